@@ -0,0 +1,15 @@
+BEGIN;
+
+ALTER TABLE tiles ADD COLUMN fingerprint VARCHAR(40);
+
+-- must match splice.models.tile_fingerprint
+UPDATE tiles SET fingerprint = SHA1(
+    target_url || CHR(31) ||
+    bg_color || CHR(31) ||
+    title || CHR(31) ||
+    image_uri || CHR(31) ||
+    COALESCE(CHR(30) || enhanced_image_uri, '') || CHR(31) ||
+    locale
+);
+
+COMMIT;
@@ -0,0 +1,12 @@
+BEGIN;
+
+CREATE TABLE deployed_artifacts (
+    id INTEGER IDENTITY(1,1) NOT NULL,
+    bucket VARCHAR(255) NOT NULL,
+    key VARCHAR(1024) NOT NULL,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (bucket, key)
+);
+
+COMMIT;
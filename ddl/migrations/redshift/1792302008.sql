@@ -0,0 +1,35 @@
+BEGIN;
+
+CREATE TABLE impression_stats_weekly (
+    year INTEGER NOT NULL,
+    week INTEGER NOT NULL,
+    tile_id INTEGER,
+    position INTEGER DEFAULT '0' NOT NULL,
+    country_code VARCHAR(5) NOT NULL,
+    locale VARCHAR(14) NOT NULL,
+    impressions INTEGER DEFAULT '0' NOT NULL,
+    clicks INTEGER DEFAULT '0' NOT NULL,
+    pinned INTEGER DEFAULT '0' NOT NULL,
+    blocked INTEGER DEFAULT '0' NOT NULL,
+    sponsored_link INTEGER DEFAULT '0' NOT NULL,
+    sponsored INTEGER DEFAULT '0' NOT NULL,
+    FOREIGN KEY(tile_id) REFERENCES tiles (id)
+);
+
+CREATE TABLE impression_stats_monthly (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    tile_id INTEGER,
+    position INTEGER DEFAULT '0' NOT NULL,
+    country_code VARCHAR(5) NOT NULL,
+    locale VARCHAR(14) NOT NULL,
+    impressions INTEGER DEFAULT '0' NOT NULL,
+    clicks INTEGER DEFAULT '0' NOT NULL,
+    pinned INTEGER DEFAULT '0' NOT NULL,
+    blocked INTEGER DEFAULT '0' NOT NULL,
+    sponsored_link INTEGER DEFAULT '0' NOT NULL,
+    sponsored INTEGER DEFAULT '0' NOT NULL,
+    FOREIGN KEY(tile_id) REFERENCES tiles (id)
+);
+
+COMMIT;
@@ -0,0 +1,41 @@
+BEGIN;
+
+-- rollups are derived data: they are recreated, to be refreshed with `data refresh_rollups`
+DROP TABLE impression_stats_weekly;
+DROP TABLE impression_stats_monthly;
+
+CREATE TABLE impression_stats_weekly (
+    date DATE NOT NULL,
+    year INTEGER NOT NULL,
+    week INTEGER NOT NULL,
+    tile_id INTEGER,
+    position INTEGER DEFAULT '0' NOT NULL,
+    country_code VARCHAR(5) NOT NULL,
+    locale VARCHAR(14) NOT NULL,
+    impressions INTEGER DEFAULT '0' NOT NULL,
+    clicks INTEGER DEFAULT '0' NOT NULL,
+    pinned INTEGER DEFAULT '0' NOT NULL,
+    blocked INTEGER DEFAULT '0' NOT NULL,
+    sponsored_link INTEGER DEFAULT '0' NOT NULL,
+    sponsored INTEGER DEFAULT '0' NOT NULL,
+    FOREIGN KEY(tile_id) REFERENCES tiles (id)
+);
+
+CREATE TABLE impression_stats_monthly (
+    date DATE NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    tile_id INTEGER,
+    position INTEGER DEFAULT '0' NOT NULL,
+    country_code VARCHAR(5) NOT NULL,
+    locale VARCHAR(14) NOT NULL,
+    impressions INTEGER DEFAULT '0' NOT NULL,
+    clicks INTEGER DEFAULT '0' NOT NULL,
+    pinned INTEGER DEFAULT '0' NOT NULL,
+    blocked INTEGER DEFAULT '0' NOT NULL,
+    sponsored_link INTEGER DEFAULT '0' NOT NULL,
+    sponsored INTEGER DEFAULT '0' NOT NULL,
+    FOREIGN KEY(tile_id) REFERENCES tiles (id)
+);
+
+COMMIT;
@@ -0,0 +1,5 @@
+BEGIN;
+
+ALTER TABLE unique_counts_daily ADD COLUMN sketch VARCHAR(65535);
+
+COMMIT;
@@ -0,0 +1,79 @@
+BEGIN;
+
+CREATE TABLE dim_os (
+    id INTEGER IDENTITY(1,1) NOT NULL,
+    name VARCHAR(64) NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (name)
+)
+DISTSTYLE ALL;
+
+INSERT INTO dim_os (name)
+SELECT os FROM impression_stats_daily UNION SELECT os FROM newtab_stats_daily;
+
+CREATE TABLE dim_browser (
+    id INTEGER IDENTITY(1,1) NOT NULL,
+    name VARCHAR(64) NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (name)
+)
+DISTSTYLE ALL;
+
+INSERT INTO dim_browser (name)
+SELECT browser FROM impression_stats_daily UNION SELECT browser FROM newtab_stats_daily;
+
+CREATE TABLE dim_version (
+    id INTEGER IDENTITY(1,1) NOT NULL,
+    name VARCHAR(64) NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (name)
+)
+DISTSTYLE ALL;
+
+INSERT INTO dim_version (name)
+SELECT version FROM impression_stats_daily UNION SELECT version FROM newtab_stats_daily;
+
+CREATE TABLE dim_device (
+    id INTEGER IDENTITY(1,1) NOT NULL,
+    name VARCHAR(64) NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (name)
+)
+DISTSTYLE ALL;
+
+INSERT INTO dim_device (name)
+SELECT device FROM impression_stats_daily UNION SELECT device FROM newtab_stats_daily;
+
+ALTER TABLE impression_stats_daily ADD COLUMN os_id INTEGER REFERENCES dim_os (id);
+UPDATE impression_stats_daily SET os_id = dim_os.id FROM dim_os WHERE impression_stats_daily.os = dim_os.name;
+ALTER TABLE impression_stats_daily DROP COLUMN os;
+
+ALTER TABLE impression_stats_daily ADD COLUMN browser_id INTEGER REFERENCES dim_browser (id);
+UPDATE impression_stats_daily SET browser_id = dim_browser.id FROM dim_browser WHERE impression_stats_daily.browser = dim_browser.name;
+ALTER TABLE impression_stats_daily DROP COLUMN browser;
+
+ALTER TABLE impression_stats_daily ADD COLUMN version_id INTEGER REFERENCES dim_version (id);
+UPDATE impression_stats_daily SET version_id = dim_version.id FROM dim_version WHERE impression_stats_daily.version = dim_version.name;
+ALTER TABLE impression_stats_daily DROP COLUMN version;
+
+ALTER TABLE impression_stats_daily ADD COLUMN device_id INTEGER REFERENCES dim_device (id);
+UPDATE impression_stats_daily SET device_id = dim_device.id FROM dim_device WHERE impression_stats_daily.device = dim_device.name;
+ALTER TABLE impression_stats_daily DROP COLUMN device;
+
+ALTER TABLE newtab_stats_daily ADD COLUMN os_id INTEGER REFERENCES dim_os (id);
+UPDATE newtab_stats_daily SET os_id = dim_os.id FROM dim_os WHERE newtab_stats_daily.os = dim_os.name;
+ALTER TABLE newtab_stats_daily DROP COLUMN os;
+
+ALTER TABLE newtab_stats_daily ADD COLUMN browser_id INTEGER REFERENCES dim_browser (id);
+UPDATE newtab_stats_daily SET browser_id = dim_browser.id FROM dim_browser WHERE newtab_stats_daily.browser = dim_browser.name;
+ALTER TABLE newtab_stats_daily DROP COLUMN browser;
+
+ALTER TABLE newtab_stats_daily ADD COLUMN version_id INTEGER REFERENCES dim_version (id);
+UPDATE newtab_stats_daily SET version_id = dim_version.id FROM dim_version WHERE newtab_stats_daily.version = dim_version.name;
+ALTER TABLE newtab_stats_daily DROP COLUMN version;
+
+ALTER TABLE newtab_stats_daily ADD COLUMN device_id INTEGER REFERENCES dim_device (id);
+UPDATE newtab_stats_daily SET device_id = dim_device.id FROM dim_device WHERE newtab_stats_daily.device = dim_device.name;
+ALTER TABLE newtab_stats_daily DROP COLUMN device;
+
+COMMIT;
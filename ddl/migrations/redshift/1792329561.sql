@@ -0,0 +1,124 @@
+BEGIN;
+
+-- tables recreated with their declared layout, see splice.redshift. Tables with identity
+-- columns are left to the redshift layout_migration command, whose copies continue their ids
+
+CREATE TABLE impression_stats_monthly_new (
+    date DATE NOT NULL,
+    year INTEGER NOT NULL ENCODE delta,
+    month INTEGER NOT NULL ENCODE delta,
+    tile_id INTEGER,
+    position INTEGER DEFAULT '0' NOT NULL ENCODE bytedict,
+    country_code VARCHAR(5) NOT NULL ENCODE bytedict,
+    locale VARCHAR(14) NOT NULL ENCODE bytedict,
+    impressions INTEGER DEFAULT '0' NOT NULL,
+    clicks INTEGER DEFAULT '0' NOT NULL,
+    pinned INTEGER DEFAULT '0' NOT NULL,
+    blocked INTEGER DEFAULT '0' NOT NULL,
+    sponsored_link INTEGER DEFAULT '0' NOT NULL,
+    sponsored INTEGER DEFAULT '0' NOT NULL,
+    FOREIGN KEY(tile_id) REFERENCES tiles (id)
+)
+DISTSTYLE KEY
+DISTKEY (tile_id)
+SORTKEY (date, tile_id);
+
+INSERT INTO impression_stats_monthly_new (date, year, month, tile_id, position, country_code, locale, impressions, clicks, pinned, blocked, sponsored_link, sponsored)
+SELECT date, year, month, tile_id, position, country_code, locale, impressions, clicks, pinned, blocked, sponsored_link, sponsored FROM impression_stats_monthly;
+
+DROP TABLE impression_stats_monthly;
+
+ALTER TABLE impression_stats_monthly_new RENAME TO impression_stats_monthly;
+
+CREATE TABLE impression_stats_daily_new (
+    tile_id INTEGER,
+    date DATE NOT NULL,
+    impressions INTEGER DEFAULT '0' NOT NULL ENCODE mostly16,
+    clicks INTEGER DEFAULT '0' NOT NULL ENCODE mostly8,
+    pinned INTEGER DEFAULT '0' NOT NULL ENCODE mostly8,
+    blocked INTEGER DEFAULT '0' NOT NULL ENCODE mostly8,
+    sponsored_link INTEGER DEFAULT '0' NOT NULL ENCODE mostly8,
+    sponsored INTEGER DEFAULT '0' NOT NULL ENCODE mostly8,
+    position INTEGER DEFAULT '0' NOT NULL ENCODE bytedict,
+    enhanced BOOLEAN DEFAULT FALSE NOT NULL ENCODE runlength,
+    locale VARCHAR(14) NOT NULL ENCODE bytedict,
+    country_code VARCHAR(5) NOT NULL ENCODE bytedict,
+    os_id INTEGER NOT NULL ENCODE bytedict,
+    browser_id INTEGER NOT NULL ENCODE bytedict,
+    version_id INTEGER NOT NULL ENCODE bytedict,
+    device_id INTEGER NOT NULL ENCODE bytedict,
+    month INTEGER NOT NULL ENCODE delta,
+    week INTEGER NOT NULL ENCODE delta,
+    year INTEGER NOT NULL ENCODE delta,
+    FOREIGN KEY(browser_id) REFERENCES dim_browser (id),
+    FOREIGN KEY(device_id) REFERENCES dim_device (id),
+    FOREIGN KEY(os_id) REFERENCES dim_os (id),
+    FOREIGN KEY(tile_id) REFERENCES tiles (id),
+    FOREIGN KEY(version_id) REFERENCES dim_version (id)
+)
+DISTSTYLE KEY
+DISTKEY (tile_id)
+SORTKEY (date, tile_id);
+
+INSERT INTO impression_stats_daily_new (tile_id, date, impressions, clicks, pinned, blocked, sponsored_link, sponsored, position, enhanced, locale, country_code, os_id, browser_id, version_id, device_id, month, week, year)
+SELECT tile_id, date, impressions, clicks, pinned, blocked, sponsored_link, sponsored, position, enhanced, locale, country_code, os_id, browser_id, version_id, device_id, month, week, year FROM impression_stats_daily;
+
+DROP TABLE impression_stats_daily;
+
+ALTER TABLE impression_stats_daily_new RENAME TO impression_stats_daily;
+
+CREATE TABLE impression_stats_weekly_new (
+    date DATE NOT NULL,
+    year INTEGER NOT NULL ENCODE delta,
+    week INTEGER NOT NULL ENCODE delta,
+    tile_id INTEGER,
+    position INTEGER DEFAULT '0' NOT NULL ENCODE bytedict,
+    country_code VARCHAR(5) NOT NULL ENCODE bytedict,
+    locale VARCHAR(14) NOT NULL ENCODE bytedict,
+    impressions INTEGER DEFAULT '0' NOT NULL,
+    clicks INTEGER DEFAULT '0' NOT NULL,
+    pinned INTEGER DEFAULT '0' NOT NULL,
+    blocked INTEGER DEFAULT '0' NOT NULL,
+    sponsored_link INTEGER DEFAULT '0' NOT NULL,
+    sponsored INTEGER DEFAULT '0' NOT NULL,
+    FOREIGN KEY(tile_id) REFERENCES tiles (id)
+)
+DISTSTYLE KEY
+DISTKEY (tile_id)
+SORTKEY (date, tile_id);
+
+INSERT INTO impression_stats_weekly_new (date, year, week, tile_id, position, country_code, locale, impressions, clicks, pinned, blocked, sponsored_link, sponsored)
+SELECT date, year, week, tile_id, position, country_code, locale, impressions, clicks, pinned, blocked, sponsored_link, sponsored FROM impression_stats_weekly;
+
+DROP TABLE impression_stats_weekly;
+
+ALTER TABLE impression_stats_weekly_new RENAME TO impression_stats_weekly;
+
+CREATE TABLE newtab_stats_daily_new (
+    date DATE NOT NULL,
+    newtabs INTEGER DEFAULT '0' NOT NULL,
+    month INTEGER NOT NULL ENCODE delta,
+    week INTEGER NOT NULL ENCODE delta,
+    year INTEGER NOT NULL ENCODE delta,
+    locale VARCHAR(14) NOT NULL ENCODE bytedict,
+    country_code VARCHAR(5) NOT NULL ENCODE bytedict,
+    os_id INTEGER NOT NULL ENCODE bytedict,
+    browser_id INTEGER NOT NULL ENCODE bytedict,
+    version_id INTEGER NOT NULL ENCODE bytedict,
+    device_id INTEGER NOT NULL ENCODE bytedict,
+    FOREIGN KEY(browser_id) REFERENCES dim_browser (id),
+    FOREIGN KEY(device_id) REFERENCES dim_device (id),
+    FOREIGN KEY(os_id) REFERENCES dim_os (id),
+    FOREIGN KEY(version_id) REFERENCES dim_version (id)
+)
+DISTSTYLE EVEN
+SORTKEY (date);
+
+INSERT INTO newtab_stats_daily_new (date, newtabs, month, week, year, locale, country_code, os_id, browser_id, version_id, device_id)
+SELECT date, newtabs, month, week, year, locale, country_code, os_id, browser_id, version_id, device_id FROM newtab_stats_daily;
+
+DROP TABLE newtab_stats_daily;
+
+ALTER TABLE newtab_stats_daily_new RENAME TO newtab_stats_daily;
+
+COMMIT;
@@ -0,0 +1,61 @@
+"""add tiles.fingerprint
+
+Revision ID: 0f32b8b5ed2a
+Revises: 4e412794c186
+Create Date: 2026-10-18 09:43:55.201384
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0f32b8b5ed2a'
+down_revision = '4e412794c186'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('tiles', sa.Column('fingerprint', sa.String(length=40), nullable=True))
+    op.create_index('ix_tiles_fingerprint', 'tiles', ['fingerprint'], unique=True)
+
+    from splice.models import tile_fingerprint
+    tiles = sa.sql.table(
+        'tiles',
+        sa.sql.column('id', sa.Integer),
+        sa.sql.column('target_url', sa.Text),
+        sa.sql.column('bg_color', sa.String),
+        sa.sql.column('title', sa.String),
+        sa.sql.column('image_uri', sa.Text),
+        sa.sql.column('enhanced_image_uri', sa.Text),
+        sa.sql.column('locale', sa.String),
+        sa.sql.column('fingerprint', sa.String),
+    )
+    conn = op.get_bind()
+    rows = conn.execute(sa.sql.select([
+        tiles.c.id, tiles.c.target_url, tiles.c.bg_color, tiles.c.title,
+        tiles.c.image_uri, tiles.c.enhanced_image_uri, tiles.c.locale])
+        .order_by(tiles.c.id)).fetchall()
+
+    # duplicates of a tile, left by a previous bug, keep no fingerprint: only the first is found
+    fingerprints = {}
+    for row in rows:
+        fingerprints.setdefault(tile_fingerprint(*row[1:]), row[0])
+    if not fingerprints:
+        return
+
+    # the digests are computed here, then set in a single statement
+    params = {}
+    values = []
+    for i, (fingerprint, tile_id) in enumerate(sorted(fingerprints.iteritems(), key=lambda item: item[1])):
+        params["id_{0}".format(i)] = tile_id
+        params["fingerprint_{0}".format(i)] = fingerprint
+        values.append("(:id_{0}, :fingerprint_{0})".format(i))
+    conn.execute(sa.sql.text(
+        "UPDATE tiles SET fingerprint = v.fingerprint "
+        "FROM (VALUES {0}) AS v (id, fingerprint) "
+        "WHERE tiles.id = v.id".format(", ".join(values))), **params)
+
+
+def downgrade():
+    op.drop_index('ix_tiles_fingerprint', 'tiles')
+    op.drop_column('tiles', 'fingerprint')
@@ -0,0 +1,26 @@
+"""add date to impression rollups
+
+Revision ID: 2b8d5e6f3a17
+Revises: 7c2e4f1a9d63
+Create Date: 2026-10-18 14:05:52.102637
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b8d5e6f3a17'
+down_revision = '7c2e4f1a9d63'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # rollups are derived data: they are emptied, to be refreshed with `data refresh_rollups`
+    for name in ('impression_stats_weekly', 'impression_stats_monthly'):
+        op.execute("DELETE FROM {0}".format(name))
+        op.add_column(name, sa.Column('date', sa.Date(), nullable=False))
+
+
+def downgrade():
+    for name in ('impression_stats_weekly', 'impression_stats_monthly'):
+        op.drop_column(name, 'date')
@@ -0,0 +1,22 @@
+"""add packed sketch to unique_counts_daily
+
+Revision ID: 4d9a1c3e7b52
+Revises: 2b8d5e6f3a17
+Create Date: 2026-10-18 16:22:40.518342
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d9a1c3e7b52'
+down_revision = '2b8d5e6f3a17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('unique_counts_daily', sa.Column('sketch', sa.String(length=65535), nullable=True))
+
+
+def downgrade():
+    op.drop_column('unique_counts_daily', 'sketch')
@@ -0,0 +1,31 @@
+"""add deployed_artifacts
+
+Revision ID: 5a1c7e0d9b34
+Revises: 0f32b8b5ed2a
+Create Date: 2026-10-18 10:12:31.774120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a1c7e0d9b34'
+down_revision = '0f32b8b5ed2a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('deployed_artifacts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('bucket', sa.String(length=255), nullable=False),
+    sa.Column('key', sa.String(length=1024), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('bucket', 'key')
+    )
+    op.create_index('ix_deployed_artifacts_key', 'deployed_artifacts', ['key'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_deployed_artifacts_key', 'deployed_artifacts')
+    op.drop_table('deployed_artifacts')
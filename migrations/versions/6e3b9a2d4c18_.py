@@ -0,0 +1,49 @@
+"""add client dimension tables, referred to by id from the daily stats
+
+Revision ID: 6e3b9a2d4c18
+Revises: 4d9a1c3e7b52
+Create Date: 2026-10-18 17:05:12.604217
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e3b9a2d4c18'
+down_revision = '4d9a1c3e7b52'
+
+from alembic import op
+import sqlalchemy as sa
+
+DIMENSIONS = ('os', 'browser', 'version', 'device')
+TABLES = ('impression_stats_daily', 'newtab_stats_daily')
+
+
+def upgrade():
+    for dimension in DIMENSIONS:
+        op.create_table('dim_{0}'.format(dimension),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name')
+        )
+        op.execute(
+            "INSERT INTO dim_{0} (name) "
+            "SELECT {0} FROM impression_stats_daily UNION SELECT {0} FROM newtab_stats_daily".format(dimension))
+
+        for table in TABLES:
+            op.add_column(table, sa.Column('{0}_id'.format(dimension), sa.Integer(), nullable=True))
+            op.execute(
+                "UPDATE {1} SET {0}_id = dim_{0}.id FROM dim_{0} WHERE {1}.{0} = dim_{0}.name".format(dimension, table))
+            op.alter_column(table, '{0}_id'.format(dimension), nullable=False)
+            op.create_foreign_key(None, table, 'dim_{0}'.format(dimension), ['{0}_id'.format(dimension)], ['id'])
+            op.drop_column(table, dimension)
+
+
+def downgrade():
+    for dimension in DIMENSIONS:
+        for table in TABLES:
+            op.add_column(table, sa.Column(dimension, sa.String(length=64), nullable=True))
+            op.execute(
+                "UPDATE {1} SET {0} = dim_{0}.name FROM dim_{0} WHERE {1}.{0}_id = dim_{0}.id".format(dimension, table))
+            op.alter_column(table, dimension, nullable=False)
+            op.drop_column(table, '{0}_id'.format(dimension))
+        op.drop_table('dim_{0}'.format(dimension))
@@ -0,0 +1,42 @@
+"""add impression_stats_weekly and impression_stats_monthly
+
+Revision ID: 7c2e4f1a9d63
+Revises: 5a1c7e0d9b34
+Create Date: 2026-10-18 12:40:08.315526
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2e4f1a9d63'
+down_revision = '5a1c7e0d9b34'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def _create_rollup(name, period):
+    op.create_table(name,
+    sa.Column('year', sa.Integer(), nullable=False),
+    sa.Column(period, sa.Integer(), nullable=False),
+    sa.Column('tile_id', sa.Integer(), nullable=True),
+    sa.Column('position', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('country_code', sa.String(length=5), nullable=False),
+    sa.Column('locale', sa.String(length=14), nullable=False),
+    sa.Column('impressions', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('clicks', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('pinned', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('blocked', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('sponsored_link', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('sponsored', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['tile_id'], ['tiles.id'], )
+    )
+
+
+def upgrade():
+    _create_rollup('impression_stats_weekly', 'week')
+    _create_rollup('impression_stats_monthly', 'month')
+
+
+def downgrade():
+    op.drop_table('impression_stats_monthly')
+    op.drop_table('impression_stats_weekly')
@@ -0,0 +1,64 @@
+"""partition impression_stats_daily by month, with indexes on (tile_id, date) and (position, date)
+
+Revision ID: 8f1d2c7b5a40
+Revises: 6e3b9a2d4c18
+Create Date: 2026-10-18 18:12:37.941520
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f1d2c7b5a40'
+down_revision = '6e3b9a2d4c18'
+
+from datetime import date
+from alembic import op
+import sqlalchemy as sa
+
+FOREIGN_KEYS = (
+    ('tile_id', 'tiles'),
+    ('os_id', 'dim_os'),
+    ('browser_id', 'dim_browser'),
+    ('version_id', 'dim_version'),
+    ('device_id', 'dim_device'),
+)
+
+
+def _next_month(month):
+    return date(month.year + month.month / 12, month.month % 12 + 1, 1)
+
+
+def _copy_table(partitioned):
+    op.execute("ALTER TABLE impression_stats_daily RENAME TO impression_stats_daily_old")
+    op.execute(
+        "CREATE TABLE impression_stats_daily (LIKE impression_stats_daily_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS)" +
+        (" PARTITION BY RANGE (date)" if partitioned else ""))
+    for column, referred in FOREIGN_KEYS:
+        op.create_foreign_key(None, 'impression_stats_daily', referred, [column], ['id'])
+
+
+def upgrade():
+    _copy_table(partitioned=True)
+
+    # partitions for the months loaded, through the next one. Later ones are created by `data manage_partitions`
+    first, last = op.get_bind().execute(sa.text("SELECT MIN(date), MAX(date) FROM impression_stats_daily_old")).first()
+    today = date.today()
+    month = date((first or today).year, (first or today).month, 1)
+    end = _next_month(date(today.year, today.month, 1))
+    if last is not None and last > end:
+        end = last
+    while month <= end:
+        op.execute("CREATE TABLE impression_stats_daily_{0:04d}_{1:02d} PARTITION OF impression_stats_daily "
+                   "FOR VALUES FROM ('{2}') TO ('{3}')".format(month.year, month.month, month, _next_month(month)))
+        month = _next_month(month)
+
+    op.execute("INSERT INTO impression_stats_daily SELECT * FROM impression_stats_daily_old")
+    op.drop_table('impression_stats_daily_old')
+    op.create_index('ix_impression_stats_daily_tile_id_date', 'impression_stats_daily', ['tile_id', 'date'])
+    op.create_index('ix_impression_stats_daily_position_date', 'impression_stats_daily', ['position', 'date'])
+
+
+def downgrade():
+    _copy_table(partitioned=False)
+    op.execute("INSERT INTO impression_stats_daily SELECT * FROM impression_stats_daily_old")
+    # drops the partitions
+    op.drop_table('impression_stats_daily_old')
@@ -0,0 +1,81 @@
+import time
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+from werkzeug.contrib.cache import BaseCache, FileSystemCache, NullCache
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache holding up to about max_bytes of items, evicting the least recently used.
+    The size of an item is that of its pickle, and items larger than max_bytes are not kept
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            expires, size, value = item
+            if expires <= time.time():
+                self._bytes -= size
+                return None
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        size = len(key) + len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._discard(key)
+            if size > self._max_bytes:
+                return False
+            self._items[key] = (time.time() + timeout, size, value)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, evicted, _) = self._items.popitem(last=False)
+                self._bytes -= evicted
+        return True
+
+    def _discard(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._bytes -= item[1]
+        return item is not None
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+        return True
+
+
+def create_cache(config):
+    """
+    Create the report cache configured: "memory" is private to a process, "filesystem" is shared
+    by the processes of a host, e.g. gunicorn workers. Any other value disables caching
+    """
+    backend = config.REPORT_CACHE_BACKEND
+    if backend == "memory":
+        return LRUCache(max_bytes=config.REPORT_CACHE_MAX_BYTES, default_timeout=config.REPORT_CACHE_TTL)
+    elif backend == "filesystem":
+        return FileSystemCache(config.REPORT_CACHE_DIR, threshold=config.REPORT_CACHE_THRESHOLD,
+                               default_timeout=config.REPORT_CACHE_TTL)
+    return NullCache()
@@ -46,16 +46,30 @@ def setup_command_logger(loglevel=None):
     return logger
 
 
+def pool_config(config, workers, worker_connections):
+    """
+    Size the connection pool of each worker. A greenlet holds at most one connection at a time,
+    and the workers together hold at most DATABASE_MAX_CONNECTIONS; greenlets beyond that wait
+    for a connection up to SQLALCHEMY_POOL_TIMEOUT
+    """
+    per_worker = max(1, config.DATABASE_MAX_CONNECTIONS // workers)
+    return {
+        "SQLALCHEMY_POOL_SIZE": min(worker_connections, per_worker),
+        "SQLALCHEMY_MAX_OVERFLOW": 0,
+    }
+
+
 class GunicornServerCommand(Command):
     """
     Run the splice Server using gunicorn
     """
-    def __init__(self, host='127.0.0.1', port=5000, workers=1,
+    def __init__(self, host='127.0.0.1', port=5000, workers=1, worker_connections=100,
                  access_logfile='-', max_requests=0, debug=True):
         self.options = {
             "host": host,
             "port": port,
             "workers": workers,
+            "worker_connections": worker_connections,
             "access_logfile": access_logfile,
             "max_requests": max_requests,
             "debug": debug,
@@ -78,6 +92,11 @@ class GunicornServerCommand(Command):
                    type=int,
                    default=self.options['workers'],
                    help="set the number of workers"),
+            Option('--worker-connections',
+                   dest='worker_connections',
+                   type=int,
+                   default=self.options['worker_connections'],
+                   help="set the number of concurrent greenlets per worker"),
             Option('--access-logfile',
                    dest='access_logfile',
                    type=str,
@@ -113,6 +132,7 @@ class GunicornServerCommand(Command):
                     ),
                     'workers': options['workers'],
                     'worker_class': 'gevent',
+                    'worker_connections': options['worker_connections'],
                     'accesslog': options['access_logfile'],
                     'max_requests': options['max_requests'],
                 }
@@ -122,6 +142,8 @@ class GunicornServerCommand(Command):
                 # Step needed to get around flask's import time side-effects
                 from splice.environment import Environment
                 env = Environment.instance()
+                env.application.config.update(
+                    pool_config(env.config, options['workers'], options['worker_connections']))
                 return env.application
 
             def load_config(self):
@@ -218,10 +240,11 @@ def load_links(in_file, country_code, out_path, console_out, verbose, old_format
 
 @DataCommand.option("-v", "--verbose", action="store_true", dest="verbose", help="turns on verbose mode", default=False, required=False)
 @DataCommand.option("-d", "--deploy", action="store_true", dest="deploy_flag", help="Deploy to S3", required=False)
+@DataCommand.option("-f", "--force", action="store_true", dest="force_flag", help="Upload all files, including those already deployed", required=False)
 @DataCommand.option("-c", "--console", action="store_true", dest="console_out", help="Enable console output", required=False)
 @DataCommand.option("-o", "--out_path", type=str, help="To dump to a file, provide a path/filename", required=False)
 @DataCommand.option("in_file", type=str, help="Path to tiles.json file")
-def ingest_tiles(in_file, out_path, console_out, deploy_flag, verbose, *args, **kwargs):
+def ingest_tiles(in_file, out_path, console_out, deploy_flag, force_flag, verbose, *args, **kwargs):
     """
     Load a set of links for all country/locale combinations into data warehouse and optionally deploy
     """
@@ -230,34 +253,151 @@ def ingest_tiles(in_file, out_path, console_out, deploy_flag, verbose, *args, **
     else:
         logger = setup_command_logger(logging.INFO)
 
-    rawdata = None
+    from splice.ingest import ingest_stream, deploy, IngestError
+
+    try:
+        with open(in_file, 'r') as f:
+            new_data = ingest_stream(f)
+
+        try:
+            if console_out:
+                new_data.dump(sys.stdout)
+
+            if out_path:
+                directory, _ = os.path.split(out_path)
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+
+                with open(out_path, "w") as f:
+                    new_data.dump(f)
+                    logger.info("wrote {0}".format(out_path))
+
+            if deploy_flag:
+                deploy(new_data, force=force_flag)
+        finally:
+            new_data.close()
+    except IngestError, e:
+        raise InvalidCommand(e.message)
+    except:
+        import traceback
+        traceback.print_exc()
+
+
+@DataCommand.option("-n", "--iterations", type=int, dest="iterations", help="Number of timed runs", default=10, required=False)
+@DataCommand.option("in_file", type=str, help="Path to tiles.json file")
+def benchmark_validation(in_file, iterations, *args, **kwargs):
+    """
+    Report the cost of validating each tile of a tiles.json file
+    """
+    logger = setup_command_logger(logging.INFO)
+
+    import timeit
+    import jsonschema
+    from splice.ingest import payload_schema, payload_validator
+
     with open(in_file, 'r') as f:
         rawdata = json.load(f)
+    num_tiles = sum(len(tiles) for tiles in rawdata.itervalues())
+
+    validators = (
+        ("jsonschema.validate", lambda: jsonschema.validate(rawdata, payload_schema)),
+        ("payload_validator", lambda: payload_validator.validate(rawdata)),
+    )
+    for name, validate in validators:
+        best = min(timeit.repeat(validate, number=1, repeat=iterations))
+        logger.info("{0}: {1:.1f}us per tile ({2} tiles, best of {3})".format(
+            name, best * 1e6 / max(num_tiles, 1), num_tiles, iterations))
+
+
+@DataCommand.option("-e", "--end-date", type=str, dest="end_date", help="Last date loaded, YYYY-MM-DD. Defaults to the start date", required=False)
+@DataCommand.option("start_date", type=str, help="First date loaded, YYYY-MM-DD")
+def refresh_rollups(start_date, end_date, *args, **kwargs):
+    """
+    Recompute the weekly and monthly impression rollups for the periods of the dates loaded
+    """
+    logger = setup_command_logger(logging.INFO)
 
-    from splice.ingest import ingest_links, deploy, IngestError
+    from splice.queries import refresh_rollups
 
     try:
-        new_data = ingest_links(rawdata)
+        start = datetime.strptime(start_date, "%Y-%m-%d").date()
+        end = datetime.strptime(end_date or start_date, "%Y-%m-%d").date()
+    except ValueError, e:
+        raise InvalidCommand(e.message)
 
-        if console_out:
-            print json.dumps(new_data, sort_keys=True, indent=2)
+    refreshed = refresh_rollups(start, end)
+    logger.info("refreshed {0} rollup periods for {1} to {2}".format(refreshed, start, end))
 
-        if out_path:
-            directory, _ = os.path.split(out_path)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
 
-            with open(out_path, "w") as f:
-                json.dump(new_data, f, sort_keys=True, indent=2)
-                logger.info("wrote {0}".format(out_path))
+@DataCommand.option("-b", "--batch-size", type=int, dest="batch_size", help="Sketches packed per transaction", default=1000, required=False)
+def pack_sketches(batch_size, *args, **kwargs):
+    """
+    Pack the HLL sketches stored as rows of registers in unique_hlls
+    """
+    logger = setup_command_logger(logging.INFO)
 
-        if deploy_flag:
-            deploy(new_data)
-    except IngestError, e:
-        raise InvalidCommand(e.message)
+    from splice.queries import pack_sketches
+
+    packed = pack_sketches(batch_size)
+    logger.info("packed {0} sketches".format(packed))
+
+
+@DataCommand.option("-w", "--workers", type=int, dest="workers", help="Processes reading the event logs. Defaults to one per CPU", required=False)
+@DataCommand.option("-s", "--staging-dir", type=str, dest="staging_dir", help="Directory for the staged files", required=False)
+@DataCommand.option("-k", "--keep-staging", action="store_true", dest="keep_staging", help="Keep the staged files", default=False, required=False)
+@DataCommand.option("in_files", type=str, nargs="+", help="Paths to newline delimited JSON event logs, optionally gzipped")
+def load_stats(in_files, staging_dir, keep_staging, workers, *args, **kwargs):
+    """
+    Load event logs into the daily stats tables, replacing the stats of the days loaded
+    """
+    logger = setup_command_logger(logging.INFO)
+
+    from splice.loader import load_stats
+
+    days, invalid = load_stats(in_files, staging_dir=staging_dir, keep_staging=keep_staging, workers=workers)
+    logger.info("loaded {0} days, skipped {1} invalid lines".format(days, invalid))
+
+
+@DataCommand.option("-d", "--detach-only", action="store_true", dest="detach_only", help="Detach partitions past the retention without dropping them", default=False, required=False)
+@DataCommand.option("-r", "--retention-months", type=int, dest="retention_months", help="Months of partitions kept, before the current one", required=False)
+@DataCommand.option("-a", "--months-ahead", type=int, dest="months_ahead", help="Months of partitions created after the current one", required=False)
+def manage_partitions(months_ahead, retention_months, detach_only, *args, **kwargs):
+    """
+    Create the monthly partitions of the daily stats ahead of time, and remove those past their retention
+    """
+    logger = setup_command_logger(logging.INFO)
+
+    from splice.environment import Environment
+    from splice.partitions import PARTITIONED_TABLES, supports_partitions, create_partitions, drop_partitions, \
+        month_start, add_months
+
+    env = Environment.instance()
+    if months_ahead is None:
+        months_ahead = env.config.PARTITION_MONTHS_AHEAD
+    if retention_months is None:
+        retention_months = env.config.PARTITION_RETENTION_MONTHS
+
+    current = month_start(datetime.utcnow().date())
+    conn = env.db.engine.connect()
+    trans = conn.begin()
+    try:
+        if not supports_partitions(conn):
+            raise InvalidCommand("partitions need Postgres 11 or later")
+        for table in PARTITIONED_TABLES:
+            for name in create_partitions(conn, table, current, add_months(current, months_ahead)):
+                logger.info("created {0}".format(name))
+            if retention_months is not None:
+                for name, renamed in drop_partitions(conn, table, add_months(current, -retention_months), detach_only):
+                    if renamed is not None:
+                        logger.info("detached {0} as {1}".format(name, renamed))
+                    else:
+                        logger.info("dropped {0}".format(name))
+        trans.commit()
     except:
-        import traceback
-        traceback.print_exc()
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
 
 
 RedshiftCommand = Manager(usage="Redshift utility commands")
@@ -274,3 +414,33 @@ def new_migration(out_path, *args, **kwargs):
     file_path = os.path.join(out_path, "{0}.sql".format(utc_seconds))
     open(file_path, "a").close()
     logger.info("wrote {0}".format(file_path))
+
+
+@RedshiftCommand.option("out_path", type=str, help="Path to output the migration file")
+def layout_migration(out_path, *args, **kwargs):
+    """
+    Compare the layout of the tables in Redshift to the layout declared by the models, and write
+    a migration deep copying the tables that differ. The copies continue the ids of the tables as
+    they are now: run the migration before any tile is ingested or stats are loaded
+    """
+    logger = setup_command_logger(logging.INFO)
+
+    from splice.environment import Environment
+    from splice.redshift import layout_migration
+
+    db = Environment.instance().db
+    with db.engine.connect() as conn:
+        migration, diffs = layout_migration(conn, db.metadata.sorted_tables)
+
+    for table_name, diff in sorted(diffs.iteritems()):
+        for line in diff:
+            logger.info("{0}: {1}".format(table_name, line))
+    if migration is None:
+        logger.info("all table layouts are as declared")
+        return
+
+    utc_seconds = calendar.timegm(datetime.utcnow().timetuple())
+    file_path = os.path.join(out_path, "{0}.sql".format(utc_seconds))
+    with open(file_path, "w") as f:
+        f.write(migration)
+    logger.info("wrote {0}".format(file_path))
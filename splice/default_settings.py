@@ -28,6 +28,8 @@ class DefaultConfig(object):
     SQLALCHEMY_ECHO = False
     SQLALCHEMY_POOL_SIZE = 5
     SQLALCHEMY_POOL_TIMEOUT = 10
+    # connections the web server workers may hold altogether
+    DATABASE_MAX_CONNECTIONS = 100
 
     # set AWS to None to use boto defaults
     AWS = {
@@ -40,8 +42,59 @@ class DefaultConfig(object):
         "tile_index_key": "tile_index.json"
     }
 
+    # concurrent uploads, artifacts queued for upload and attempts per artifact when deploying to S3
+    S3_UPLOAD_WORKERS = 8
+    S3_UPLOAD_QUEUE_SIZE = 16
+    S3_UPLOAD_RETRIES = 3
+    S3_UPLOAD_RETRY_DELAY = 0.5
+
     CLOUDFRONT_BASE_URL = "https://d3bhweee2a5al5.cloudfront.net"
 
+    # rows per chunk of a streamed report response
+    REPORT_CHUNK_ROWS = 1000
+    # ids per batch report request
+    REPORT_BATCH_MAX_IDS = 500
+
+    # weekly and monthly reports read from the impression rollups.
+    # Enable once they are populated, with `data refresh_rollups`
+    IMPRESSION_ROLLUPS_ENABLED = False
+
+    # registers of the unique_hlls sketches are numbered from 0 to 2^HLL_PRECISION - 1
+    HLL_PRECISION = 14
+
+    # report results cache: "memory", "filesystem" or "null" to disable.
+    # A memory cache holds up to about REPORT_CACHE_MAX_BYTES per process, a filesystem cache up to
+    # REPORT_CACHE_THRESHOLD files per host in REPORT_CACHE_DIR.
+    # Results of periods closed for REPORT_CACHE_CLOSED_AFTER days are kept for REPORT_CACHE_CLOSED_TTL
+    # seconds, others for REPORT_CACHE_TTL seconds. Results of more than REPORT_CACHE_MAX_ROWS are not cached
+    REPORT_CACHE_BACKEND = "null"
+    REPORT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    REPORT_CACHE_DIR = "/tmp/splice-report-cache"
+    REPORT_CACHE_THRESHOLD = 500
+    REPORT_CACHE_MAX_ROWS = 10000
+    REPORT_CACHE_TTL = 300
+    REPORT_CACHE_CLOSED_TTL = 7 * 24 * 3600
+    REPORT_CACHE_CLOSED_AFTER = 2
+
+    # event logs loaded by `data load_stats` are staged in a temporary directory of LOAD_STAGING_DIR,
+    # or of the system's if None, in gzipped files of at most LOAD_STAGING_FILE_ROWS rows
+    LOAD_STAGING_DIR = None
+    LOAD_STAGING_FILE_ROWS = 100000
+    # processes summing event logs, a file at a time. None for one per CPU
+    LOAD_WORKERS = None
+    # Redshift copies the staged files from S3: they are uploaded under a prefix of a bucket,
+    # readable with the AWS credentials, and removed once loaded
+    LOAD_S3 = {
+        "bucket": "moz-tiles-local",
+        "prefix": "load-staging"
+    }
+
+    # on Postgres, impression_stats_daily has a partition per month, created PARTITION_MONTHS_AHEAD
+    # months ahead by `data manage_partitions`, which removes those older than PARTITION_RETENTION_MONTHS.
+    # None keeps them all
+    PARTITION_MONTHS_AHEAD = 3
+    PARTITION_RETENTION_MONTHS = None
+
     LOG_HANDLERS = {
         'application': {
             'handler': logging.handlers.SysLogHandler,
@@ -39,6 +39,7 @@ class Environment(object):
 
         self.__s3_conn = None
         self.__fixtures = None
+        self.__report_cache = None
         self.__db = SQLAlchemy()
 
         for path in CONFIG_PATH_LOCATIONS:
@@ -116,6 +117,14 @@ class Environment(object):
 
         return self.__s3_conn
 
+    @property
+    def report_cache(self):
+        if not self.__report_cache:
+            from splice.cache import create_cache
+            self.__report_cache = create_cache(self.config)
+
+        return self.__report_cache
+
     @property
     def fixtures(self):
         if not self.__fixtures:
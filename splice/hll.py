@@ -0,0 +1,124 @@
+"""
+HyperLogLog cardinality estimation over the registers of unique_hlls.
+
+A sketch is an array of 2^p registers. Sketches merge by taking the maximum of each register,
+so the unique count of any range of days, countries or locales is estimated from the daily
+sketches alone. Several sketches are handled at once, as the rows of a 2-dimensional array
+"""
+import base64
+import hashlib
+import numpy as np
+
+
+def register_count(precision):
+    return 1 << precision
+
+
+def alpha(m):
+    """
+    Bias correction constant for m registers
+    """
+    if m == 16:
+        return 0.673
+    elif m == 32:
+        return 0.697
+    elif m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+def empty(precision, count=None):
+    """
+    Empty sketch, or array of count empty sketches
+    """
+    shape = register_count(precision) if count is None else (count, register_count(precision))
+    return np.zeros(shape, dtype=np.uint8)
+
+
+def add(registers, values, precision):
+    """
+    Add values to a sketch. Values are hashed to 64 bits: the first precision bits select a
+    register, which keeps the highest position of the first set bit in the remaining bits
+    """
+    rest_bits = 64 - precision
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        digest = int(hashlib.sha1(value).hexdigest()[:16], 16)
+        index = digest >> rest_bits
+        rest = digest & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > registers[index]:
+            registers[index] = rank
+    return registers
+
+
+def merge_into(sketches, rows, indexes, values):
+    """
+    Merge (index, value) registers into rows of an array of sketches, in place
+    """
+    np.maximum.at(sketches, (np.asarray(rows, dtype=np.intp), np.asarray(indexes, dtype=np.intp)),
+                  np.asarray(values, dtype=np.uint8))
+    return sketches
+
+
+def merge(*sketches):
+    """
+    Union of sketches
+    """
+    return np.maximum.reduce(sketches)
+
+
+def estimate(sketches):
+    """
+    Estimated cardinality of a sketch, or of each row of an array of sketches.
+    Small cardinalities, for which the raw estimate is biased, are counted linearly from the
+    empty registers. With 64 bit hashes, large cardinalities need no correction
+    """
+    single = np.ndim(sketches) == 1
+    sketches = np.atleast_2d(sketches)
+    m = sketches.shape[1]
+    raw = alpha(m) * m * m / np.sum(np.exp2(-sketches.astype(np.float64)), axis=1)
+    zeros = np.sum(sketches == 0, axis=1)
+    with np.errstate(divide="ignore"):
+        linear = m * np.log(np.float64(m) / zeros)
+    result = np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+    result = np.rint(result).astype(np.int64)
+    if single:
+        return int(result[0])
+    return result
+
+
+def pack(registers):
+    """
+    Encode a sketch as text, in the denser of two formats: "S" followed by the indexes and
+    values of the non-empty registers, or "D" followed by all registers, 6 bits each
+    """
+    registers = np.asarray(registers, dtype=np.uint8)
+    indexes = np.nonzero(registers)[0]
+    if len(indexes) * 3 < len(registers) * 3 / 4:
+        data = "S" + indexes.astype("<u2").tostring() + registers[indexes].tostring()
+    else:
+        r = registers.reshape(-1, 4).astype(np.uint32)
+        words = (r[:, 0] << 18) | (r[:, 1] << 12) | (r[:, 2] << 6) | r[:, 3]
+        data = "D" + np.column_stack((words >> 16, words >> 8, words)).astype(np.uint8).tostring()
+    return base64.b64encode(data)
+
+
+def unpack(packed, precision):
+    """
+    Decode a sketch encoded by pack
+    """
+    data = base64.b64decode(packed)
+    registers = empty(precision)
+    if data[:1] == "S":
+        count = (len(data) - 1) / 3
+        indexes = np.frombuffer(data, dtype="<u2", count=count, offset=1)
+        registers[indexes] = np.frombuffer(data, dtype=np.uint8, offset=1 + 2 * count)
+    elif data[:1] == "D":
+        b = np.frombuffer(data, dtype=np.uint8, offset=1).reshape(-1, 3).astype(np.uint32)
+        words = (b[:, 0] << 16) | (b[:, 1] << 8) | b[:, 2]
+        registers[:] = np.column_stack((words >> 18, words >> 12, words >> 6, words)).ravel() & 0x3f
+    else:
+        raise ValueError("Unknown sketch format")
+    return registers
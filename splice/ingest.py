@@ -5,14 +5,19 @@ import hashlib
 import logging
 import base64
 import urllib
-import copy
 import re
+import time
+import tempfile
+import threading
+import Queue
 from datetime import datetime
 from boto.s3.cors import CORSConfiguration
 from boto.s3.key import Key
 import jsonschema
 from furl import furl
-from splice.queries import tile_exists, insert_tile, insert_distribution
+from splice.models import tile_fingerprint
+from splice.queries import tile_fingerprints, resolve_tiles, insert_distribution, \
+    deployed_keys, insert_deployed_keys
 from splice.environment import Environment
 
 command_logger = logging.getLogger("command")
@@ -24,52 +29,234 @@ mime_extensions = {
     "image/svg+xml": "svg",
 }
 
+country_locale_pattern = "^([A-Za-z]+)/([A-Za-z-]+)$"
+
+tile_schema = {
+    "type": "object",
+    "properties": {
+        "directoryId": {
+            "type": "integer",
+        },
+        "url": {
+            "type": "string",
+            "pattern": "^https?://.*$",
+        },
+        "title": {
+            "type": "string",
+        },
+        "bgColor": {
+            "type": "string",
+            "pattern": "^#[0-9a-fA-F]+$|^rgb\([0-9]+,[0-9]+,[0-9]+\)$|"
+        },
+        "type": {
+            "enum": ["affiliate", "organic", "sponsored"],
+        },
+        "imageURI": {
+            "type": "string",
+            "pattern": "^data:image/.*$|^https?://.*$",
+        },
+        "enhancedImageURI": {
+            "type": "string",
+            "pattern": "^data:image/.*$|^https?://.*$",
+        },
+    },
+    "required": ["url", "title", "bgColor", "type", "imageURI"],
+}
+
 payload_schema = {
     "type": "object",
     "patternProperties": {
-        "^([A-Za-z]+)/([A-Za-z-]+)$": {
+        country_locale_pattern: {
             "type": "array",
-            "items": {
-                "type": "object",
-                "properties": {
-                    "directoryId": {
-                        "type": "integer",
-                    },
-                    "url": {
-                        "type": "string",
-                        "pattern": "^https?://.*$",
-                    },
-                    "title": {
-                        "type": "string",
-                    },
-                    "bgColor": {
-                        "type": "string",
-                        "pattern": "^#[0-9a-fA-F]+$|^rgb\([0-9]+,[0-9]+,[0-9]+\)$|"
-                    },
-                    "type": {
-                        "enum": ["affiliate", "organic", "sponsored"],
-                    },
-                    "imageURI": {
-                        "type": "string",
-                        "pattern": "^data:image/.*$|^https?://.*$",
-                    },
-                    "enhancedImageURI": {
-                        "type": "string",
-                        "pattern": "^data:image/.*$|^https?://.*$",
-                    },
-                },
-                "required": ["url", "title", "bgColor", "type", "imageURI"],
-            }
+            "items": tile_schema,
         }
     },
     "additionalProperties": False,
 }
 
 
+def _compile_pattern(pattern):
+    """
+    Return a function testing a string against a schema pattern, as re.search would.
+    Patterns made of ^prefix.*$ alternatives only need their prefix matched and the
+    absence of a line break, other than a trailing one, which `.` would not match.
+    Data URIs are only checked on their prefix, so multi-megabyte images are not
+    scanned: their payload is checked when decoded by slice_image_uri
+    """
+    alternatives = pattern.split("|")
+    if all(a.startswith("^") and a.endswith(".*$") and "(" not in a for a in alternatives):
+        prefix = re.compile("(?:{0})".format("|".join(a[1:-3] for a in alternatives)))
+
+        def check(instance):
+            match = prefix.match(instance)
+            if match is None:
+                return False
+            return match.group().startswith("data:") or instance.find("\n") in (-1, len(instance) - 1)
+        return check
+
+    regex = re.compile(pattern)
+    return lambda instance: regex.search(instance) is not None
+
+_pattern_checks = {}
+
+
+def _pattern(validator, pattern, instance, schema):
+    if not validator.is_type(instance, "string"):
+        return
+
+    check = _pattern_checks.get(pattern)
+    if check is None:
+        check = _pattern_checks[pattern] = _compile_pattern(pattern)
+
+    if not check(instance):
+        yield jsonschema.exceptions.ValidationError("%r does not match %r" % (instance, pattern))
+
+PayloadValidator = jsonschema.validators.extend(jsonschema.Draft4Validator, {"pattern": _pattern})
+
+# schemas are checked and validators built once, rather than on every validation
+PayloadValidator.check_schema(payload_schema)
+payload_validator = PayloadValidator(payload_schema)
+tile_validator = PayloadValidator(tile_schema)
+country_locale_re = re.compile(country_locale_pattern)
+
+
 class IngestError(Exception):
     pass
 
 
+class _PayloadReader(object):
+    """
+    Incremental reader over a JSON document, decoding one value at a time
+    """
+    whitespace = re.compile(r"[ \t\n\r]*")
+    decoder = json.JSONDecoder()
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        """
+        Read more data, discarding what was consumed. Return False at the end of input
+        """
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        data = self.fp.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def peek(self):
+        """
+        Return the next non-whitespace character, or None at the end of input
+        """
+        while True:
+            self.pos = self.whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self.chunk_size):
+                return None
+
+    def expect(self, chars):
+        """
+        Consume and return the next non-whitespace character, which must be one of chars
+        """
+        char = self.peek()
+        if char is None or char not in chars:
+            raise IngestError("Invalid JSON: expected one of '{0}'".format(chars))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decode the next JSON value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                end = None
+
+            # a value ending with the buffer, such as a number, may continue in the next chunk
+            if end is not None and (end < len(self.buf) or self.eof):
+                self.pos = end
+                return value
+
+            # read as much again as is buffered, so that large values are decoded in linear time
+            if not self._fill(max(self.chunk_size, len(self.buf) - self.pos)) and end is None:
+                raise IngestError("Invalid JSON: unexpected end of input")
+
+
+def iter_payload(fp, chunk_size=64 * 1024, validate=True):
+    """
+    Parse a tiles payload from a file object incrementally, yielding a
+    (country_locale, tiles) tuple per country/locale. Each tile is validated as
+    soon as it is read, unless validate is False, so memory is bounded by a single
+    country/locale. The end of the payload is only checked once all are yielded
+    """
+    reader = _PayloadReader(fp, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.expect("}")
+        _expect_end(reader)
+        return
+
+    country_locales = set()
+    while True:
+        country_locale = reader.value()
+        if not isinstance(country_locale, basestring):
+            raise IngestError("Invalid JSON: expected a property name")
+        if country_locale in country_locales:
+            raise IngestError("Invalid JSON: duplicate country/locale {0}".format(country_locale))
+        country_locales.add(country_locale)
+        if not country_locale_re.match(country_locale):
+            raise jsonschema.exceptions.ValidationError(
+                "Additional properties are not allowed ({0!r} was unexpected)".format(country_locale),
+                path=[country_locale])
+
+        reader.expect(":")
+        if reader.peek() != "[":
+            raise jsonschema.exceptions.ValidationError(
+                "{0!r} is not of type 'array'".format(country_locale), path=[country_locale])
+        reader.expect("[")
+
+        tiles = []
+        if reader.peek() == "]":
+            reader.expect("]")
+        else:
+            while True:
+                tile = reader.value()
+                if validate:
+                    error = jsonschema.exceptions.best_match(tile_validator.iter_errors(tile))
+                    if error is not None:
+                        error.path.appendleft(len(tiles))
+                        error.path.appendleft(country_locale)
+                        raise error
+                tiles.append(tile)
+                if reader.expect(",]") == "]":
+                    break
+
+        yield country_locale, tiles
+
+        if reader.expect(",}") == "}":
+            break
+
+    _expect_end(reader)
+
+
+def _expect_end(reader):
+    if reader.peek() is not None:
+        raise IngestError("Invalid JSON: unexpected data after the payload")
+
+
 def slice_image_uri(image_uri):
     """
     Turn an image uri into a sha1 hash, mime_type and data tuple
@@ -94,83 +281,206 @@ def ingest_links(data, *args, **kwargs):
     """
 
     try:
-        jsonschema.validate(data, payload_schema)
+        payload_validator.validate(data)
     except jsonschema.exceptions.ValidationError, e:
         command_logger.error("ERROR: cannot validate JSON: {0}".format(e.message))
         exc_class, exc, tb = sys.exc_info()
         raise exc_class, exc, tb
 
-    from splice.environment import Environment
-    env = Environment.instance()
+    return _ingest_links(data)
 
-    ingested_data = {}
 
-    country_locales = sorted(data.keys())
+class IngestedPayload(object):
+    """
+    Tiles of a payload ingested from a stream, with their directoryId. The stream is spooled to
+    a temporary file as it is ingested, and read again one country/locale at a time, so that the
+    payload and its images are never held in memory whole
+    """
 
-    for country_locale_str in country_locales:
+    def __init__(self, spool, directory_ids):
+        self.spool = spool
+        self.directory_ids = directory_ids
 
-        tiles = data[country_locale_str]
-        country_code, locale = country_locale_str.split("/")
-        country_code = country_code.upper()
+    def iteritems(self):
+        """
+        Yield a (country_locale, tiles) tuple per country/locale, in payload order
+        """
+        self.spool.seek(0)
+        directory_ids = iter(self.directory_ids)
+        for country_locale_str, tiles in iter_payload(self.spool, validate=False):
+            for t in tiles:
+                t["directoryId"] = next(directory_ids)
+            yield country_locale_str, tiles
+
+    def dump(self, fp):
+        """
+        Write the tiles as a JSON object, one country/locale at a time
+        """
+        fp.write("{")
+        for i, (country_locale_str, tiles) in enumerate(self.iteritems()):
+            tiles_json = json.dumps(tiles, sort_keys=True, indent=2).replace("\n", "\n  ")
+            fp.write("{0}\n  {1}: {2}".format("," if i else "", json.dumps(country_locale_str), tiles_json))
+        fp.write("\n}\n")
 
-        if country_code not in Environment.instance().fixtures["countries"]:
-            raise IngestError("country_code '{0}' is invalid".format(country_code))
+    def close(self):
+        self.spool.close()
 
-        if locale not in Environment.instance().fixtures["locales"]:
-            raise IngestError("locale '{0}' is invalid".format(locale))
 
-        command_logger.info("PROCESSING FOR COUNTRY:{0} LOCALE:{1}".format(country_code, locale))
+class _SpoolingReader(object):
+    """
+    File object copying what is read from another to a spool
+    """
 
-        new_tiles_list = []
+    def __init__(self, fp, spool):
+        self.fp = fp
+        self.spool = spool
 
-        for t in tiles:
-            conn = env.db.engine.connect()
-            trans = conn.begin()
-            if not env.is_test:
-                conn.execute("LOCK TABLE tiles;")
+    def read(self, size):
+        data = self.fp.read(size)
+        self.spool.write(data)
+        return data
 
-            image_hash = hashlib.sha1(t["imageURI"]).hexdigest()
-            enhanced_image_hash = hashlib.sha1(t.get("enhancedImageURI")).hexdigest() if "enhancedImageURI" in t else None
 
-            columns = dict(
-                target_url=t["url"],
-                bg_color=t["bgColor"],
-                title=t["title"],
-                type=t["type"],
-                image_uri=image_hash,
-                enhanced_image_uri=enhanced_image_hash,
-                locale=locale,
-                conn=conn
-            )
+def ingest_stream(fp, *args, **kwargs):
+    """
+    Obtain links from a file object, insert in data warehouse. The whole stream is validated
+    and its tiles staged, without their images, before a single transaction resolves them.
+    Return an IngestedPayload
+    """
+    spool = tempfile.TemporaryFile()
+    try:
+        staged = []
+        try:
+            for country_locale_str, tiles in iter_payload(_SpoolingReader(fp, spool)):
+                staged.extend(_stage_tiles(country_locale_str, tiles))
+        except jsonschema.exceptions.ValidationError, e:
+            command_logger.error("ERROR: cannot validate JSON: {0}".format(e.message))
+            exc_class, exc, tb = sys.exc_info()
+            raise exc_class, exc, tb
+
+        # tiles are resolved in the order ingest_links resolves them, then reported in payload order
+        order = sorted(xrange(len(staged)), key=lambda i: staged[i][0])
+        directory_ids = _resolve_tiles([staged[i] for i in order])
+        ids = [None] * len(staged)
+        for i, directory_id in zip(order, directory_ids):
+            ids[i] = directory_id
+    except:
+        spool.close()
+        raise
+
+    return IngestedPayload(spool, ids)
+
 
-            db_tile_id = tile_exists(**columns)
-            f_tile_id = t.get("directoryId")
+def _stage_tiles(country_locale_str, tiles):
+    """
+    Return a (country_locale, directoryId, fingerprint, columns) tuple per tile of a country/locale
+    """
+    env = Environment.instance()
 
-            if db_tile_id is None:
-                """
-                Will generate a new id if not found in db
-                """
-                db_tile_id = insert_tile(**columns)
-                t["directoryId"] = db_tile_id
-                new_tiles_list.append(t)
-                command_logger.info("INSERT: Creating id:{0}".format(db_tile_id))
+    country_code, locale = country_locale_str.split("/")
+    country_code = country_code.upper()
 
-            elif db_tile_id == f_tile_id:
-                new_tiles_list.append(t)
-                command_logger.info("NOOP: id:{0} already exists".format(f_tile_id))
+    if country_code not in env.fixtures["countries"]:
+        raise IngestError("country_code '{0}' is invalid".format(country_code))
 
-            else:
-                """
-                Either f_tile_id was not provided or
-                the id's provided differ
-                """
-                t["directoryId"] = db_tile_id
-                new_tiles_list.append(t)
-                command_logger.info("IGNORE: Tile already exists with id: {1}".format(f_tile_id, db_tile_id))
+    if locale not in env.fixtures["locales"]:
+        raise IngestError("locale '{0}' is invalid".format(locale))
 
+    command_logger.info("PROCESSING FOR COUNTRY:{0} LOCALE:{1}".format(country_code, locale))
+
+    staged = []
+    for t in tiles:
+        image_hash = hashlib.sha1(t["imageURI"]).hexdigest()
+        enhanced_image_hash = hashlib.sha1(t.get("enhancedImageURI")).hexdigest() if "enhancedImageURI" in t else None
+
+        columns = dict(
+            target_url=t["url"],
+            bg_color=t["bgColor"],
+            title=t["title"],
+            type=t["type"],
+            image_uri=image_hash,
+            enhanced_image_uri=enhanced_image_hash,
+            locale=locale,
+        )
+        staged.append((country_locale_str, t.get("directoryId"), tile_fingerprint(**columns), columns))
+    return staged
+
+
+def _resolve_tiles(staged):
+    """
+    Find or insert the staged tiles, so that the tiles table is only queried and written
+    to once per ingestion. Return the directoryId of each
+    """
+    env = Environment.instance()
+
+    # tiles seen before are resolved in-process, the others in one transaction
+    db_tile_ids = tile_fingerprints.lookup(set(fp for _, _, fp, _ in staged))
+
+    # tiles are inserted in order of appearance, so ids are allocated in payload order
+    unresolved = []
+    unresolved_fps = set()
+    for _, _, fingerprint, columns in staged:
+        if fingerprint not in db_tile_ids and fingerprint not in unresolved_fps:
+            unresolved_fps.add(fingerprint)
+            unresolved.append(columns)
+
+    inserted_ids = {}
+    if unresolved:
+        conn = env.db.engine.connect()
+        trans = conn.begin()
+        try:
+            found_ids, inserted_ids = resolve_tiles(unresolved, conn)
             trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+
+        db_tile_ids.update(found_ids)
+        tile_fingerprints.update(db_tile_ids)
+
+    created = set()
+    directory_ids = []
+
+    for _, f_tile_id, fingerprint, _ in staged:
+
+        db_tile_id = db_tile_ids[fingerprint]
+
+        if fingerprint in inserted_ids and fingerprint not in created:
+            """
+            A new id was generated as the tile was not found in db
+            """
+            created.add(fingerprint)
+            command_logger.info("INSERT: Creating id:{0}".format(db_tile_id))
+
+        elif db_tile_id == f_tile_id:
+            command_logger.info("NOOP: id:{0} already exists".format(f_tile_id))
+
+        else:
+            """
+            Either f_tile_id was not provided or
+            the id's provided differ
+            """
+            command_logger.info("IGNORE: Tile already exists with id: {1}".format(f_tile_id, db_tile_id))
+
+        directory_ids.append(db_tile_id)
+
+    return directory_ids
 
-        ingested_data[country_locale_str] = new_tiles_list
+
+def _ingest_links(data):
+    country_locales = sorted(data.keys())
+
+    staged = []
+    for country_locale_str in country_locales:
+        staged.extend(_stage_tiles(country_locale_str, data[country_locale_str]))
+    directory_ids = _resolve_tiles(staged)
+
+    ingested_data = dict((country_locale_str, data[country_locale_str]) for country_locale_str in country_locales)
+    tiles = (t for country_locale_str in country_locales for t in data[country_locale_str])
+    for t, directory_id in zip(tiles, directory_ids):
+        t["directoryId"] = directory_id
 
     return ingested_data
 
@@ -179,6 +489,15 @@ def generate_artifacts(data):
     """
     Generate locale json files, upload to s3
     """
+    return list(iter_artifacts(data))
+
+
+def iter_artifacts(data):
+    """
+    Generate images and locale json files, followed by the tile index and distribution.
+    Artifacts are yielded as they are generated, so they need not be held in memory together
+    """
+    # artifacts generated but not yet yielded
     artifacts = []
     tile_index = {}
     image_index = {}
@@ -200,103 +519,216 @@ def generate_artifacts(data):
             artifacts.append({
                 "mime": mime_type,
                 "key": s3_key,
-                "data": image
+                "data": image,
+                "immutable": True
             })
 
         return image_index[hash]
 
+    # urls of the image uris seen so far, by digest of the uri so that the uris themselves are
+    # not kept: an image shared by tiles across locales is only decoded the first time round
+    image_urls = {}
+
+    def image_url(image_uri, locale, tile_id):
+        """
+        Return the file url of an image uri
+        """
+        uri_hash = hashlib.sha1(image_uri).digest()
+        if uri_hash not in image_urls:
+            image_urls[uri_hash] = image_add(*slice_image_uri(image_uri), locale=locale, tile_id=tile_id)
+        return image_urls[uri_hash]
+
     for country_locale, tile_data in data.iteritems():
 
         country_code, locale = country_locale.split("/")
-        # copy data to modify inplace
-        tile_data = copy.deepcopy(tile_data)
+
+        # shallow copies share the original strings: only image uris are replaced. An
+        # IngestedPayload releases the original tiles, and their images, once they are done
+        tile_data = [dict(tile) for tile in tile_data]
 
         for tile in tile_data:
             # image splitting from input
-            url = image_add(*slice_image_uri(tile["imageURI"]), locale=locale, tile_id=tile["directoryId"])
-            tile["imageURI"] = url
+            tile["imageURI"] = image_url(tile["imageURI"], locale, tile["directoryId"])
 
             if 'enhancedImageURI' in tile:
-                url = image_add(*slice_image_uri(tile["enhancedImageURI"]), locale=locale, tile_id=tile["directoryId"])
-                tile["enhancedImageURI"] = url
+                tile["enhancedImageURI"] = image_url(tile["enhancedImageURI"], locale, tile["directoryId"])
+
+            for artifact in artifacts:
+                yield artifact
+            del artifacts[:]
 
         serialized = json.dumps({locale: tile_data}, sort_keys=True)
         hsh = hashlib.sha1(serialized).hexdigest()
         s3_key = "{0}.{1}.json".format(country_locale, hsh)
-        artifacts.append({
+        yield {
             "key": s3_key,
             "data": serialized,
-        })
+            "immutable": True
+        }
 
         tile_index[country_locale] = os.path.join(env.config.CLOUDFRONT_BASE_URL, s3_key)
 
     # include tile index
 
-    artifacts.append({
+    yield {
         "key": env.config.S3["tile_index_key"],
-        "data": json.dumps(tile_index, sort_keys=True)
-    })
+        "data": json.dumps(tile_index, sort_keys=True),
+        "index": True
+    }
 
-    # include data submission in artifacts
+    # include data submission in artifacts, with its images, so that it can be submitted again.
+    # It is read again a country/locale at a time, should data be an IngestedPayload
 
-    data_serialized = json.dumps(data, sort_keys=True)
+    data_serialized = "{{{0}}}".format(", ".join(
+        "{0}: {1}".format(json.dumps(country_locale), json.dumps(tile_data, sort_keys=True))
+        for country_locale, tile_data in data.iteritems()))
     hsh = hashlib.sha1(data_serialized).hexdigest()
     dt_str = datetime.utcnow().isoformat().replace(":", "-")
-    artifacts.append({
+    yield {
         "key": os.path.join("/distributions", "{0}.{1}.json".format(hsh, dt_str)),
         "data": data_serialized,
         "dist": True
-    })
+    }
 
-    return artifacts
 
+def upload_artifact(bucket, file):
+    """
+    Upload an artifact publicly readable, retrying on failure, and return its url
+    """
+    env = Environment.instance()
 
-def deploy(data):
-    command_logger.info("Generating Data")
-    artifacts = generate_artifacts(data)
+    headers = {
+        'Cache-Control': 'public, max-age=31536000',
+        'Content-Disposition': 'inline',
+        # default to JSON for artifacts
+        'Content-Type': file.get("mime", "application/json"),
+    }
+
+    start_time = time.time()
+    attempt = 1
+    while True:
+        try:
+            key = Key(bucket)
+            key.name = file["key"]
+            # the ACL is set with the PUT rather than in a separate request
+            key.set_contents_from_string(file["data"], headers=headers, policy="public-read")
+            break
+        except Exception, e:
+            if attempt >= env.config.S3_UPLOAD_RETRIES:
+                raise
+            command_logger.warning("RETRY: upload of {0} failed on attempt {1}: {2}".format(file["key"], attempt, e))
+            time.sleep(env.config.S3_UPLOAD_RETRY_DELAY * attempt)
+            attempt += 1
+
+    url = key.generate_url(expires_in=0, query_auth=False)
+
+    # remove x-amz-security-token, which is inserted even if query_auth=False
+    # ref: https://github.com/boto/boto/issues/1477
+    uri = furl(url)
+    try:
+        uri.args.pop('x-amz-security-token')
+    except:
+        pass
+    url = uri.url
 
-    command_logger.info("Uploading to S3")
+    command_logger.info("Deployed file at {0} in {1:.3f}s".format(url, time.time() - start_time))
+    return url
 
-    bucket = Environment.instance().s3.get_bucket(Environment.instance().config.S3["bucket"])
+
+def deploy(data, force=False):
+    """
+    Upload artifacts to S3 as they are generated. Immutable artifacts, whose keys embed a hash of
+    their content, are skipped if a previous deployment already uploaded them, unless force is set
+    """
+    env = Environment.instance()
+    bucket_name = env.config.S3["bucket"]
+    bucket = env.s3.get_bucket(bucket_name)
     cors = CORSConfiguration()
     cors.add_rule("GET", "*", allowed_header="*")
     bucket.set_cors(cors)
 
-    deployed = []
+    command_logger.info("Generating Data and Uploading to S3")
+    start_time = time.time()
 
-    headers = {
-        'Cache-Control': 'public, max-age=31536000',
-        'Content-Disposition': 'inline',
-    }
+    # artifacts are generated in this thread and uploaded by workers. The queue is bounded,
+    # so that only a few artifacts are in memory at any time
+    upload_queue = Queue.Queue(maxsize=env.config.S3_UPLOAD_QUEUE_SIZE)
+    uploaded = []
+    errors = []
 
-    # upload individual files
-    for file in artifacts:
-        if "mime" in file:
-            headers['Content-Type'] = file["mime"]
-        else:
-            # default to JSON for artifacts
-            headers['Content-Type'] = "application/json"
+    def upload_worker():
+        while True:
+            item = upload_queue.get()
+            try:
+                if item is None:
+                    return
+                if not errors:
+                    index, file = item
+                    url = upload_artifact(bucket, file)
+                    uploaded.append((index, file["key"], file.get("immutable"), url))
+                    # release the artifact's content as soon as it is uploaded
+                    file["data"] = None
+            except:
+                errors.append(sys.exc_info())
+            finally:
+                upload_queue.task_done()
+
+    workers = [threading.Thread(target=upload_worker) for _ in xrange(env.config.S3_UPLOAD_WORKERS)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    # the manifest of deployed keys is checked a batch of artifacts at a time
+    batch = []
+
+    def enqueue_batch():
+        skipped = set()
+        if not force:
+            skipped = deployed_keys(bucket_name, [f["key"] for _, f in batch if f.get("immutable")])
+        for index, file in batch:
+            if file["key"] in skipped:
+                command_logger.info("SKIP: {0} already deployed".format(file["key"]))
+            else:
+                upload_queue.put((index, file))
+        del batch[:]
 
-        key = Key(bucket)
-        key.name = file["key"]
-        key.set_contents_from_string(file["data"], headers=headers)
-        key.set_acl("public-read")
+    # the tile index and distribution refer to the other artifacts,
+    # so they are only uploaded once those are all in place
+    finalizing = []
 
-        url = key.generate_url(expires_in=0, query_auth=False)
+    try:
+        for index, file in enumerate(iter_artifacts(data)):
+            if errors:
+                break
+            if file.get("index") or file.get("dist"):
+                finalizing.append(file)
+                continue
+            batch.append((index, file))
+            if len(batch) >= env.config.S3_UPLOAD_QUEUE_SIZE:
+                enqueue_batch()
+        else:
+            enqueue_batch()
+    finally:
+        for worker in workers:
+            upload_queue.put(None)
+        for worker in workers:
+            worker.join()
+        # keys uploaded are recorded even if the deployment fails
+        insert_deployed_keys(bucket_name, [key for _, key, immutable, _ in uploaded if immutable])
+
+    if errors:
+        exc_class, exc, tb = errors[0]
+        raise exc_class, exc, tb
 
-        # remove x-amz-security-token, which is inserted even if query_auth=False
-        # ref: https://github.com/boto/boto/issues/1477
-        uri = furl(url)
-        try:
-            uri.args.pop('x-amz-security-token')
-        except:
-            pass
-        url = uri.url
+    deployed = [url for _, _, _, url in sorted(uploaded)]
 
-        command_logger.info("Deployed file at {0}".format(url))
+    for file in finalizing:
+        url = upload_artifact(bucket, file)
         deployed.append(url)
 
         if file.get("dist", False):
             insert_distribution(url)
 
+    command_logger.info("Uploaded {0} files in {1:.3f}s".format(len(deployed), time.time() - start_time))
+
     return deployed
@@ -0,0 +1,395 @@
+"""
+Load newline delimited JSON event logs into impression_stats_daily and newtab_stats_daily.
+
+Each line is an event of a new tab page:
+
+    {"date": "2014-09-23", "locale": "en-US", "country_code": "US", "os": "Windows",
+     "browser": "Firefox", "version": "34.0", "device": "Desktop",
+     "tiles": [{"id": 16}, {"id": 15, "pos": 3}], "enhanced": false, "click": 1}
+
+An event without an action is a view: it counts a new tab, and an impression of each tile with
+an id. An event with an action ("click", "block", "pin", "sponsored" or "sponsored_link")
+counts the action for the tile at that index. Tile positions default to their index, and
+events are not enhanced unless told.
+
+Events are summed in memory to the grain of the daily tables, a file per worker process with
+the files shared out between them, then the sums of all files are merged. They are staged as
+gzipped CSV files, with the names of the client's os, browser, version and device replaced by
+their ids, and copied into the tables, replacing the stats of the days loaded in a single
+transaction. Postgres copies the files from the client, Redshift from S3, where they are uploaded
+with a manifest listing them. Other databases, such as sqlite in tests, insert their rows
+"""
+import os
+import csv
+import gzip
+import json
+import logging
+import multiprocessing
+import shutil
+import tempfile
+from datetime import datetime
+from boto.s3.key import Key
+from sqlalchemy.sql import text
+from splice.models import impression_stats_daily, newtab_stats_daily, dimensions
+from splice.queries import refresh_rollups, encode_dimension, dimension_name, dimension_ids
+from splice.partitions import supports_partitions, create_partitions
+from splice.environment import Environment
+
+command_logger = logging.getLogger("command")
+
+ACTIONS = {
+    "click": "clicks",
+    "block": "blocked",
+    "pin": "pinned",
+    "sponsored": "sponsored",
+    "sponsored_link": "sponsored_link",
+}
+
+CLIENT_COLUMNS = ("locale", "country_code", "os", "browser", "version", "device")
+# stored as ids of the names in their dimension table
+DIMENSION_COLUMNS = ("os", "browser", "version", "device")
+IMPRESSION_KEYS = ("tile_id", "date", "position", "enhanced") + CLIENT_COLUMNS
+IMPRESSION_SUMS = ("impressions", "clicks", "pinned", "blocked", "sponsored_link", "sponsored")
+NEWTAB_KEYS = ("date",) + CLIENT_COLUMNS
+NEWTAB_SUMS = ("newtabs",)
+PERIOD_COLUMNS = ("month", "week", "year")
+# longest values of the client columns, in bytes as Redshift counts them
+CLIENT_LENGTHS = dict([(c, impression_stats_daily.c[c].type.length) for c in ("locale", "country_code")] +
+                      [(c, dimensions[c].c.name.type.length) for c in DIMENSION_COLUMNS])
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _client_value(event, column):
+    """
+    Value of a client column of an event: a string, not empty, that fits the column
+    """
+    value = event[column]
+    if not isinstance(value, basestring) or not 0 < len(value.encode("utf-8")) <= CLIENT_LENGTHS[column]:
+        raise ValueError("invalid {0}".format(column))
+    return value
+
+
+def aggregate(lines):
+    """
+    Sum events to the grain of the daily tables.
+    Return the impression and newtab sums, keyed by their dimensions, and the number of invalid lines
+    """
+    impressions = {}
+    newtabs = {}
+    invalid = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            event = json.loads(line)
+            day = datetime.strptime(event["date"], "%Y-%m-%d").date()
+            enhanced = bool(event.get("enhanced", False))
+            client = tuple(_client_value(event, c) for c in CLIENT_COLUMNS)
+            tiles = [(int(t["id"]), int(t.get("pos", i))) for i, t in enumerate(event["tiles"]) if t.get("id") is not None]
+            actions = [a for a in ACTIONS if a in event]
+            if len(actions) > 1:
+                raise ValueError("more than one action")
+            if actions:
+                index = int(event[actions[0]])
+                if index < 0:
+                    raise IndexError("negative tile index")
+                tile = event["tiles"][index]
+                tile_id, position = int(tile["id"]), int(tile.get("pos", index))
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+            invalid += 1
+            continue
+
+        if actions:
+            counts = impressions.setdefault((tile_id, day, position, enhanced) + client, [0] * len(IMPRESSION_SUMS))
+            counts[IMPRESSION_SUMS.index(ACTIONS[actions[0]])] += 1
+        else:
+            newtab = newtabs.setdefault((day,) + client, [0])
+            newtab[0] += 1
+            for tile_id, position in tiles:
+                counts = impressions.setdefault((tile_id, day, position, enhanced) + client, [0] * len(IMPRESSION_SUMS))
+                counts[0] += 1
+    return impressions, newtabs, invalid
+
+
+def aggregate_file(path):
+    """
+    Sum the events of a file, as aggregate does
+    """
+    with _open(path) as fd:
+        return (path,) + aggregate(fd)
+
+
+def merge_sums(into, sums):
+    """
+    Add sums keyed by their dimensions to others, in place
+    """
+    for key, counts in sums.iteritems():
+        total = into.get(key)
+        if total is None:
+            into[key] = counts
+        else:
+            for i, count in enumerate(counts):
+                total[i] += count
+    return into
+
+
+def aggregate_files(paths, workers=None):
+    """
+    Sum the events of files, shared out between worker processes.
+    Return the sums of all files, as aggregate does
+    """
+    impressions = {}
+    newtabs = {}
+    invalid = 0
+
+    workers = min(workers or multiprocessing.cpu_count(), len(paths))
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(aggregate_file, paths)
+    else:
+        results = (aggregate_file(path) for path in paths)
+
+    try:
+        for path, file_impressions, file_newtabs, file_invalid in results:
+            merge_sums(impressions, file_impressions)
+            merge_sums(newtabs, file_newtabs)
+            invalid += file_invalid
+            command_logger.info("read {0}: {1} invalid lines".format(path, file_invalid))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return impressions, newtabs, invalid
+
+
+def _period_columns(day):
+    return day.month, day.isocalendar()[1], day.year
+
+
+def _csv_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def stage(sums, keys, staging_dir, name, file_rows=None):
+    """
+    Write summed rows to gzipped CSV files of at most file_rows rows, with the columns of
+    the keys, the sums and the periods. Return the paths of the files
+    """
+    file_rows = file_rows or Environment.instance().config.LOAD_STAGING_FILE_ROWS
+    date_index = keys.index("date")
+    paths = []
+    writer = fd = None
+    for i, (key, counts) in enumerate(sorted(sums.iteritems())):
+        if i % file_rows == 0:
+            if fd is not None:
+                fd.close()
+            paths.append(os.path.join(staging_dir, "{0}.{1:04d}.csv.gz".format(name, len(paths))))
+            fd = gzip.open(paths[-1], "wb")
+            writer = csv.writer(fd)
+        row = list(key) + list(counts) + list(_period_columns(key[date_index]))
+        writer.writerow([_csv_value(v) for v in row])
+    if fd is not None:
+        fd.close()
+    return paths
+
+
+def write_manifest(staging_dir, name, urls):
+    """
+    Write a manifest of staged files, in the format read by Redshift's COPY ... MANIFEST
+    """
+    path = os.path.join(staging_dir, "{0}.manifest".format(name))
+    with open(path, "w") as fd:
+        json.dump({"entries": [{"url": url, "mandatory": True} for url in urls]}, fd)
+    return path
+
+
+def upload_staged(bucket, prefix, staging_dir, name, paths):
+    """
+    Upload staged files to S3 under a prefix, followed by a manifest of them.
+    Return the names of the keys uploaded, the manifest's last
+    """
+    keys = []
+    for path in paths + [None]:
+        if path is None:
+            urls = ["s3://{0}/{1}".format(bucket.name, k) for k in keys]
+            path = write_manifest(staging_dir, name, urls)
+        key = Key(bucket)
+        key.name = "{0}/{1}".format(prefix, os.path.basename(path))
+        key.set_contents_from_filename(path)
+        keys.append(key.name)
+    return keys
+
+
+def _supports_copy(conn):
+    """
+    Whether the connection can COPY FROM STDIN. Redshift can only copy from S3, and like
+    in splice.queries is told from Postgres by the lack of RETURNING
+    """
+    return conn.dialect.name == "postgresql" and conn.dialect.driver == "psycopg2" and conn.dialect.implicit_returning
+
+
+def _copies_from_s3(conn):
+    """
+    Whether the connection is to Redshift
+    """
+    return conn.dialect.name == "postgresql" and not conn.dialect.implicit_returning
+
+
+def _s3_credentials(s3):
+    """
+    Credentials of an S3 connection, as given to Redshift's COPY
+    """
+    credentials = "aws_access_key_id={0};aws_secret_access_key={1}".format(s3.aws_access_key_id, s3.aws_secret_access_key)
+    if s3.provider.security_token:
+        credentials += ";token={0}".format(s3.provider.security_token)
+    return credentials
+
+
+def _column(key):
+    if key in DIMENSION_COLUMNS:
+        return "{0}_id".format(key)
+    return key
+
+
+def _parse_value(column, value):
+    if column == "date":
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    elif column == "enhanced":
+        return value == "true"
+    elif column in ("locale", "country_code"):
+        return value.decode("utf-8")
+    return int(value)
+
+
+def copy_file(conn, table, columns, path):
+    """
+    Load a staged file into a table, with COPY where supported, else with a batched insert
+    """
+    if _supports_copy(conn):
+        cursor = conn.connection.cursor()
+        try:
+            with gzip.open(path, "rb") as fd:
+                cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH CSV".format(table.name, ", ".join(columns)), fd)
+        finally:
+            cursor.close()
+    else:
+        with gzip.open(path, "rb") as fd:
+            rows = [dict((c, _parse_value(c, v)) for c, v in zip(columns, row)) for row in csv.reader(fd)]
+        if rows:
+            conn.execute(table.insert(), rows)
+
+
+def copy_manifest(conn, table, columns, manifest_url, credentials):
+    """
+    Load the files listed by a manifest on S3 into a table, with Redshift's COPY
+    """
+    conn.execute(text("COPY {0} ({1}) FROM :manifest CREDENTIALS :credentials MANIFEST GZIP CSV".format(
+        table.name, ", ".join(columns))), manifest=manifest_url, credentials=credentials)
+
+
+def lock_dimensions(conn):
+    """
+    Serialize loads adding names to the dimension tables, as Redshift doesn't enforce their
+    uniqueness. On Postgres, reports may still read the tables
+    """
+    names = ", ".join(sorted(table.name for table in dimensions.itervalues()))
+    if _copies_from_s3(conn):
+        conn.execute("LOCK {0};".format(names))
+    elif conn.dialect.name == "postgresql":
+        conn.execute("LOCK TABLE {0} IN SHARE ROW EXCLUSIVE MODE;".format(names))
+
+
+def encode_dimensions(conn, sums, keys):
+    """
+    Replace the names of the client dimensions in the keys of sums by their ids.
+    Return the sums and the mappings of names to ids, to cache once committed
+    """
+    indexes = [(dimension, keys.index(dimension)) for dimension in DIMENSION_COLUMNS]
+    mappings = dict((dimension, encode_dimension(conn, dimension, set(key[i] for key in sums)))
+                    for dimension, i in indexes)
+
+    encoded = {}
+    for key, counts in sums.iteritems():
+        key = list(key)
+        for dimension, i in indexes:
+            key[i] = mappings[dimension][dimension_name(key[i])]
+        # keys differing only by the type of a name are summed together
+        merge_sums(encoded, {tuple(key): counts})
+    return encoded, mappings
+
+
+def load_stats(paths, staging_dir=None, keep_staging=False, workers=None):
+    """
+    Load event logs, replacing the stats of the days they have events for, and refresh the
+    rollups of those days. Return the number of days loaded and of invalid lines
+    """
+    env = Environment.instance()
+
+    impressions, newtabs, invalid = aggregate_files(paths, workers or env.config.LOAD_WORKERS)
+
+    days = sorted(set(key[IMPRESSION_KEYS.index("date")] for key in impressions) | set(key[0] for key in newtabs))
+    if not days:
+        return 0, invalid
+
+    staging_dir = tempfile.mkdtemp(prefix="splice-load-", dir=staging_dir or env.config.LOAD_STAGING_DIR)
+    bucket = None
+    uploaded = []
+    conn = env.db.engine.connect()
+    trans = conn.begin()
+    try:
+        lock_dimensions(conn)
+        if supports_partitions(conn):
+            create_partitions(conn, impression_stats_daily, days[0], days[-1])
+        if _copies_from_s3(conn):
+            bucket = env.s3.get_bucket(env.config.LOAD_S3["bucket"])
+            prefix = "{0}/{1}".format(env.config.LOAD_S3["prefix"], os.path.basename(staging_dir))
+
+        mappings = []
+        for table, keys, sums_columns, sums in ((impression_stats_daily, IMPRESSION_KEYS, IMPRESSION_SUMS, impressions),
+                                                (newtab_stats_daily, NEWTAB_KEYS, NEWTAB_SUMS, newtabs)):
+            sums, table_mappings = encode_dimensions(conn, sums, keys)
+            mappings.append(table_mappings)
+            staged = stage(sums, keys, staging_dir, table.name)
+
+            columns = tuple(_column(k) for k in keys) + sums_columns + PERIOD_COLUMNS
+            if bucket is not None:
+                uploaded.extend(upload_staged(bucket, prefix, staging_dir, table.name, staged))
+                conn.execute(table.delete().where(table.c.date.in_(days)))
+                if staged:
+                    copy_manifest(conn, table, columns, "s3://{0}/{1}".format(bucket.name, uploaded[-1]),
+                                  _s3_credentials(env.s3))
+            else:
+                conn.execute(table.delete().where(table.c.date.in_(days)))
+                for path in staged:
+                    copy_file(conn, table, columns, path)
+            command_logger.info("loaded {0} files into {1}".format(len(staged), table.name))
+
+        refresh_rollups(days[0], days[-1], conn=conn)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+        if keep_staging:
+            command_logger.info("staged files kept in {0}".format(staging_dir))
+        else:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if uploaded:
+                bucket.delete_keys(uploaded)
+
+    for table_mappings in mappings:
+        for dimension, mapping in table_mappings.iteritems():
+            dimension_ids.update(dimension, mapping)
+
+    return len(days), invalid
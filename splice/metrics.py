@@ -0,0 +1,111 @@
+"""
+Metrics derived from the sums of report results, computed over whole columns at once
+"""
+from datetime import date, timedelta
+import numpy as np
+
+SUMS = ("impressions", "clicks", "pinned", "blocked", "sponsored", "sponsored_link")
+
+RATES = (
+    ("ctr", "clicks"),
+    ("pin_rate", "pinned"),
+    ("block_rate", "blocked"),
+)
+
+DELTAS = ("impressions", "clicks", "ctr")
+
+
+def _rates(sums, keys):
+    impressions = sums[:, keys.index("impressions")]
+    rates = np.zeros((len(sums), len(RATES)))
+    for i, (_, name) in enumerate(RATES):
+        np.divide(sums[:, keys.index(name)], impressions, out=rates[:, i], where=impressions > 0)
+    return rates
+
+
+def _week_start(year, week):
+    """
+    First day of the calendar year in an ISO week, which may be one of the ISO year before
+    """
+    for iso_year in (year, year - 1):
+        jan4 = date(iso_year, 1, 4)
+        monday = jan4 + timedelta(days=7 * (week - 1) - jan4.weekday())
+        if monday.isocalendar()[:2] != (iso_year, week):
+            continue
+        for i in xrange(7):
+            day = monday + timedelta(days=i)
+            if day.year == year:
+                return day
+    return None
+
+
+def previous_period(year, period, value):
+    """
+    (year, value) of the period before another, as in the year and period columns of the stats
+    tables: weeks are the ISO weeks of the calendar year. None if the period doesn't exist
+    """
+    if period == 'month':
+        return (year, value - 1) if value > 1 else (year - 1, 12)
+    if period == 'week':
+        start = _week_start(year, value)
+        if start is None:
+            return None
+        day = start - timedelta(days=1)
+        return day.year, day.isocalendar()[1]
+    day = value - timedelta(days=1)
+    return day.year, day
+
+
+def derive(keys, rows, id_key):
+    """
+    Add rates, and deltas from the previous period with results of the same id, to rows of a
+    summary ordered by period. Deltas are None when the id has no results for the period right
+    before. Rows totalling each id over all periods follow, then a row for the grand total: their
+    period columns, and the id column of the grand total, are None
+    """
+    sum_keys = [k for k in keys if k in SUMS]
+    rate_keys = [name for name, _ in RATES]
+    out_keys = tuple(keys) + tuple(rate_keys) + tuple("{0}_delta".format(k) for k in DELTAS)
+
+    if not rows:
+        return out_keys, []
+
+    id_index = keys.index(id_key)
+    sum_indexes = [keys.index(k) for k in sum_keys]
+    ids = np.array([row[id_index] for row in rows])
+    sums = np.array([[row[i] for i in sum_indexes] for row in rows], dtype=np.float64)
+    rates = _rates(sums, sum_keys)
+
+    # deltas: rows of an id, in period order, each minus the one before if of the period before
+    period = next(k for k in keys[1:] if k in ('week', 'month', 'date'))
+    year_index, period_index = keys.index('year'), keys.index(period)
+    periods = [(row[year_index], row[period_index]) for row in rows]
+    previous = [previous_period(year, period, value) for year, value in periods]
+
+    values = np.column_stack([sums[:, sum_keys.index(k)] if k in sum_keys else rates[:, rate_keys.index(k)]
+                              for k in DELTAS])
+    order = np.lexsort((np.arange(len(rows)), ids))
+    deltas = np.full(values.shape, np.nan)
+    consecutive = np.array([previous[i] == periods[j] for i, j in zip(order[1:], order[:-1])], dtype=bool)
+    follows = (ids[order][1:] == ids[order][:-1]) & consecutive
+    deltas[order[1:][follows]] = values[order][1:][follows] - values[order][:-1][follows]
+
+    # deltas of counts are counts, like the sums they are taken from
+    delta_types = [int if k in SUMS else float for k in DELTAS]
+    derived = []
+    for row, row_rates, row_deltas in zip(rows, rates.tolist(), deltas.tolist()):
+        derived.append(tuple(row) + tuple(row_rates) +
+                       tuple(None if np.isnan(d) else t(d) for t, d in zip(delta_types, row_deltas)))
+
+    # totals per id, in order of first appearance, and overall
+    unique_ids, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    totals = np.zeros((len(unique_ids), len(sum_keys)))
+    np.add.at(totals, inverse, sums)
+    totals = np.vstack((totals[np.argsort(first)], sums.sum(axis=0)))
+    total_ids = [rows[i][id_index] for i in sorted(first)] + [None]
+    for total_id, total_sums, total_rates in zip(total_ids, totals.tolist(), _rates(totals, sum_keys).tolist()):
+        row = dict(zip(sum_keys, [int(s) for s in total_sums]))
+        row[id_key] = total_id
+        derived.append(tuple(row.get(k) for k in keys) + tuple(total_rates) + (None,) * len(DELTAS))
+
+    return out_keys, derived
@@ -1,3 +1,4 @@
+import hashlib
 from datetime import datetime
 from sqlalchemy.sql.functions import current_date
 from splice.environment import Environment
@@ -13,8 +14,43 @@ class Distribution(db.Model):
     created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
 
 
+class DeployedArtifact(db.Model):
+    __tablename__ = "deployed_artifacts"
+    __table_args__ = (db.UniqueConstraint("bucket", "key"),)
+
+    id = db.Column(db.Integer(), autoincrement=True, primary_key=True, info={"identity": [1, 1]})
+    bucket = db.Column(db.String(255), nullable=False)
+    key = db.Column(db.String(1024), nullable=False, index=True)
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+
+
+def tile_fingerprint(target_url, bg_color, title, image_uri, enhanced_image_uri, locale, *args, **kwargs):
+    """
+    Return a digest of the columns identifying a tile. The enhanced image is prefixed by CHR(30)
+    when there is one, so that a NULL one differs from an empty one. Redshift can compute the
+    same digest with SHA1() over the columns joined by CHR(31)
+    """
+    enhanced_image_uri = u"\x1e" + enhanced_image_uri if enhanced_image_uri is not None else u""
+    fields = [target_url, bg_color, title, image_uri, enhanced_image_uri, locale]
+    fields = [f if isinstance(f, unicode) else f.decode("utf-8") for f in fields]
+    return hashlib.sha1(u"\x1f".join(fields).encode("utf-8")).hexdigest()
+
+
+def _tile_fingerprint_default(context):
+    params = context.current_parameters
+    return tile_fingerprint(
+        params["target_url"],
+        params["bg_color"],
+        params["title"],
+        params["image_uri"],
+        params.get("enhanced_image_uri"),
+        params["locale"])
+
+
 class Tile(db.Model):
     __tablename__ = "tiles"
+    # small, and joined to the stats: a copy on each Redshift node
+    __table_args__ = {"info": {"diststyle": "all"}}
 
     TYPES = {"organic", "sponsored", "affiliate"}
 
@@ -29,6 +65,8 @@ class Tile(db.Model):
 
     locale = db.Column(db.String(14), nullable=False)
 
+    fingerprint = db.Column(db.String(40), nullable=True, index=True, unique=True, default=_tile_fingerprint_default)
+
     created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
 
 
@@ -43,6 +81,9 @@ class UniqueCountsDaily(db.Model):
     locale = db.Column(db.String(14), nullable=False, default="en-US")
     country_code = db.Column(db.String(5), nullable=False, default="US")
 
+    # the HLL sketch packed by splice.hll.pack. Sketches not packed have their registers in unique_hlls
+    sketch = db.Column(db.String(65535), nullable=True)
+
 
 unique_hlls = db.Table(
     'unique_hlls',
@@ -52,6 +93,19 @@ unique_hlls = db.Table(
 )
 
 
+def _dimension(name):
+    return db.Table(
+        name,
+        db.Column('id', db.Integer(), autoincrement=True, primary_key=True, info={"identity": [1, 1]}),
+        db.Column('name', db.String(64), nullable=False, unique=True),
+        info={"diststyle": "all"},
+    )
+
+
+# names of the client os, browser, version and device, referred to by id in the daily stats
+dimensions = dict((name, _dimension('dim_{0}'.format(name))) for name in ('os', 'browser', 'version', 'device'))
+
+
 impression_stats_daily = db.Table(
     'impression_stats_daily',
     db.Column('tile_id', db.Integer, db.ForeignKey('tiles.id')),
@@ -66,16 +120,79 @@ impression_stats_daily = db.Table(
     db.Column('enhanced', db.Boolean, nullable=False, server_default="false"),
     db.Column('locale', db.String(14), nullable=False),
     db.Column('country_code', db.String(5), nullable=False),
-    db.Column('os', db.String(64), nullable=False),
-    db.Column('browser', db.String(64), nullable=False),
-    db.Column('version', db.String(64), nullable=False),
-    db.Column('device', db.String(64), nullable=False),
+    db.Column('os_id', db.Integer, db.ForeignKey('dim_os.id'), nullable=False),
+    db.Column('browser_id', db.Integer, db.ForeignKey('dim_browser.id'), nullable=False),
+    db.Column('version_id', db.Integer, db.ForeignKey('dim_version.id'), nullable=False),
+    db.Column('device_id', db.Integer, db.ForeignKey('dim_device.id'), nullable=False),
     db.Column('month', db.Integer, nullable=False),
     db.Column('week', db.Integer, nullable=False),
     db.Column('year', db.Integer, nullable=False),
+    db.Index('ix_impression_stats_daily_tile_id_date', 'tile_id', 'date'),
+    db.Index('ix_impression_stats_daily_position_date', 'position', 'date'),
+    # Redshift layout, see splice.redshift: reports select a range of dates, and join tiles by id
+    info={
+        "sortkey": ("date", "tile_id"),
+        "distkey": "tile_id",
+        "encode": {
+            "impressions": "mostly16",
+            "clicks": "mostly8",
+            "pinned": "mostly8",
+            "blocked": "mostly8",
+            "sponsored_link": "mostly8",
+            "sponsored": "mostly8",
+            "position": "bytedict",
+            "enhanced": "runlength",
+            "locale": "bytedict",
+            "country_code": "bytedict",
+            "os_id": "bytedict",
+            "browser_id": "bytedict",
+            "version_id": "bytedict",
+            "device_id": "bytedict",
+            "month": "delta",
+            "week": "delta",
+            "year": "delta",
+        },
+    },
 )
 
 
+def _impression_rollup(name, period):
+    return db.Table(
+        name,
+        # the earliest date with stats in the period, to select periods by date
+        db.Column('date', db.Date, nullable=False),
+        db.Column('year', db.Integer, nullable=False),
+        db.Column(period, db.Integer, nullable=False),
+        db.Column('tile_id', db.Integer, db.ForeignKey('tiles.id')),
+        db.Column('position', db.Integer, nullable=False, server_default="0"),
+        db.Column('country_code', db.String(5), nullable=False),
+        db.Column('locale', db.String(14), nullable=False),
+        db.Column('impressions', db.Integer, nullable=False, server_default="0"),
+        db.Column('clicks', db.Integer, nullable=False, server_default="0"),
+        db.Column('pinned', db.Integer, nullable=False, server_default="0"),
+        db.Column('blocked', db.Integer, nullable=False, server_default="0"),
+        db.Column('sponsored_link', db.Integer, nullable=False, server_default="0"),
+        db.Column('sponsored', db.Integer, nullable=False, server_default="0"),
+        info={
+            "sortkey": ("date", "tile_id"),
+            "distkey": "tile_id",
+            "encode": {
+                "year": "delta",
+                period: "delta",
+                "position": "bytedict",
+                "country_code": "bytedict",
+                "locale": "bytedict",
+            },
+        },
+    )
+
+
+# impression_stats_daily summed per tile, position, country and locale, by week and by month
+impression_stats_weekly = _impression_rollup('impression_stats_weekly', 'week')
+impression_stats_monthly = _impression_rollup('impression_stats_monthly', 'month')
+impression_rollups = {'week': impression_stats_weekly, 'month': impression_stats_monthly}
+
+
 newtab_stats_daily = db.Table(
     'newtab_stats_daily',
     db.Column('date', db.Date, nullable=False),
@@ -85,8 +202,22 @@ newtab_stats_daily = db.Table(
     db.Column('year', db.Integer, nullable=False),
     db.Column('locale', db.String(14), nullable=False),
     db.Column('country_code', db.String(5), nullable=False),
-    db.Column('os', db.String(64), nullable=False),
-    db.Column('browser', db.String(64), nullable=False),
-    db.Column('version', db.String(64), nullable=False),
-    db.Column('device', db.String(64), nullable=False),
+    db.Column('os_id', db.Integer, db.ForeignKey('dim_os.id'), nullable=False),
+    db.Column('browser_id', db.Integer, db.ForeignKey('dim_browser.id'), nullable=False),
+    db.Column('version_id', db.Integer, db.ForeignKey('dim_version.id'), nullable=False),
+    db.Column('device_id', db.Integer, db.ForeignKey('dim_device.id'), nullable=False),
+    info={
+        "sortkey": ("date",),
+        "encode": {
+            "month": "delta",
+            "week": "delta",
+            "year": "delta",
+            "locale": "bytedict",
+            "country_code": "bytedict",
+            "os_id": "bytedict",
+            "browser_id": "bytedict",
+            "version_id": "bytedict",
+            "device_id": "bytedict",
+        },
+    },
 )
@@ -0,0 +1,124 @@
+"""
+Monthly range partitions of the daily stats on Postgres.
+
+impression_stats_daily is partitioned by range of date, a partition per month named after it,
+e.g. impression_stats_daily_2014_09. Partitions are created ahead of the months loaded, and
+those older than the retention are detached, then dropped. Partitions only detached are renamed
+with a "_detached" suffix, numbered should the month have been detached before, leaving their
+name to a partition created for the month again. Redshift has no partitions
+"""
+import re
+from datetime import date
+from sqlalchemy.sql import text
+from splice.models import impression_stats_daily
+
+PARTITIONED_TABLES = (impression_stats_daily,)
+
+
+def supports_partitions(conn):
+    """
+    Whether the connection is to Postgres 11 or later, which indexes partitioned tables.
+    Redshift identifies itself as Postgres 8.0
+    """
+    return conn.dialect.name == "postgresql" and conn.dialect.server_version_info >= (11,)
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, count):
+    months = month.year * 12 + month.month - 1 + count
+    return date(months / 12, months % 12 + 1, 1)
+
+
+def months(start, end):
+    """
+    First days of the months from the month of start through the month of end
+    """
+    month = month_start(start)
+    while month <= end:
+        yield month
+        month = add_months(month, 1)
+
+
+def partition_name(table, month):
+    return "{0}_{1:04d}_{2:02d}".format(table.name, month.year, month.month)
+
+
+def detached_name(conn, name):
+    """
+    Name for a detached partition not taken by a table: <name>_detached, or <name>_detached_<n>
+    after the first time
+    """
+    taken = set(row[0] for row in conn.execute(text(
+        "SELECT relname FROM pg_class WHERE relname LIKE :pattern"), pattern="{0}_detached%".format(name)))
+    detached = "{0}_detached".format(name)
+    n = 1
+    while detached in taken:
+        n += 1
+        detached = "{0}_detached_{1}".format(name, n)
+    return detached
+
+
+def partition_month(table, name):
+    """
+    Month of a partition, from its name, or None if it is not named after one
+    """
+    match = re.match(r"^{0}_(\d{{4}})_(\d{{2}})$".format(re.escape(table.name)), name)
+    if match is None:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def partition_ddl(table, month):
+    return "CREATE TABLE {0} PARTITION OF {1} FOR VALUES FROM ('{2}') TO ('{3}')".format(
+        partition_name(table, month), table.name, month.isoformat(), add_months(month, 1).isoformat())
+
+
+def existing_partitions(conn, table):
+    """
+    Names of the partitions of a table
+    """
+    return set(row[0] for row in conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :name"), name=table.name))
+
+
+def create_partitions(conn, table, start, end):
+    """
+    Create the partitions missing for the months from start through end.
+    Return the names of the partitions created
+    """
+    existing = existing_partitions(conn, table)
+    created = []
+    for month in months(start, end):
+        name = partition_name(table, month)
+        if name not in existing:
+            conn.execute(partition_ddl(table, month))
+            created.append(name)
+    return created
+
+
+def drop_partitions(conn, table, before, detach_only=False):
+    """
+    Detach, and unless detach_only drop, the partitions of months ending before a day.
+    Partitions only detached are renamed, see detached_name.
+    Return the names of the partitions removed, with the names detached partitions are renamed to
+    """
+    removed = []
+    for name in sorted(existing_partitions(conn, table)):
+        month = partition_month(table, name)
+        if month is None or add_months(month, 1) > before:
+            continue
+        conn.execute("ALTER TABLE {0} DETACH PARTITION {1}".format(table.name, name))
+        renamed = None
+        if detach_only:
+            renamed = detached_name(conn, name)
+            conn.execute("ALTER TABLE {0} RENAME TO {1}".format(name, renamed))
+        else:
+            conn.execute("DROP TABLE {0}".format(name))
+        removed.append((name, renamed))
+    return removed
@@ -1,9 +1,77 @@
-from datetime import datetime
+import json
+import inspect
+import hashlib
+import threading
+import functools
+from datetime import date, datetime, timedelta
 from sqlalchemy.sql import text
-from splice.models import Distribution, Tile, impression_stats_daily, newtab_stats_daily
-from sqlalchemy.sql import select, func, and_
+from splice.models import Distribution, DeployedArtifact, Tile, impression_stats_daily, impression_rollups, \
+    newtab_stats_daily, tile_fingerprint, UniqueCountsDaily, unique_hlls, dimensions
+from sqlalchemy.sql import select, func, and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.types import Date
 from sqlalchemy.sql.expression import asc
 from sqlalchemy.orm.session import sessionmaker
+from werkzeug.contrib.cache import NullCache
+
+
+class TileFingerprints(object):
+    """
+    In-process map of tile fingerprint to id, so that known tiles are resolved without a query.
+    Tiles are never updated nor deleted, so an entry stays valid once added; a miss falls
+    back to the database, which covers tiles inserted by other processes
+    """
+
+    def __init__(self):
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def warm(self, conn=None):
+        """
+        Load the fingerprints of all tiles in the database
+        """
+        from splice.environment import Environment
+
+        if conn is None:
+            conn = Environment.instance().db.engine
+
+        stmt = (
+            select([Tile.id, Tile.fingerprint])
+            .where(Tile.fingerprint != None)  # noqa
+            .order_by(asc(Tile.id))
+        )
+        ids = {}
+        for tile_id, fingerprint in conn.execute(stmt):
+            ids.setdefault(fingerprint, tile_id)
+
+        with self._lock:
+            self._ids = ids
+
+    def lookup(self, fingerprints):
+        """
+        Return a mapping of fingerprint to id for the fingerprints known
+        """
+        if not fingerprints:
+            return {}
+        if self._ids is None:
+            self.warm()
+        ids = self._ids
+        return dict((fp, ids[fp]) for fp in fingerprints if fp in ids)
+
+    def update(self, mapping):
+        """
+        Add fingerprints of committed tiles
+        """
+        with self._lock:
+            if self._ids is not None:
+                for fingerprint, tile_id in mapping.iteritems():
+                    self._ids.setdefault(fingerprint, tile_id)
+
+    def clear(self):
+        with self._lock:
+            self._ids = None
+
+tile_fingerprints = TileFingerprints()
 
 
 def tile_exists(target_url, bg_color, title, type, image_uri, enhanced_image_uri, locale, conn=None, *args, **kwargs):
@@ -13,6 +81,11 @@ def tile_exists(target_url, bg_color, title, type, image_uri, enhanced_image_uri
     from splice.environment import Environment
     env = Environment.instance()
 
+    fingerprint = tile_fingerprint(target_url, bg_color, title, image_uri, enhanced_image_uri, locale)
+    known = tile_fingerprints.lookup([fingerprint])
+    if known:
+        return known[fingerprint]
+
     if conn is not None:
         sm = sessionmaker(bind=conn)
         session = sm()
@@ -24,41 +97,293 @@ def tile_exists(target_url, bg_color, title, type, image_uri, enhanced_image_uri
     results = (
         session
         .query(Tile.id)
-        .filter(Tile.target_url == target_url)
-        .filter(Tile.bg_color == bg_color)
-        .filter(Tile.title == title)
-        .filter(Tile.image_uri == image_uri)
-        .filter(Tile.enhanced_image_uri == enhanced_image_uri)
-        .filter(Tile.locale == locale)
+        .filter(Tile.fingerprint == fingerprint)
         .order_by(asc(Tile.id))
         .first()
     )
 
+    if results is None:
+        # tiles written without a fingerprint are matched on their columns
+        results = (
+            session
+            .query(Tile.id)
+            .filter(Tile.fingerprint == None)  # noqa
+            .filter(Tile.target_url == target_url)
+            .filter(Tile.bg_color == bg_color)
+            .filter(Tile.title == title)
+            .filter(Tile.image_uri == image_uri)
+            .filter(Tile.enhanced_image_uri == enhanced_image_uri)
+            .filter(Tile.locale == locale)
+            .order_by(asc(Tile.id))
+            .first()
+        )
+
     if results:
         return results[0]
 
     return results
 
 
-def _parse_date(start_date, date_window):
-    dt = datetime.strptime(start_date, "%Y-%m-%d")
-    year = dt.year
-    if date_window == 'month':
-        window_param = dt.month
-    elif date_window == 'date':
-        window_param = dt.date()
-    else:
-        window_param = dt.isocalendar()[1]
-    return year, window_param
+def tile_ids(tiles, conn=None, chunk_size=500, *args, **kwargs):
+    """
+    Return a mapping of fingerprint to id for the tiles provided that already exist.
+    The lookup is set-based: it runs one query per chunk of fingerprints rather than one per tile
+    """
+    from splice.environment import Environment
+    env = Environment.instance()
+
+    if conn is None:
+        conn = env.db.engine
+
+    wanted = set(tile_fingerprint(**t) for t in tiles)
+    fingerprints = sorted(wanted)
+
+    found = {}
+    for i in xrange(0, len(fingerprints), chunk_size):
+        stmt = (
+            select([Tile.id, Tile.fingerprint])
+            .where(Tile.fingerprint.in_(fingerprints[i:i + chunk_size]))
+            .order_by(asc(Tile.id))
+        )
+        for tile_id, fingerprint in conn.execute(stmt):
+            # keep the lowest id, should duplicates exist
+            found.setdefault(fingerprint, tile_id)
+
+    # tiles written without a fingerprint are matched on their columns, fetched by image
+    image_uris = sorted(set(t["image_uri"] for t in tiles if tile_fingerprint(**t) not in found))
+    for i in xrange(0, len(image_uris), chunk_size):
+        stmt = (
+            select([Tile.id, Tile.target_url, Tile.bg_color, Tile.title, Tile.image_uri,
+                    Tile.enhanced_image_uri, Tile.locale])
+            .where(and_(Tile.fingerprint == None, Tile.image_uri.in_(image_uris[i:i + chunk_size])))  # noqa
+            .order_by(asc(Tile.id))
+        )
+        for row in conn.execute(stmt):
+            fingerprint = tile_fingerprint(*row[1:])
+            if fingerprint in wanted and fingerprint not in found:
+                found[fingerprint] = row[0]
+
+    return found
+
+
+class DimensionIds(object):
+    """
+    In-process map of the names of each dimension to their id. Like tile fingerprints, names
+    are never updated nor deleted; entries are only added once their transaction is committed
+    """
+
+    def __init__(self):
+        self._ids = dict((dimension, {}) for dimension in dimensions)
+        self._lock = threading.Lock()
+
+    def lookup(self, dimension, names):
+        ids = self._ids[dimension]
+        return dict((name, ids[name]) for name in names if name in ids)
+
+    def update(self, dimension, mapping):
+        with self._lock:
+            self._ids[dimension].update(mapping)
+
+    def clear(self):
+        with self._lock:
+            for ids in self._ids.itervalues():
+                ids.clear()
+
+dimension_ids = DimensionIds()
+
+
+def dimension_name(value):
+    """
+    Name of a dimension as stored, so that values of other types, like 34, are the same as their text
+    """
+    return value.decode("utf-8") if isinstance(value, str) else unicode(value)
+
+
+def encode_dimension(conn, dimension, names, chunk_size=500):
+    """
+    Return a mapping of names of a dimension, see dimension_name, to their id, adding the names not
+    in its table. The caller adds the mapping to dimension_ids once the connection's transaction is
+    committed, and serializes concurrent writers, as Redshift doesn't enforce the uniqueness of names
+    """
+    table = dimensions[dimension]
+    names = set(dimension_name(name) for name in names)
+    found = dimension_ids.lookup(dimension, names)
+    missing = sorted(set(names) - set(found))
+
+    for i in xrange(0, len(missing), chunk_size):
+        chunk = missing[i:i + chunk_size]
+        known = dict((name, dim_id) for dim_id, name in
+                     conn.execute(select([table.c.id, table.c.name]).where(table.c.name.in_(chunk))))
+        new = [name for name in chunk if name not in known]
+        if new:
+            conn.execute(table.insert(), [dict(name=name) for name in new])
+            known.update((name, dim_id) for dim_id, name in
+                         conn.execute(select([table.c.id, table.c.name]).where(table.c.name.in_(new))))
+        found.update(known)
+    return found
+
+
+class InvalidArgument(ValueError):
+    """
+    A report argument given by the client is invalid
+    """
+    pass
+
+
+def _parse_day(value, name):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        raise InvalidArgument("Invalid {0}".format(name))
 
 
-def _slot_query(connection, start_date, date_window, position, country_code, locale):
-    year, window_param = _parse_date(start_date, date_window)
-    imps = impression_stats_daily
+def _period_end(day, date_window):
+    """
+    Last day of the period containing a day
+    """
+    if date_window == 'week':
+        return day + timedelta(days=6 - day.weekday())
+    elif date_window == 'month':
+        next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return next_month - timedelta(days=1)
+    return day
+
+
+def cached_report(query):
+    """
+    Cache the results of a report query, keyed on its arguments. Results ending with a period closed
+    for a while are kept longer than those including recent periods, which may still be loaded
+    """
+    @functools.wraps(query)
+    def wrapper(connection, *args, **kwargs):
+        from splice.environment import Environment
+
+        env = Environment.instance()
+        if isinstance(env.report_cache, NullCache):
+            return query(connection, *args, **kwargs)
+
+        config = env.config
+        params = inspect.getcallargs(query, connection, *args, **kwargs)
+        del params['connection']
+        key = "report:{0}:{1}".format(
+            query.__name__, hashlib.sha1(json.dumps(params, sort_keys=True, default=str)).hexdigest())
+
+        cached = env.report_cache.get(key)
+        if cached is not None:
+            return cached
+
+        keys, result = query(connection, *args, **kwargs)
+
+        timeout = config.REPORT_CACHE_TTL
+        end_date = params.get('end_date')
+        if end_date is not None:
+            closed_on = _period_end(_parse_day(end_date, "end_date"), params['period'])
+            if (datetime.utcnow().date() - closed_on).days > config.REPORT_CACHE_CLOSED_AFTER:
+                timeout = config.REPORT_CACHE_CLOSED_TTL
+
+        def stream():
+            # rows are streamed as they are read, and cached once all are,
+            # unless there are too many of them
+            rows = []
+            for row in result:
+                row = tuple(row)
+                if rows is not None:
+                    rows.append(row)
+                    if len(rows) > config.REPORT_CACHE_MAX_ROWS:
+                        rows = None
+                yield row
+            if rows is not None:
+                env.report_cache.set(key, (keys, rows), timeout=timeout)
+
+        return keys, stream()
+
+    return wrapper
+
+
+def _period_start(day, date_window):
+    """
+    First day of the period containing a day
+    """
+    if date_window == 'week':
+        return day - timedelta(days=day.weekday())
+    elif date_window == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _date_range(start_date, end_date, date_window):
+    """
+    Dates of the periods from start_date, through end_date if given, for a predicate on the date
+    column, which is the sort key. Whole periods are included
+    """
+    start = _period_start(_parse_day(start_date, "start_date"), date_window)
+    end = None
+    if end_date is not None:
+        end = _period_end(_parse_day(end_date, "end_date"), date_window)
+    return start, end
+
+
+def _date_predicates(table, start_date, end_date, date_window):
+    start, end = _date_range(start_date, end_date, date_window)
+    where_elements = [table.c.date >= start]
+    if end is not None:
+        where_elements.append(table.c.date <= end)
+    return where_elements
+
+
+def _column_value(column, value):
+    if isinstance(column.type, Date) and not isinstance(value, date):
+        return _parse_day(value, "cursor")
+    return value
+
+
+def _page(stmt, order, limit=None, after=None):
+    """
+    Restrict a statement to the rows following the row `after`, a mapping of key names to values,
+    and to limit rows. The statement is ordered on the keys named in order
+    """
+    if after is not None:
+        try:
+            columns = [column for _, column in order]
+            values = [_column_value(column, after[name]) for name, column in order]
+        except (KeyError, TypeError):
+            raise InvalidArgument("Invalid cursor")
+        # (c1, c2, ...) > (v1, v2, ...), spelled out as c1 > v1 OR (c1 = v1 AND c2 > v2) OR ...
+        clauses = []
+        for i, column in enumerate(columns):
+            clauses.append(and_(*([c == v for c, v in zip(columns[:i], values[:i])] + [column > values[i]])))
+        stmt = stmt.where(or_(*clauses))
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def _matches(column, value):
+    """
+    Predicate for a value, or any of a list of values
+    """
+    if isinstance(value, (list, tuple)):
+        return column.in_(value)
+    return column == value
+
+
+def _impressions(date_window):
+    """
+    Table to aggregate impressions from: the rollup for the window, when rollups are enabled
+    """
+    from splice.environment import Environment
+
+    if Environment.instance().config.IMPRESSION_ROLLUPS_ENABLED:
+        return impression_rollups.get(date_window, impression_stats_daily)
+    return impression_stats_daily
+
+
+def _slot_query(connection, start_date, date_window, position, country_code, locale, end_date=None, limit=None, after=None):
+    imps = _impressions(date_window)
     window_func_table = imps.c.get(date_window)
 
-    # the where clause is an ANDed list of country, monthly|weekly, and year conditions
-    where_elements = [imps.c.year >= year, window_func_table >= window_param, imps.c.position == position]
+    # the where clause is an ANDed list of date range, position, country and locale conditions
+    where_elements = _date_predicates(imps, start_date, end_date, date_window) + [_matches(imps.c.position, position)]
     if country_code is not None:
         where_elements.append(imps.c.country_code == country_code)
     if locale is not None:
@@ -66,6 +391,14 @@ def _slot_query(connection, start_date, date_window, position, country_code, loc
 
     where_clause = and_(*where_elements)
 
+    # the ordering keys are unique to each row, to page through rows
+    order = [
+        ('year', imps.c.year),
+        (date_window, window_func_table),
+        ('position', imps.c.position),
+        ('country_code', imps.c.country_code),
+        ('locale', imps.c.locale),
+    ]
     stmt = select(
         [
             imps.c.year,
@@ -82,21 +415,20 @@ def _slot_query(connection, start_date, date_window, position, country_code, loc
         ]) \
         .where(where_clause) \
         .group_by(imps.c.year, window_func_table, imps.c.position, imps.c.country_code, imps.c.locale) \
-        .order_by(imps.c.year, window_func_table, imps.c.position, imps.c.country_code, imps.c.locale)
+        .order_by(*[column for _, column in order])
+    stmt = _page(stmt, order, limit, after)
     return ('year', date_window, 'position', 'country_code', 'locale',
             'impressions', 'clicks', 'pinned', 'blocked', 'sponsored', 'sponsored_link'), \
         connection.execute(stmt)
 
 
-def _tile_query(connection, start_date, date_window, tile_id, country_code, locale):
-    year, window_param = _parse_date(start_date, date_window)
-
-    imps = impression_stats_daily
+def _tile_query(connection, start_date, date_window, tile_id, country_code, locale, end_date=None, limit=None, after=None):
+    imps = _impressions(date_window)
     window_func_table = imps.c.get(date_window)
 
-    # the where clause is an ANDed list of country, monthly|weekly, and year conditions
-    where_elements = [imps.c.year >= year, window_func_table >= window_param,
-                      imps.c.tile_id == tile_id, imps.c.tile_id == Tile.id]
+    # the where clause is an ANDed list of date range, tile, country and locale conditions
+    where_elements = _date_predicates(imps, start_date, end_date, date_window) + \
+        [_matches(imps.c.tile_id, tile_id), imps.c.tile_id == Tile.id]
     if country_code is not None:
         where_elements.append(imps.c.country_code == country_code)
     if locale is not None:
@@ -104,6 +436,14 @@ def _tile_query(connection, start_date, date_window, tile_id, country_code, loca
 
     where_clause = and_(*where_elements)
 
+    # the ordering keys are unique to each row, to page through rows
+    order = [
+        ('year', imps.c.year),
+        (date_window, window_func_table),
+        ('tile_id', imps.c.tile_id),
+        ('country_code', imps.c.country_code),
+        ('locale', imps.c.locale),
+    ]
     stmt = select(
         [
             imps.c.year,
@@ -121,21 +461,20 @@ def _tile_query(connection, start_date, date_window, tile_id, country_code, loca
         ]) \
         .where(where_clause) \
         .group_by(imps.c.year, window_func_table, imps.c.tile_id, Tile.title, imps.c.country_code, imps.c.locale) \
-        .order_by(imps.c.year, window_func_table, imps.c.tile_id, imps.c.country_code, imps.c.locale)
+        .order_by(*[column for _, column in order])
+    stmt = _page(stmt, order, limit, after)
 
     return ('year', date_window, 'tile_id', 'tile_title', 'country_code', 'locale',
             'impressions', 'clicks', 'pinned', 'blocked', 'sponsored', 'sponsored_link'), \
         connection.execute(stmt)
 
 
-def _newtab_query(connection, start_date, date_window, country_code, locale):
-    year, window_param = _parse_date(start_date, date_window)
-
+def _newtab_query(connection, start_date, date_window, country_code, locale, end_date=None, limit=None, after=None):
     imps = newtab_stats_daily
     window_func_table = imps.c.get(date_window)
 
-    # the where clause is an ANDed list of country, monthly|weekly, and year conditions
-    where_elements = [imps.c.year >= year, window_func_table >= window_param]
+    # the where clause is an ANDed list of date range, country and locale conditions
+    where_elements = _date_predicates(imps, start_date, end_date, date_window)
     if country_code is not None:
         where_elements.append(imps.c.country_code == country_code)
     if locale is not None:
@@ -143,6 +482,13 @@ def _newtab_query(connection, start_date, date_window, country_code, locale):
 
     where_clause = and_(*where_elements)
 
+    # the ordering keys are unique to each row, to page through rows
+    order = [
+        ('year', imps.c.year),
+        (date_window, window_func_table),
+        ('country_code', imps.c.country_code),
+        ('locale', imps.c.locale),
+    ]
     stmt = select(
         [
             imps.c.year,
@@ -153,18 +499,17 @@ def _newtab_query(connection, start_date, date_window, country_code, locale):
         ]) \
         .where(where_clause) \
         .group_by(imps.c.year, window_func_table, imps.c.country_code, imps.c.locale) \
-        .order_by(imps.c.year, window_func_table, imps.c.country_code, imps.c.locale)
+        .order_by(*[column for _, column in order])
+    stmt = _page(stmt, order, limit, after)
     return ('year', date_window, 'country_code', 'locale', 'newtabs'), connection.execute(stmt)
 
 
-def _tile_summary_query(connection, start_date, date_window, country_code, locale):
-    year, window_param = _parse_date(start_date, date_window)
-
-    imps = impression_stats_daily
+def _tile_summary_query(connection, start_date, date_window, country_code, locale, end_date=None, limit=None, after=None):
+    imps = _impressions(date_window)
     window_func_table = imps.c.get(date_window)
 
-    # the where clause is an ANDed list of country, monthly|weekly, and year conditions
-    where_elements = [imps.c.year >= year, window_func_table >= window_param, imps.c.tile_id == Tile.id]
+    # the where clause is an ANDed list of date range, country and locale conditions
+    where_elements = _date_predicates(imps, start_date, end_date, date_window) + [imps.c.tile_id == Tile.id]
     if country_code is not None:
         where_elements.append(imps.c.country_code == country_code)
     if locale is not None:
@@ -172,6 +517,12 @@ def _tile_summary_query(connection, start_date, date_window, country_code, local
 
     where_clause = and_(*where_elements)
 
+    # the ordering keys are unique to each row, to page through rows
+    order = [
+        ('year', imps.c.year),
+        (date_window, window_func_table),
+        ('tile_id', imps.c.tile_id),
+    ]
     stmt = select(
         [
             imps.c.year,
@@ -187,21 +538,20 @@ def _tile_summary_query(connection, start_date, date_window, country_code, local
         ]) \
         .where(where_clause) \
         .group_by(imps.c.year, window_func_table, imps.c.tile_id, Tile.title) \
-        .order_by(imps.c.year, window_func_table, imps.c.tile_id)
+        .order_by(*[column for _, column in order])
+    stmt = _page(stmt, order, limit, after)
 
     return ('year', date_window, 'tile_id', 'tile_title',
             'impressions', 'clicks', 'pinned', 'blocked', 'sponsored', 'sponsored_link'), \
         connection.execute(stmt)
 
 
-def _slot_summary_query(connection, start_date, date_window, country_code, locale):
-    year, window_param = _parse_date(start_date, date_window)
-
-    imps = impression_stats_daily
+def _slot_summary_query(connection, start_date, date_window, country_code, locale, end_date=None, limit=None, after=None):
+    imps = _impressions(date_window)
     window_func_table = imps.c.get(date_window)
 
-    # the where clause is an ANDed list of country, monthly|weekly, and year conditions
-    where_elements = [imps.c.year >= year, window_func_table >= window_param]
+    # the where clause is an ANDed list of date range, country and locale conditions
+    where_elements = _date_predicates(imps, start_date, end_date, date_window)
     if country_code is not None:
         where_elements.append(imps.c.country_code == country_code)
     if locale is not None:
@@ -209,6 +559,12 @@ def _slot_summary_query(connection, start_date, date_window, country_code, local
 
     where_clause = and_(*where_elements)
 
+    # the ordering keys are unique to each row, to page through rows
+    order = [
+        ('year', imps.c.year),
+        (date_window, window_func_table),
+        ('position', imps.c.position),
+    ]
     stmt = select(
         [
             imps.c.year,
@@ -223,66 +579,313 @@ def _slot_summary_query(connection, start_date, date_window, country_code, local
         ]) \
         .where(where_clause) \
         .group_by(imps.c.year, window_func_table, imps.c.position) \
-        .order_by(imps.c.year, window_func_table, imps.c.position)
+        .order_by(*[column for _, column in order])
+    stmt = _page(stmt, order, limit, after)
     return ('year', date_window, 'position',
             'impressions', 'clicks', 'pinned', 'blocked', 'sponsored', 'sponsored_link'), \
         connection.execute(stmt)
 
 
-def tile_stats(connection, start_date, period='week', tile_id=None, country_code=None, locale=None):
-    """period = 'week' | 'month' | 'date'"""
-    return _tile_query(connection, start_date, period, tile_id, country_code, locale)
+@cached_report
+def tile_stats(connection, start_date, period='week', tile_id=None, country_code=None, locale=None, end_date=None, limit=None, after=None):
+    """period = 'week' | 'month' | 'date', tile_id = id | list of ids"""
+    return _tile_query(connection, start_date, period, tile_id, country_code, locale, end_date, limit, after)
 
 
-def tile_summary(connection, start_date, period='week', country_code=None, locale=None):
-    return _tile_summary_query(connection, start_date, period, country_code, locale)
+@cached_report
+def tile_summary(connection, start_date, period='week', country_code=None, locale=None, end_date=None, limit=None, after=None):
+    return _tile_summary_query(connection, start_date, period, country_code, locale, end_date, limit, after)
 
 
-def newtab_stats(connection, start_date, period='week', country_code=None, locale=None):
+@cached_report
+def newtab_stats(connection, start_date, period='week', country_code=None, locale=None, end_date=None, limit=None, after=None):
     """period = 'week' | 'month' | 'date'"""
-    return _newtab_query(connection, start_date, period, country_code, locale)
+    return _newtab_query(connection, start_date, period, country_code, locale, end_date, limit, after)
 
 
-def slot_stats(connection, start_date, period='week', position=None, country_code=None, locale=None):
-    return _slot_query(connection, start_date, period, position, country_code, locale)
+@cached_report
+def slot_stats(connection, start_date, period='week', position=None, country_code=None, locale=None, end_date=None, limit=None, after=None):
+    """period = 'week' | 'month' | 'date', position = position | list of positions"""
+    return _slot_query(connection, start_date, period, position, country_code, locale, end_date, limit, after)
 
 
-def slot_summary(connection, start_date, period='week', country_code=None, locale=None):
-    return _slot_summary_query(connection, start_date, period, country_code, locale)
+@cached_report
+def slot_summary(connection, start_date, period='week', country_code=None, locale=None, end_date=None, limit=None, after=None):
+    return _slot_summary_query(connection, start_date, period, country_code, locale, end_date, limit, after)
 
 
-def insert_tile(target_url, bg_color, title, type, image_uri, enhanced_image_uri, locale, conn=None, *args, **kwargs):
+def _period_key(day, date_window):
+    """
+    (year, period) of a day, as in the year and week or month columns of the stats tables:
+    the calendar year, with the ISO week
+    """
+    if date_window == 'week':
+        return day.year, day.isocalendar()[1]
+    elif date_window == 'month':
+        return day.year, day.month
+    return day.year, day
+
+
+@cached_report
+def unique_stats(connection, start_date, period='week', tile_id=None, country_code=None, locale=None, end_date=None, chunk_size=100000):
+    """
+    Estimated unique impressions and clicks of tiles per period, merged from the daily sketches.
+    tile_id = id | list of ids
+    """
+    from splice.environment import Environment
+    import numpy as np
+    from splice import hll
+
+    daily = UniqueCountsDaily.__table__
+    where_elements = _date_predicates(daily, start_date, end_date, period)
+    if tile_id is not None:
+        where_elements.append(_matches(daily.c.tile_id, tile_id))
+    if country_code is not None:
+        where_elements.append(daily.c.country_code == country_code)
+    if locale is not None:
+        where_elements.append(daily.c.locale == locale)
+    where_clause = and_(*where_elements)
 
+    precision = Environment.instance().config.HLL_PRECISION
+
+    # each period and tile has a sketch of impressions, followed by one of clicks.
+    # Packed sketches are merged as they are read, the others from their rows of registers
+    groups = {}
+    packed = []
+    sketch_ids = []
+    sketch_rows = []
+    stmt = select([daily.c.id, daily.c.date, daily.c.tile_id, daily.c.impression, daily.c.sketch]).where(where_clause)
+    for sketch_id, day, tile, impression, sketch in connection.execute(stmt):
+        group = groups.setdefault(_period_key(day, period) + (tile,), len(groups))
+        row = 2 * group + (0 if impression else 1)
+        if sketch is not None:
+            packed.append((row, sketch))
+        else:
+            sketch_ids.append(sketch_id)
+            sketch_rows.append(row)
+
+    sketches = hll.empty(precision, 2 * len(groups))
+    for row, sketch in packed:
+        np.maximum(sketches[row], hll.unpack(sketch, precision), out=sketches[row])
+
+    order = np.argsort(sketch_ids)
+    sketch_ids = np.asarray(sketch_ids, dtype=np.int64)[order]
+    sketch_rows = np.asarray(sketch_rows, dtype=np.intp)[order]
+
+    if len(sketch_ids):
+        stmt = (
+            select([unique_hlls.c.unique_counts_daily_id, unique_hlls.c.index, unique_hlls.c.value])
+            .where(and_(unique_hlls.c.unique_counts_daily_id == daily.c.id, daily.c.sketch == None, where_clause))  # noqa
+        )
+        result = connection.execute(stmt)
+        while True:
+            chunk = np.array(result.fetchmany(chunk_size), dtype=np.int64)
+            if not len(chunk):
+                break
+            # registers of sketches added since they were listed are left out
+            found = np.searchsorted(sketch_ids, chunk[:, 0])
+            listed = found < len(sketch_ids)
+            listed[listed] = sketch_ids[found[listed]] == chunk[listed, 0]
+            hll.merge_into(sketches, sketch_rows[found[listed]], chunk[listed, 1], chunk[listed, 2])
+
+    estimates = hll.estimate(sketches).reshape(-1, 2) if groups else []
+    rows = sorted(key + tuple(int(e) for e in estimates[group]) for key, group in groups.iteritems())
+    return ('year', period, 'tile_id', 'unique_impressions', 'unique_clicks'), rows
+
+
+def pack_sketches(batch_size=1000, *args, **kwargs):
+    """
+    Move the registers of unique_hlls into the packed sketch column of unique_counts_daily,
+    a batch of sketches per transaction. Return the number of sketches packed
+    """
     from splice.environment import Environment
+    from sqlalchemy.sql import bindparam
+    import numpy as np
+    from splice import hll
+
     env = Environment.instance()
+    precision = env.config.HLL_PRECISION
+    daily = UniqueCountsDaily.__table__
+
+    packed = 0
+    while True:
+        conn = env.db.engine.connect()
+        trans = conn.begin()
+        try:
+            ids = [row[0] for row in conn.execute(
+                select([daily.c.id]).where(daily.c.sketch == None).order_by(daily.c.id).limit(batch_size))]  # noqa
+            if not ids:
+                trans.commit()
+                return packed
+
+            sketches = hll.empty(precision, len(ids))
+            registers = np.array(conn.execute(
+                select([unique_hlls.c.unique_counts_daily_id, unique_hlls.c.index, unique_hlls.c.value])
+                .where(unique_hlls.c.unique_counts_daily_id.in_(ids))
+            ).fetchall(), dtype=np.int64).reshape(-1, 3)
+            hll.merge_into(sketches, np.searchsorted(ids, registers[:, 0]), registers[:, 1], registers[:, 2])
+
+            conn.execute(
+                daily.update().where(daily.c.id == bindparam("sketch_id")).values(sketch=bindparam("packed")),
+                [dict(sketch_id=sketch_id, packed=hll.pack(sketch)) for sketch_id, sketch in zip(ids, sketches)]
+            )
+            conn.execute(unique_hlls.delete().where(unique_hlls.c.unique_counts_daily_id.in_(ids)))
+            trans.commit()
+            packed += len(ids)
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+def _period_dates(year, period, value):
+    """
+    First and last dates of the rows of a (year, period), a range per month or ISO week, bounding
+    the date column so that only the partitions of those dates are scanned. Weeks are numbered in
+    the calendar year of their rows: week 1 may have rows in early January and in late December,
+    the latter of the ISO week 1 of the following year, and the last week rows in early January
+    """
+    if period == 'month':
+        first = date(year, value, 1)
+        return [(first, _period_end(first, 'month'))]
+
+    ranges = []
+    for iso_year in (year - 1, year, year + 1):
+        jan4 = date(iso_year, 1, 4)
+        monday = jan4 + timedelta(days=7 * (value - 1) - jan4.weekday())
+        if monday.isocalendar()[:2] != (iso_year, value):
+            continue
+        first, last = max(monday, date(year, 1, 1)), min(monday + timedelta(days=6), date(year, 12, 31))
+        if first <= last:
+            ranges.append((first, last))
+    return ranges
+
+
+def refresh_rollups(start_date, end_date, conn=None, *args, **kwargs):
+    """
+    Recompute the weekly and monthly impression rollups for the periods having daily stats
+    between two dates. Only those periods are rewritten, so this is run after each daily load.
+    Rows of a week are summed per ISO week, so that those of late December and early January
+    each keep the date of their own week
+    """
+    from splice.environment import Environment
 
     trans = None
     if conn is None:
-        conn = env.db.engine.connect()
+        conn = Environment.instance().db.engine.connect()
         trans = conn.begin()
 
+    daily = impression_stats_daily
+    sums = ['impressions', 'clicks', 'pinned', 'blocked', 'sponsored_link', 'sponsored']
+
     try:
-        conn.execute(
+        refreshed = 0
+        for period, rollup in sorted(impression_rollups.iteritems()):
+            dims = ['year', period, 'tile_id', 'position', 'country_code', 'locale']
+            periods = conn.execute(
+                select([daily.c.year, daily.c[period]])
+                .where(and_(daily.c.date >= start_date, daily.c.date <= end_date))
+                .distinct()
+            ).fetchall()
+
+            for year, value in periods:
+                conn.execute(rollup.delete().where(and_(rollup.c.year == year, rollup.c[period] == value)))
+                for first, last in _period_dates(year, period, value):
+                    stmt = (
+                        select([func.min(daily.c.date)] + [daily.c[c] for c in dims] + [func.sum(daily.c[c]) for c in sums])
+                        .where(and_(daily.c.date >= first, daily.c.date <= last,
+                                    daily.c.year == year, daily.c[period] == value))
+                        .group_by(*[daily.c[c] for c in dims])
+                    )
+                    conn.execute(rollup.insert().from_select(['date'] + dims + sums, stmt))
+            refreshed += len(periods)
 
-            text(
-                "INSERT INTO tiles ("
-                " target_url, bg_color, title, type, image_uri, enhanced_image_uri, locale, created_at"
-                ") "
-                "VALUES ("
-                " :target_url, :bg_color, :title, :type, :image_uri, :enhanced_image_uri, :locale, :created_at"
-                ")"
-            ),
-            target_url=target_url,
-            bg_color=bg_color,
-            title=title,
-            type=type,
-            image_uri=image_uri,
-            enhanced_image_uri=enhanced_image_uri,
-            locale=locale,
-            created_at=datetime.utcnow()
+        if trans is not None:
+            trans.commit()
+        return refreshed
+    except:
+        if trans is not None:
+            trans.rollback()
+        raise
+    finally:
+        if trans is not None:
+            conn.close()
+
+
+def _supports_returning(conn):
+    """
+    Whether inserts can return generated ids. Redshift identifies itself as postgres 8.0,
+    which predates RETURNING, and is excluded by sqlalchemy on connection
+    """
+    return conn.dialect.name == "postgresql" and conn.dialect.implicit_returning
+
+
+def insert_tile(target_url, bg_color, title, type, image_uri, enhanced_image_uri, locale, conn=None, *args, **kwargs):
+    """
+    Insert a tile, returning its id
+    """
+    columns = dict(
+        target_url=target_url,
+        bg_color=bg_color,
+        title=title,
+        type=type,
+        image_uri=image_uri,
+        enhanced_image_uri=enhanced_image_uri,
+        locale=locale,
+    )
+    return insert_tiles([columns], conn=conn)[tile_fingerprint(**columns)]
+
+
+def insert_tiles(tiles, conn=None, chunk_size=500, *args, **kwargs):
+    """
+    Insert tiles in a single batch, returning a mapping of fingerprint to the new id
+    """
+    from splice.environment import Environment
+    env = Environment.instance()
+
+    if not tiles:
+        return {}
+
+    trans = None
+    if conn is None:
+        conn = env.db.engine.connect()
+        trans = conn.begin()
+
+    created_at = datetime.utcnow()
+    rows = [
+        dict(
+            target_url=t["target_url"],
+            bg_color=t["bg_color"],
+            title=t["title"],
+            type=t["type"],
+            image_uri=t["image_uri"],
+            enhanced_image_uri=t["enhanced_image_uri"],
+            locale=t["locale"],
+            fingerprint=tile_fingerprint(**t),
+            created_at=created_at,
         )
+        for t in tiles
+    ]
+
+    try:
+        if _supports_returning(conn):
+            # ids come back from the insert itself, which needs no table lock to be correct
+            result = {}
+            for i in xrange(0, len(rows), chunk_size):
+                stmt = (
+                    Tile.__table__.insert()
+                    .values(rows[i:i + chunk_size])
+                    .returning(Tile.id, Tile.fingerprint)
+                )
+                for tile_id, fingerprint in conn.execute(stmt):
+                    if fingerprint not in result or tile_id < result[fingerprint]:
+                        result[fingerprint] = tile_id
+        else:
+            # otherwise, ids are read back within the transaction using the fingerprints
+            conn.execute(Tile.__table__.insert(), rows)
+            result = tile_ids(tiles, conn=conn)
 
-        result = conn.execute("SELECT MAX(id) FROM tiles;").scalar()
         if trans is not None:
             trans.commit()
         return result
@@ -290,6 +893,45 @@ def insert_tile(target_url, bg_color, title, type, image_uri, enhanced_image_uri
         if trans is not None:
             trans.rollback()
         raise
+    finally:
+        if trans is not None:
+            conn.close()
+
+
+def resolve_tiles(tiles, conn, chunk_size=500):
+    """
+    Return a mapping of fingerprint to id for the tiles provided, inserting those that don't
+    exist within the connection's transaction, and the mapping of the tiles inserted
+    """
+    # Redshift doesn't enforce the unique index on fingerprints, so its writers are serialized.
+    # sqlite only allows one writer at a time
+    postgres = _supports_returning(conn)
+    if conn.dialect.name == "postgresql" and not postgres:
+        conn.execute("LOCK TABLE tiles;")
+
+    found = tile_ids(tiles, conn=conn, chunk_size=chunk_size)
+    missing = [t for t in tiles if tile_fingerprint(**t) not in found]
+
+    while True:
+        # on Postgres, tiles inserted by a concurrent ingestion since the lookup violate the
+        # index: the insert is undone to a savepoint and the lookup retried for the others
+        savepoint = conn.begin_nested() if postgres else None
+        try:
+            inserted = insert_tiles(missing, conn=conn, chunk_size=chunk_size)
+        except IntegrityError:
+            if savepoint is None:
+                raise
+            savepoint.rollback()
+            concurrent = tile_ids(missing, conn=conn, chunk_size=chunk_size)
+            if not concurrent:
+                raise
+            found.update(concurrent)
+            missing = [t for t in missing if tile_fingerprint(**t) not in found]
+            continue
+        if savepoint is not None:
+            savepoint.commit()
+        found.update(inserted)
+        return found, inserted
 
 
 def insert_distribution(url, *args, **kwargs):
@@ -315,6 +957,64 @@ def insert_distribution(url, *args, **kwargs):
     except:
         trans.rollback()
         raise
+    finally:
+        conn.close()
+
+
+def deployed_keys(bucket, keys, chunk_size=500, *args, **kwargs):
+    """
+    Return the subset of keys already deployed to a bucket
+    """
+    from splice.environment import Environment
+
+    env = Environment.instance()
+
+    if not keys:
+        return set()
+
+    with env.db.engine.connect() as conn:
+        return _deployed_keys(conn, bucket, keys, chunk_size)
+
+
+def _deployed_keys(conn, bucket, keys, chunk_size=500):
+    keys = sorted(set(keys))
+    found = set()
+    for i in xrange(0, len(keys), chunk_size):
+        stmt = (
+            select([DeployedArtifact.key])
+            .where(DeployedArtifact.bucket == bucket)
+            .where(DeployedArtifact.key.in_(keys[i:i + chunk_size]))
+        )
+        found.update(row[0] for row in conn.execute(stmt))
+    return found
+
+
+def insert_deployed_keys(bucket, keys, *args, **kwargs):
+    """
+    Record keys as deployed to a bucket, unless they already are, as after a forced deployment
+    """
+    from splice.environment import Environment
+
+    if not keys:
+        return
+
+    env = Environment.instance()
+    conn = env.db.engine.connect()
+    trans = conn.begin()
+    try:
+        new_keys = sorted(set(keys) - _deployed_keys(conn, bucket, keys))
+        if new_keys:
+            created_at = datetime.utcnow()
+            conn.execute(
+                DeployedArtifact.__table__.insert(),
+                [dict(bucket=bucket, key=key, created_at=created_at) for key in new_keys]
+            )
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
 
 
 def get_distributions(limit=100, *args, **kwargs):
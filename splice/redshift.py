@@ -0,0 +1,193 @@
+"""
+Redshift table layouts: distribution, sort keys and column encodings.
+
+Tables declare their layout in their info: "diststyle" ("even" or "all"), or "distkey" for a
+key distribution, "sortkey", a tuple of columns, and "encode", a mapping of column to encoding.
+Columns without a declared encoding are left to Redshift.
+
+The layout of a table can't be altered in place, so a table whose live layout differs from its
+declared one is deep copied: recreated with its layout, filled from the old table, and swapped in.
+The identity columns of a copy keep the ids copied, and generate the following ones
+"""
+import re
+from sqlalchemy import Boolean, UniqueConstraint
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import text, select, func
+
+LAYOUT_KEYS = ("diststyle", "distkey", "sortkey", "encode")
+DEFAULT_LAYOUT = {"diststyle": "even", "distkey": None, "sortkey": (), "encode": {}}
+
+
+def declared_layout(table):
+    """
+    Layout declared by a table, or None if it declares none
+    """
+    info = table.info
+    if not any(k in info for k in LAYOUT_KEYS):
+        return None
+    distkey = info.get("distkey")
+    return {
+        "diststyle": "key" if distkey else info.get("diststyle", "even"),
+        "distkey": distkey,
+        "sortkey": tuple(info.get("sortkey", ())),
+        "encode": dict(info.get("encode", {})),
+    }
+
+
+def live_layout(conn, table_name):
+    """
+    Layout of a table in the Redshift catalog, or None if the table does not exist
+    """
+    diststyle = conn.execute(text("SELECT diststyle FROM svv_table_info WHERE \"table\" = :name"),
+                             name=table_name).scalar()
+    if diststyle is None:
+        return None
+
+    distkey = None
+    sortkey = []
+    encode = {}
+    columns = conn.execute(text(
+        "SELECT \"column\", encoding, distkey, sortkey FROM pg_table_def WHERE tablename = :name"), name=table_name)
+    for column, encoding, is_distkey, sort_position in columns:
+        encode[column] = "raw" if encoding == "none" else encoding
+        if is_distkey:
+            distkey = column
+        if sort_position > 0:
+            sortkey.append((sort_position, column))
+
+    # styles are reported as EVEN, ALL or KEY(column), wrapped in AUTO(...) when chosen by Redshift
+    match = re.match(r"(?:AUTO\()?(\w+)", diststyle)
+    return {
+        "diststyle": match.group(1).lower(),
+        "distkey": distkey,
+        "sortkey": tuple(column for _, column in sorted(sortkey)),
+        "encode": encode,
+    }
+
+
+def layout_diff(declared, live):
+    """
+    Differences of a live layout from a declared one, as descriptions
+    """
+    diff = []
+    for key in ("diststyle", "distkey", "sortkey"):
+        if declared[key] != live[key]:
+            diff.append("{0}: {1} instead of {2}".format(key, live[key], declared[key]))
+    for column, encoding in sorted(declared["encode"].iteritems()):
+        if live["encode"].get(column) != encoding:
+            diff.append("encode {0}: {1} instead of {2}".format(column, live["encode"].get(column), encoding))
+    return diff
+
+
+def _column_ddl(column, layout, next_ids):
+    dialect = postgresql.dialect()
+    ddl = "{0} {1}".format(column.name, column.type.compile(dialect=dialect))
+    if "identity" in column.info:
+        seed, step = column.info["identity"]
+        if next_ids is None:
+            ddl += " IDENTITY({0},{1})".format(seed, step)
+        else:
+            # a copy is filled with the ids of the table copied, then generates those following
+            ddl += " GENERATED BY DEFAULT AS IDENTITY({0},{1})".format(next_ids.get(column.name, seed), step)
+    if column.server_default is not None:
+        default = column.server_default.arg
+        ddl += " DEFAULT {0}".format(default.upper() if isinstance(column.type, Boolean) else "'{0}'".format(default))
+    if not column.nullable:
+        ddl += " NOT NULL"
+    if column.name in layout["encode"]:
+        ddl += " ENCODE {0}".format(layout["encode"][column.name])
+    return ddl
+
+
+def create_table_ddl(table, name=None, next_ids=None):
+    """
+    CREATE TABLE statement of a table, with its declared layout. For a copy, next_ids maps
+    each identity column to the id it generates first
+    """
+    layout = declared_layout(table) or DEFAULT_LAYOUT
+    lines = [_column_ddl(c, layout, next_ids) for c in table.columns]
+    if table.primary_key.columns:
+        lines.append("PRIMARY KEY ({0})".format(", ".join(c.name for c in table.primary_key.columns)))
+    lines.extend(sorted("UNIQUE ({0})".format(", ".join(c.name for c in constraint.columns))
+                        for constraint in table.constraints if isinstance(constraint, UniqueConstraint)))
+    for fk in sorted(table.foreign_keys, key=lambda fk: fk.parent.name):
+        lines.append("FOREIGN KEY({0}) REFERENCES {1} ({2})".format(fk.parent.name, fk.column.table.name, fk.column.name))
+
+    ddl = "CREATE TABLE {0} (\n    {1}\n)".format(name or table.name, ",\n    ".join(lines))
+    ddl += "\nDISTSTYLE {0}".format(layout["diststyle"].upper())
+    if layout["distkey"]:
+        ddl += "\nDISTKEY ({0})".format(layout["distkey"])
+    if layout["sortkey"]:
+        ddl += "\nSORTKEY ({0})".format(", ".join(layout["sortkey"]))
+    return ddl + ";"
+
+
+def _referencing(table):
+    """
+    Foreign keys of other tables referencing a table
+    """
+    return sorted((fk for other in table.metadata.sorted_tables if other is not table
+                   for fk in other.foreign_keys if fk.column.table is table),
+                  key=lambda fk: (fk.parent.table.name, fk.parent.name))
+
+
+def identity_columns(table):
+    return [c for c in table.columns if "identity" in c.info]
+
+
+def next_ids(conn, table):
+    """
+    Ids the identity columns of a table generate next: a step past the largest, or their seed
+    """
+    ids = {}
+    for column in identity_columns(table):
+        seed, step = column.info["identity"]
+        largest = conn.execute(select([func.max(column)])).scalar()
+        ids[column.name] = seed if largest is None else largest + step
+    return ids
+
+
+def deep_copy_ddl(table, next_ids=None):
+    """
+    Statements recreating a table with its declared layout, keeping its rows. next_ids maps each
+    identity column to the id following those of the table, see next_ids.
+    Foreign keys referencing the table are dropped with it, and added back to the copy
+    """
+    columns = ", ".join(c.name for c in table.columns)
+    new_name = "{0}_new".format(table.name)
+    referencing = _referencing(table)
+    statements = [
+        create_table_ddl(table, new_name, next_ids=next_ids or {}),
+        "INSERT INTO {0} ({1})\nSELECT {1} FROM {2};".format(new_name, columns, table.name),
+        "DROP TABLE {0}{1};".format(table.name, " CASCADE" if referencing else ""),
+        "ALTER TABLE {0} RENAME TO {1};".format(new_name, table.name),
+    ]
+    statements.extend("ALTER TABLE {0} ADD FOREIGN KEY ({1}) REFERENCES {2} ({3});".format(
+        fk.parent.table.name, fk.parent.name, table.name, fk.column.name) for fk in referencing)
+    return "\n\n".join(statements)
+
+
+def layout_migration(conn, tables):
+    """
+    Migration deep copying the tables whose live layout differs from their declared one.
+    Return the migration, or None if no table differs, and the differences by table.
+    The identity columns of the copies continue from the ids of the tables when the migration
+    is generated, so that no rows are to be added to them until it is run
+    """
+    diffs = {}
+    statements = []
+    for table in tables:
+        declared = declared_layout(table)
+        if declared is None:
+            continue
+        live = live_layout(conn, table.name)
+        if live is None:
+            continue
+        diff = layout_diff(declared, live)
+        if diff:
+            diffs[table.name] = diff
+            statements.append("-- {0}\n{1}".format("\n-- ".join(diff), deep_copy_ddl(table, next_ids(conn, table))))
+
+    if not statements:
+        return None, diffs
+    return "BEGIN;\n\n{0}\n\nCOMMIT;\n".format("\n\n".join(statements)), diffs
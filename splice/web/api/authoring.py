@@ -3,7 +3,7 @@ import logging
 from flask import Blueprint, request, jsonify
 from splice.environment import Environment
 from splice.queries import get_distributions
-from splice.ingest import IngestError, ingest_links, deploy, payload_schema as schema
+from splice.ingest import IngestError, ingest_stream, deploy, payload_schema as schema
 from jsonschema.exceptions import ValidationError
 
 authoring = Blueprint('api.authoring', __name__, url_prefix='/api/authoring')
@@ -14,9 +14,11 @@ env = Environment.instance()
 def all_tiles():
 
     try:
-        data = request.get_json(force=True)
-        new_data = ingest_links(data)
-        urls = deploy(new_data)
+        new_data = ingest_stream(request.stream)
+        try:
+            urls = deploy(new_data)
+        finally:
+            new_data.close()
     except ValidationError, e:
         errors = []
         error = {"path": e.path[0], "msg": e.message}
@@ -1,14 +1,93 @@
-from flask import Blueprint, request, Response
+import time
+import threading
+from flask import Blueprint, request, Response, g, jsonify
+from sqlalchemy.pool import QueuePool
 from splice.queries import tile_stats, slot_stats, newtab_stats, \
-    tile_summary, slot_summary
+    tile_summary, slot_summary, unique_stats, InvalidArgument
 from splice.models import Environment
+from splice.metrics import derive
 
+import base64
 import ujson
 import StringIO
 import csv
+from datetime import date
 
 
-def _build_response(it, keys, name=''):
+def _csv_chunks(it, keys, headers, chunk_rows):
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+    if headers:
+        writer.writerow(keys)
+    for i, tup in enumerate(it, 1):
+        writer.writerow(tup)
+        if i % chunk_rows == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+    buf.close()
+
+
+def _json_chunks(it, keys, chunk_rows):
+    chunk = ['[']
+    for i, tup in enumerate(it):
+        if i:
+            chunk.append(',')
+        chunk.append(ujson.dumps(dict(zip(keys, tup))))
+        if len(chunk) >= 2 * chunk_rows:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def _encode_cursor(keys, row):
+    values = dict((k, v.isoformat() if isinstance(v, date) else v) for k, v in zip(keys, row))
+    return base64.urlsafe_b64encode(ujson.dumps(values))
+
+
+def _decode_cursor(cursor):
+    try:
+        after = ujson.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (TypeError, ValueError, UnicodeError):
+        after = None
+    if not isinstance(after, dict):
+        raise InvalidArgument("Invalid cursor")
+    return after
+
+
+def _parse_page():
+    """
+    Page size and cursor of the previous page's last row, if given
+    """
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            raise InvalidArgument("Invalid limit")
+    after = request.args.get('cursor')
+    if after is not None:
+        after = _decode_cursor(after)
+    return limit, after
+
+
+def _with_next(limit):
+    """
+    Rows to fetch for a page: one more, telling whether a next page exists
+    """
+    if limit is not None:
+        return limit + 1
+
+
+def _build_response(it, keys, name='', limit=None):
+    """
+    Stream the rows of a result, a chunk of rows at a time. With a limit, the result is expected
+    to hold one more row if a next page exists, and the cursor to it is returned in a header
+    """
     json = request.args.get('json')
     if json == 'true':
         json = True
@@ -25,28 +104,63 @@ def _build_response(it, keys, name=''):
     else:
         download = False
 
+    chunk_rows = Environment.instance().config.REPORT_CHUNK_ROWS
+
+    next_cursor = None
+    if limit is not None:
+        it = list(it)
+        if len(it) > limit:
+            it = it[:limit]
+            next_cursor = _encode_cursor(keys, it[-1])
+
     if json:
-        rval = []
-        for tup in it:
-            rval.append(dict(zip(keys, tup)))
-        response = Response(ujson.dumps(rval), content_type='application/json; charset=utf-8', status=200)
+        response = Response(_json_chunks(it, keys, chunk_rows), content_type='application/json; charset=utf-8', status=200)
         ending = 'json'
     else:
-        buf = StringIO.StringIO()
-        writer = csv.writer(buf)
-        if headers:
-            writer.writerow(keys)
-        for tup in it:
-            writer.writerow(tup)
-        response = Response(buf.getvalue(), content_type='text/csv; charset=utf-8', status=200)
-        buf.close()
+        response = Response(_csv_chunks(it, keys, headers, chunk_rows), content_type='text/csv; charset=utf-8', status=200)
         ending = 'csv'
 
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
     if download:
         response.headers['Content-Disposition'] = 'attachment; filename=imps_%s.%s' % (name, ending)
     return response
 
 
+class PoolWaits(object):
+    """
+    Time spent waiting for pooled connections, in this process
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, wait):
+        with self._lock:
+            self.count += 1
+            self.total += wait
+            self.max = max(self.max, wait)
+
+pool_waits = PoolWaits()
+
+
+def _connection():
+    """
+    Connection for the current request, with results streamed from a server-side cursor where
+    supported. It is returned to the pool once the response is sent, or when the request fails
+    """
+    conn = getattr(g, 'report_conn', None)
+    if conn is None:
+        start_time = time.time()
+        conn = Environment.instance().db.engine.connect().execution_options(stream_results=True)
+        pool_waits.add(time.time() - start_time)
+        g.report_conn = conn
+    return conn
+
+
 def _parse_country_locale():
     country_code = request.args.get('country_code')
     locale = request.args.get('locale')
@@ -55,45 +169,180 @@ def _parse_country_locale():
 report = Blueprint('api.report', __name__, url_prefix='/api/report')
 
 
+@report.after_request
+def _release_on_close(response):
+    # responses are streamed, so the connection is held until the response is closed
+    conn = getattr(g, 'report_conn', None)
+    if conn is not None:
+        response.call_on_close(conn.close)
+        g.report_conn = None
+    return response
+
+
+@report.teardown_request
+def _release(exc):
+    conn = getattr(g, 'report_conn', None)
+    if conn is not None:
+        conn.close()
+        g.report_conn = None
+
+
+@report.errorhandler(InvalidArgument)
+def _invalid_argument(e):
+    return jsonify({"err": [{"msg": e.message}]}), 400
+
+
 @report.route('/', methods=['GET'])
 def root():
     return ""
 
+
+@report.route('/pool', methods=['GET'])
+def pool_status():
+    """
+    Connection pool metrics of the worker process serving the request
+    """
+    pool = Environment.instance().db.engine.pool
+    stats = {
+        "status": pool.status(),
+        "wait_count": pool_waits.count,
+        "wait_total_ms": pool_waits.total * 1000,
+        "wait_max_ms": pool_waits.max * 1000,
+    }
+    # only queue pools keep counts
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    return jsonify(stats)
+
 _periods = {'weekly': 'week', 'daily': 'date', 'monthly': 'month'}
 _sumaries = {'tile': tile_summary, 'slot': slot_summary, 'newtab': newtab_stats}
+_summary_ids = {'tile': 'tile_id', 'slot': 'position'}
 
 
 @report.route('/tile_stats/<period>/<start_date>/<tile_id>', methods=['GET'])
 def path_tile_stats(start_date, period, tile_id):
     country_code, locale = _parse_country_locale()
-    conn = Environment.instance().db.engine.connect()
-    keys, rval = tile_stats(conn, start_date, _periods[period], tile_id, country_code, locale)
-    return _build_response(rval, keys, name=start_date)
+    end_date = request.args.get('end_date')
+    limit, after = _parse_page()
+    conn = _connection()
+    keys, rval = tile_stats(conn, start_date, _periods[period], tile_id, country_code, locale, end_date=end_date,
+                            limit=_with_next(limit), after=after)
+    return _build_response(rval, keys, name=start_date, limit=limit)
 
 
 # @report.route('/newtab_stats/<period>/<start_date>', methods=['GET'])
 # def path_newtab_stats(start_date, period):
 #     country_code, locale = _parse_country_locale()
-#     conn = Environment.instance().db.engine.connect()
-#     keys, rval = newtab_stats(conn, start_date, _periods[period], country_code, locale)
-#     return _build_response(rval, keys, name=start_date)
+#     end_date = request.args.get('end_date')
+#     limit, after = _parse_page()
+#     conn = _connection()
+#     keys, rval = newtab_stats(conn, start_date, _periods[period], country_code, locale, end_date=end_date,
+#                               limit=_with_next(limit), after=after)
+#     return _build_response(rval, keys, name=start_date, limit=limit)
 
 
 @report.route('/summary/<summary>/<period>/<start_date>', methods=['GET'])
 def path_summary(summary, start_date, period):
     country_code, locale = _parse_country_locale()
-    conn = Environment.instance().db.engine.connect()
-    keys, rval = _sumaries[summary](conn, start_date, _periods[period], country_code, locale)
-    return _build_response(rval, keys, name=start_date)
+    end_date = request.args.get('end_date')
+    limit, after = _parse_page()
+    derived = request.args.get('derived') == 'true'
+    if derived:
+        if summary not in _summary_ids:
+            raise InvalidArgument("No derived metrics for this summary")
+        if limit is not None or after is not None:
+            raise InvalidArgument("Derived metrics are not paged")
+    conn = _connection()
+    keys, rval = _sumaries[summary](conn, start_date, _periods[period], country_code, locale, end_date=end_date,
+                                    limit=_with_next(limit), after=after)
+    if derived:
+        # deltas and totals need every period, so the result is processed whole
+        keys, rval = derive(keys, list(rval), _summary_ids[summary])
+    return _build_response(rval, keys, name=start_date, limit=limit)
 
 
 @report.route('/slot_stats/<period>/<start_date>/<slot_id>', methods=['GET'])
 def path_slot_stats(start_date, period, slot_id):
     country_code, locale = _parse_country_locale()
-    conn = Environment.instance().db.engine.connect()
-    keys, rval = slot_stats(conn, start_date, _periods[period], slot_id, country_code, locale)
+    end_date = request.args.get('end_date')
+    limit, after = _parse_page()
+    conn = _connection()
+    keys, rval = slot_stats(conn, start_date, _periods[period], slot_id, country_code, locale, end_date=end_date,
+                            limit=_with_next(limit), after=after)
+    return _build_response(rval, keys, name=start_date, limit=limit)
+
+
+@report.route('/unique_stats/<period>/<start_date>/<tile_id>', methods=['GET'])
+def path_unique_stats(start_date, period, tile_id):
+    country_code, locale = _parse_country_locale()
+    end_date = request.args.get('end_date')
+    try:
+        tile_id = int(tile_id)
+    except ValueError:
+        raise InvalidArgument("Invalid tile id")
+    conn = _connection()
+    keys, rval = unique_stats(conn, start_date, _periods[period], tile_id, country_code, locale, end_date=end_date)
     return _build_response(rval, keys, name=start_date)
 
 
+def _parse_ids():
+    """
+    Comma separated integer ids
+    """
+    try:
+        ids = sorted(set(int(i) for i in request.args.get('ids', '').split(',')))
+    except ValueError:
+        raise InvalidArgument("Invalid ids")
+    if len(ids) > Environment.instance().config.REPORT_BATCH_MAX_IDS:
+        raise InvalidArgument("Too many ids")
+    return ids
+
+
+def _build_batch_response(it, keys, id_key, ids):
+    """
+    JSON rows of a result, grouped by id. Ids without rows have none
+    """
+    grouped = dict((i, []) for i in ids)
+    for tup in it:
+        row = dict(zip(keys, tup))
+        grouped[row[id_key]].append(row)
+    return Response(ujson.dumps(grouped), content_type='application/json; charset=utf-8', status=200)
+
+
+@report.route('/batch/tile_stats/<period>/<start_date>', methods=['GET'])
+def path_batch_tile_stats(start_date, period):
+    tile_ids = _parse_ids()
+    country_code, locale = _parse_country_locale()
+    end_date = request.args.get('end_date')
+    conn = _connection()
+    keys, rval = tile_stats(conn, start_date, _periods[period], tile_ids, country_code, locale, end_date=end_date)
+    return _build_batch_response(rval, keys, 'tile_id', tile_ids)
+
+
+@report.route('/batch/slot_stats/<period>/<start_date>', methods=['GET'])
+def path_batch_slot_stats(start_date, period):
+    slot_ids = _parse_ids()
+    country_code, locale = _parse_country_locale()
+    end_date = request.args.get('end_date')
+    conn = _connection()
+    keys, rval = slot_stats(conn, start_date, _periods[period], slot_ids, country_code, locale, end_date=end_date)
+    return _build_batch_response(rval, keys, 'position', slot_ids)
+
+
+@report.route('/batch/unique_stats/<period>/<start_date>', methods=['GET'])
+def path_batch_unique_stats(start_date, period):
+    tile_ids = _parse_ids()
+    country_code, locale = _parse_country_locale()
+    end_date = request.args.get('end_date')
+    conn = _connection()
+    keys, rval = unique_stats(conn, start_date, _periods[period], tile_ids, country_code, locale, end_date=end_date)
+    return _build_batch_response(rval, keys, 'tile_id', tile_ids)
+
+
 def register_routes(app):
     app.register_blueprint(report)
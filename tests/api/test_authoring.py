@@ -1,5 +1,68 @@
+import json
+from flask import url_for
+from mock import Mock, patch
+from nose.tools import assert_equal
 from tests.base import BaseTestCase
 
 
 class TestAuthoring(BaseTestCase):
-    pass
+
+    def setUp(self):
+        super(TestAuthoring, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+
+    def tearDown(self):
+        self.app.config['WTF_CSRF_ENABLED'] = True
+        super(TestAuthoring, self).tearDown()
+
+    def test_all_tiles_invalid(self):
+        """
+        Invalid tiles are rejected with their country/locale
+        """
+        payload = {"US/en-US": [
+            {
+                "imageURI": "data:image/png;base64,somedata",
+                "url": "ftp://somewhere.com",
+                "title": "Some Title",
+                "type": "organic",
+                "bgColor": "#FFFFFF"
+            }
+        ]}
+        response = self.client.post(url_for('api.authoring.all_tiles'), data=json.dumps(payload))
+        assert_equal(response.status_code, 400)
+        assert_equal("US/en-US", json.loads(response.data)["err"][0]["path"])
+
+    def test_all_tiles_malformed(self):
+        """
+        Malformed payloads are rejected
+        """
+        response = self.client.post(url_for('api.authoring.all_tiles'), data='{"US/en-US": [')
+        assert_equal(response.status_code, 400)
+
+    def test_all_tiles_distribution_posted_back(self):
+        """
+        A distribution deployed can be posted again, as the authoring page does
+        """
+        from splice.models import Tile
+        payload = {"US/en-US": [
+            {
+                "imageURI": "data:image/png;base64,somedata",
+                "enhancedImageURI": "data:image/png;base64,somemoredata",
+                "url": "https://somewhere.com",
+                "title": "Some Title",
+                "type": "organic",
+                "bgColor": "#FFFFFF"
+            }
+        ]}
+        key = Mock()
+        with patch("splice.ingest.Key", Mock(return_value=key)), \
+                patch.object(self.env.s3, "get_bucket", Mock(return_value=Mock())):
+            response = self.client.post(url_for('api.authoring.all_tiles'), data=json.dumps(payload))
+            assert_equal(response.status_code, 200)
+            tile_count = self.env.db.session.query(Tile).count()
+
+            # the distribution is uploaded last
+            distribution = key.set_contents_from_string.call_args[0][0]
+            response = self.client.post(url_for('api.authoring.all_tiles'), data=distribution)
+            assert_equal(response.status_code, 200)
+        assert_equal(tile_count, self.env.db.session.query(Tile).count())
@@ -1,8 +1,11 @@
 from StringIO import StringIO
 from flask import url_for
-from nose.tools import assert_equal
+from mock import Mock, patch
+from nose.tools import assert_equal, assert_almost_equal
 from tests.base import BaseTestCase
 import csv
+import base64
+import json
 from splice.environment import Environment
 from datetime import datetime
 
@@ -25,12 +28,12 @@ class TestReporting(BaseTestCase):
 
         with open(self.get_fixture_path('impression_stats.csv')) as fd:
             for row in values(fd, 1):
-                ins = impression_stats_daily.insert().values(row)
+                ins = impression_stats_daily.insert().values(self.encode_dimensions(conn, row, 12))
                 conn.execute(ins)
 
         with open(self.get_fixture_path('newtabs.csv')) as fd:
             for row in values(fd):
-                ins = newtab_stats_daily.insert().values(row)
+                ins = newtab_stats_daily.insert().values(self.encode_dimensions(conn, row, 7))
                 conn.execute(ins)
 
     def test_tile_summary_weekly(self):
@@ -260,3 +263,354 @@ class TestReporting(BaseTestCase):
                 assert_equal(val, '116')
                 f2 = True
         assert(f1 and f2)
+
+    def test_streamed_in_chunks(self):
+        """
+        Reports are streamed a chunk of rows at a time, in both formats
+        """
+        url = url_for('api.report.path_summary',
+                      start_date='2014-05-15',
+                      summary='tile',
+                      period='weekly')
+        expected = self.client.get(url).data
+        rows = list(csv.reader(StringIO(expected)))
+        assert(len(rows) > 3)
+
+        chunk_rows = self.env.config.REPORT_CHUNK_ROWS
+        self.env.config.REPORT_CHUNK_ROWS = 2
+        try:
+            response = self.client.get(url)
+            chunks = list(response.response)
+            # the header row and two rows per chunk, the last chunk with the remainder
+            assert_equal(len(chunks), (len(rows) - 1) / 2 + 1)
+            assert_equal(''.join(chunks), expected)
+
+            response = self.client.get(url_for('api.report.path_summary',
+                                               start_date='2014-05-15',
+                                               summary='tile',
+                                               period='weekly',
+                                               json='true'))
+            chunks = list(response.response)
+            assert(len(chunks) > 1)
+            assert_equal([[str(r[k]) for k in rows[0]] for r in json.loads(''.join(chunks))], rows[1:])
+        finally:
+            self.env.config.REPORT_CHUNK_ROWS = chunk_rows
+
+    def test_connection_released_on_close(self):
+        """
+        The connection of a report is returned to the pool once its response is closed
+        """
+        from sqlalchemy.engine import Connection
+        url = url_for('api.report.path_summary',
+                      start_date='2014-05-15',
+                      summary='tile',
+                      period='weekly')
+        with patch.object(Connection, 'close', autospec=True, side_effect=Connection.close) as close:
+            response = self.client.get(url)
+            assert_equal(response.status_code, 200)
+            assert_equal(0, close.call_count)
+            response.close()
+            assert_equal(1, close.call_count)
+
+    def test_pool_status(self):
+        """
+        /pool
+        """
+        response = self.client.get(url_for('api.report.pool_status'))
+        assert_equal(response.status_code, 200)
+        stats = json.loads(response.data)
+        assert('status' in stats)
+        assert('wait_max_ms' in stats)
+
+    def _summary_weeks(self, **kwargs):
+        url = url_for('api.report.path_summary',
+                      headers='false',
+                      summary='tile',
+                      period='weekly',
+                      **kwargs)
+        response = self.client.get(url)
+        assert_equal(response.status_code, 200)
+        return set(tuple(int(r) for r in row[:2]) for row in csv.reader(StringIO(response.data)))
+
+    def test_end_date(self):
+        """
+        /tile_summary/weekly/<start_date>?end_date=<end_date>
+        """
+        weeks = self._summary_weeks(start_date='2014-05-15')
+        assert((2014, 39) in weeks and (2014, 40) in weeks)
+
+        # the whole week of the end date is included
+        bounded = self._summary_weeks(start_date='2014-05-15', end_date='2014-09-22')
+        assert((2014, 39) in bounded)
+        assert((2014, 40) not in bounded)
+        assert_equal(bounded, set(w for w in weeks if w <= (2014, 39)))
+
+    def test_later_year(self):
+        """
+        Periods of later years are reported, whatever their number
+        """
+        from splice.models import impression_stats_daily
+        from splice.queries import refresh_rollups
+        day = datetime(2015, 1, 7).date()
+        conn = self.env.db.engine.connect()
+        os_id, browser_id, version_id, device_id = self.encode_dimensions(conn, ['Windows', 'Firefox', '35.0', 'Other'], 0)
+        conn.execute(impression_stats_daily.insert().values(
+            tile_id=11, date=day, impressions=5, position=1, enhanced=False, locale='en-US', country_code='US',
+            os_id=os_id, browser_id=browser_id, version_id=version_id, device_id=device_id, month=1, week=2, year=2015))
+        conn.close()
+        refresh_rollups(day, day)
+
+        assert((2015, 2) in self._summary_weeks(start_date='2014-10-15'))
+
+    def test_year_boundary_week(self):
+        """
+        Days of late December in the ISO week 1 of the next year are reported in week 1 of their year
+        """
+        from splice.models import impression_stats_daily
+        from splice.queries import refresh_rollups
+        conn = self.env.db.engine.connect()
+        os_id, browser_id, version_id, device_id = self.encode_dimensions(conn, ['Windows', 'Firefox', '35.0', 'Other'], 0)
+        for day, impressions in [(datetime(2014, 1, 2).date(), 3), (datetime(2014, 12, 30).date(), 5),
+                                 (datetime(2015, 1, 2).date(), 7)]:
+            conn.execute(impression_stats_daily.insert().values(
+                tile_id=11, date=day, impressions=impressions, position=1, enhanced=False, locale='en-US',
+                country_code='US', os_id=os_id, browser_id=browser_id, version_id=version_id, device_id=device_id,
+                month=day.month, week=day.isocalendar()[1], year=day.year))
+        conn.close()
+        refresh_rollups(datetime(2014, 1, 2).date(), datetime(2015, 1, 2).date())
+
+        url = url_for('api.report.path_tile_stats', start_date='2014-12-29', end_date='2015-01-04', tile_id=11,
+                      period='weekly', headers='false', country_code='US', locale='en-US')
+        response = self.client.get(url)
+        assert_equal(response.status_code, 200)
+        rows = [(row[0], row[1], row[6]) for row in csv.reader(StringIO(response.data))]
+        assert_equal([('2014', '1', '5'), ('2015', '1', '7')], rows)
+
+    def _paged(self, endpoint, limit, **kwargs):
+        pages = []
+        cursor = None
+        while True:
+            if cursor is not None:
+                kwargs['cursor'] = cursor
+            response = self.client.get(url_for(endpoint, headers='false', limit=limit, **kwargs))
+            assert_equal(response.status_code, 200)
+            rows = list(csv.reader(StringIO(response.data)))
+            assert(len(rows) <= limit)
+            pages.append(rows)
+            cursor = response.headers.get('X-Next-Cursor')
+            if cursor is None:
+                return pages
+
+    def test_pages(self):
+        """
+        Reports are fetched a page at a time, following the cursor to the next page
+        """
+        for endpoint, kwargs in [
+                ('api.report.path_summary', dict(summary='tile', period='weekly', start_date='2014-05-15')),
+                ('api.report.path_tile_stats', dict(tile_id=16, period='daily', start_date='2014-05-15')),
+                ('api.report.path_slot_stats', dict(slot_id=8, period='monthly', start_date='2014-05-15'))]:
+            response = self.client.get(url_for(endpoint, headers='false', **kwargs))
+            rows = list(csv.reader(StringIO(response.data)))
+            assert(len(rows) > 3)
+            assert(response.headers.get('X-Next-Cursor') is None)
+
+            pages = self._paged(endpoint, 3, **kwargs)
+            assert_equal(len(pages), (len(rows) + 2) / 3)
+            assert_equal(rows, [row for page in pages for row in page])
+
+    def test_invalid_pages(self):
+        """
+        Invalid limits and cursors are rejected
+        """
+        for args in [dict(limit=0), dict(limit='x'), dict(cursor='x'), dict(cursor='e30=')]:
+            url = url_for('api.report.path_summary',
+                          start_date='2014-05-15',
+                          summary='tile',
+                          period='weekly',
+                          **args)
+            response = self.client.get(url)
+            assert_equal(response.status_code, 400)
+
+    def test_invalid_dates(self):
+        """
+        Invalid dates, given or in a cursor, are rejected
+        """
+        cursor = base64.urlsafe_b64encode(json.dumps({"date": "x", "tile_id": 1}))
+        for start_date, args in [('x', {}), ('2014-05-15', dict(end_date='2014-13-01')),
+                                 ('2014-05-15', dict(cursor=cursor))]:
+            url = url_for('api.report.path_tile_stats', start_date=start_date, tile_id=1, period='daily', **args)
+            response = self.client.get(url)
+            assert_equal(response.status_code, 400)
+
+    def test_summary_derived(self):
+        """
+        Summaries with derived=true carry rates, deltas and totals
+        """
+        for summary, id_key in [('tile', 'tile_id'), ('slot', 'position')]:
+            kwargs = dict(start_date='2014-05-15', summary=summary, period='weekly', json='true')
+            rows = json.loads(self.client.get(url_for('api.report.path_summary', **kwargs)).data)
+            derived = json.loads(self.client.get(url_for('api.report.path_summary', derived='true', **kwargs)).data)
+
+            ids = set(row[id_key] for row in rows)
+            assert_equal(len(derived), len(rows) + len(ids) + 1)
+            for row, drow in zip(rows, derived):
+                for key, value in row.items():
+                    assert_equal(drow[key], value)
+                if row['impressions']:
+                    assert_almost_equal(drow['ctr'], float(row['clicks']) / row['impressions'])
+                # deltas of counts are written as the counts are
+                for key in ('impressions_delta', 'clicks_delta'):
+                    assert drow[key] is None or isinstance(drow[key], int), (key, drow[key])
+
+            totals = derived[len(rows):]
+            assert_equal(set(row[id_key] for row in totals[:-1]), ids)
+            assert_equal(totals[-1][id_key], None)
+            assert_equal(totals[-1]['impressions'], sum(row['impressions'] for row in rows))
+
+        # not paged, and only for tiles and slots
+        for args in [dict(summary='tile', limit=3), dict(summary='newtab')]:
+            response = self.client.get(url_for('api.report.path_summary', start_date='2014-05-15', period='weekly',
+                                               derived='true', **args))
+            assert_equal(response.status_code, 400)
+
+    def test_batch_tile_stats(self):
+        """
+        /batch/tile_stats/<period>/<start_date>?ids=<tile_id>,...
+        """
+        from sqlalchemy.engine import Connection
+        from splice.queries import tile_stats, slot_stats
+        conn = self.env.db.engine.connect()
+        for endpoint, query, ids in [('api.report.path_batch_tile_stats', tile_stats, [11, 12, 15, 16]),
+                                     ('api.report.path_batch_slot_stats', slot_stats, [1, 8, 13])]:
+            execute = Mock(side_effect=conn.execute)
+            with patch.object(Connection, 'execute', execute):
+                response = self.client.get(url_for(endpoint,
+                                                   start_date='2014-09-15',
+                                                   period='weekly',
+                                                   ids=','.join(str(i) for i in ids)))
+            assert_equal(response.status_code, 200)
+            # one query for all ids
+            assert_equal(1, execute.call_count)
+
+            grouped = json.loads(response.data)
+            assert_equal(sorted(grouped.keys()), sorted(str(i) for i in ids))
+            assert(any(grouped.values()))
+            for i in ids:
+                keys, rows = query(conn, '2014-09-15', 'week', i)
+                assert_equal([[r[k] for k in keys] for r in grouped[str(i)]], [list(row) for row in rows])
+        conn.close()
+
+    def test_batch_invalid_ids(self):
+        """
+        Invalid ids are rejected
+        """
+        for ids in ['', '1,x']:
+            response = self.client.get(url_for('api.report.path_batch_tile_stats',
+                                               start_date='2014-09-15',
+                                               period='weekly',
+                                               ids=ids))
+            assert_equal(response.status_code, 400)
+
+    def test_unique_stats(self):
+        """
+        /unique_stats/<period>/<start_date>/<tile_id>
+        """
+        from splice import hll
+        from splice.models import UniqueCountsDaily, unique_hlls
+        precision = self.env.config.HLL_PRECISION
+        days = [(datetime(2014, 10, 1).date(), range(0, 3000)), (datetime(2014, 10, 2).date(), range(2000, 5000))]
+        for i, (day, users) in enumerate(days):
+            for impression, clicking in ((True, users), (False, users[:100])):
+                registers = hll.add(hll.empty(precision), (str(u) for u in clicking), precision)
+                result = self.env.db.engine.execute(UniqueCountsDaily.__table__.insert().values(
+                    tile_id=15, date=day, impression=impression, locale='en-US', country_code='US'))
+                self.env.db.engine.execute(unique_hlls.insert(), [
+                    dict(unique_counts_daily_id=result.inserted_primary_key[0], index=int(index), value=int(registers[index]))
+                    for index in registers.nonzero()[0]])
+
+        def unique_counts(**kwargs):
+            url = url_for('api.report.path_unique_stats', tile_id=15, headers='false', **kwargs)
+            response = self.client.get(url)
+            assert_equal(response.status_code, 200)
+            return [tuple(row) for row in csv.reader(StringIO(response.data))]
+
+        rows = unique_counts(start_date='2014-09-15', period='weekly')
+        assert_equal(1, len(rows))
+        year, week, tile_id, impressions, clicks = rows[0]
+        assert_equal(('2014', '40', '15'), (year, week, tile_id))
+        assert(abs(int(impressions) - 5000) < 250)
+        assert(abs(int(clicks) - 200) < 10)
+
+        assert_equal(2, len(unique_counts(start_date='2014-09-15', period='daily')))
+        assert_equal([], unique_counts(start_date='2014-09-15', period='weekly', country_code='CA'))
+
+        response = self.client.get(url_for('api.report.path_batch_unique_stats',
+                                           start_date='2014-09-15', period='monthly', ids='15,16'))
+        grouped = json.loads(response.data)
+        assert_equal([], grouped['16'])
+        assert_equal(int(impressions), grouped['15'][0]['unique_impressions'])
+
+        # sketches added between the reads of sketches and of their registers are left out
+        from splice.queries import unique_stats
+        conn = self.env.db.engine.connect()
+        execute = conn.execute
+        added = []
+
+        def execute_after_insert(stmt, *args, **kwargs):
+            if stmt.froms[0] is unique_hlls:
+                result = self.env.db.engine.execute(UniqueCountsDaily.__table__.insert().values(
+                    tile_id=15, date=days[0][0], impression=True, locale='en-US', country_code='US'))
+                registers = hll.add(hll.empty(precision), (str(u) for u in range(10000, 20000)), precision)
+                self.env.db.engine.execute(unique_hlls.insert(), [
+                    dict(unique_counts_daily_id=result.inserted_primary_key[0], index=int(index), value=int(registers[index]))
+                    for index in registers.nonzero()[0]])
+                added.append(result.inserted_primary_key[0])
+            return execute(stmt, *args, **kwargs)
+
+        with patch.object(conn, "execute", execute_after_insert):
+            _, estimates = unique_stats(conn, '2014-09-15', 'week', 15)
+        conn.close()
+        assert_equal([(2014, 40, 15, int(impressions), int(clicks))], estimates)
+        self.env.db.engine.execute(unique_hlls.delete().where(unique_hlls.c.unique_counts_daily_id.in_(added)))
+        self.env.db.engine.execute(UniqueCountsDaily.__table__.delete().where(UniqueCountsDaily.id.in_(added)))
+
+        response = self.client.get(url_for('api.report.path_unique_stats', start_date='2014-09-15', period='weekly', tile_id='x'))
+        assert_equal(response.status_code, 400)
+
+        # packed sketches give the same estimates
+        from splice.queries import pack_sketches
+        assert_equal(4, pack_sketches(batch_size=3))
+        assert_equal(0, self.env.db.engine.execute(unique_hlls.count()).scalar())
+        self.env.report_cache.clear()
+        assert_equal(rows, unique_counts(start_date='2014-09-15', period='weekly'))
+
+
+class TestReportingRollups(TestReporting):
+    """
+    The weekly and monthly reports, read from the impression rollups
+    """
+
+    def setUp(self):
+        super(TestReportingRollups, self).setUp()
+        from splice.queries import refresh_rollups
+        refresh_rollups(datetime(2014, 1, 1).date(), datetime(2014, 12, 31).date())
+        self.env.config.IMPRESSION_ROLLUPS_ENABLED = True
+
+    def tearDown(self):
+        self.env.config.IMPRESSION_ROLLUPS_ENABLED = False
+        super(TestReportingRollups, self).tearDown()
+
+    def test_refresh_incremental(self):
+        """
+        Refreshing the rollups rewrites the periods of the dates given, without duplicating them
+        """
+        from splice.queries import refresh_rollups
+        from splice.models import impression_stats_weekly
+
+        def weekly():
+            return sorted(self.env.db.engine.execute(impression_stats_weekly.select()).fetchall())
+
+        before = weekly()
+        # 2014-10-02 falls in week 40 and in october
+        assert_equal(2, refresh_rollups(datetime(2014, 10, 2).date(), datetime(2014, 10, 2).date()))
+        assert_equal(before, weekly())
@@ -17,6 +17,11 @@ class BaseTestCase(TestCase):
         return self.env.application
 
     def setUp(self):
+        from splice.queries import tile_fingerprints, dimension_ids
+        tile_fingerprints.clear()
+        dimension_ids.clear()
+        self.env.report_cache.clear()
+
         self.create_app()
         self.env.db.create_all()
 
@@ -39,6 +44,17 @@ class BaseTestCase(TestCase):
         self.env.db.session.remove()
         self.env.db.drop_all()
 
+    def encode_dimensions(self, conn, row, start):
+        """
+        Replace the os, browser, version and device names of a fixture row, from index start, by their ids
+        """
+        from splice.queries import encode_dimension, dimension_ids
+        for i, dimension in enumerate(('os', 'browser', 'version', 'device'), start):
+            mapping = encode_dimension(conn, dimension, [row[i]])
+            dimension_ids.update(dimension, mapping)
+            row[i] = mapping[row[i]]
+        return row
+
     def get_fixture_path(self, name):
         path = os.path.dirname(__file__)
         return os.path.join(path, 'fixtures/{0}'.format(name))
@@ -0,0 +1,42 @@
+from nose.tools import assert_equal
+from splice.cache import LRUCache
+from tests.base import BaseTestCase
+
+
+class TestLRUCache(BaseTestCase):
+
+    def test_evicts_least_recently_used(self):
+        # room for two items of about 110 bytes
+        cache = LRUCache(max_bytes=250)
+        cache.set("a", "1" * 100)
+        cache.set("b", "2" * 100)
+        assert_equal("1" * 100, cache.get("a"))
+        cache.set("c", "3" * 100)
+        assert_equal(None, cache.get("b"))
+        assert_equal("1" * 100, cache.get("a"))
+        assert_equal("3" * 100, cache.get("c"))
+
+    def test_large_items_not_kept(self):
+        cache = LRUCache(max_bytes=250)
+        cache.set("a", "1" * 100)
+        assert(not cache.set("b", "2" * 300))
+        assert_equal(None, cache.get("b"))
+        assert_equal("1" * 100, cache.get("a"))
+
+    def test_expires(self):
+        cache = LRUCache()
+        cache.set("a", 1, timeout=0)
+        cache.set("b", 2, timeout=60)
+        assert_equal(None, cache.get("a"))
+        assert_equal(2, cache.get("b"))
+
+    def test_add_delete_clear(self):
+        cache = LRUCache()
+        assert(cache.add("a", 1))
+        assert(not cache.add("a", 2))
+        assert_equal(1, cache.get("a"))
+        assert(cache.delete("a"))
+        assert(not cache.delete("a"))
+        cache.set("b", 2)
+        cache.clear()
+        assert_equal(None, cache.get("b"))
@@ -0,0 +1,47 @@
+import numpy as np
+from nose.tools import assert_equal
+from splice import hll
+from tests.base import BaseTestCase
+
+
+def sketch(values, precision=12):
+    return hll.add(hll.empty(precision), (str(v) for v in values), precision)
+
+
+def assert_close(expected, estimate, error=0.05):
+    assert abs(estimate - expected) <= error * expected, "{0} is not within {1} of {2}".format(estimate, error, expected)
+
+
+class TestHLL(BaseTestCase):
+
+    def test_estimate(self):
+        assert_equal(0, hll.estimate(hll.empty(12)))
+        for count in (10, 1000, 50000):
+            assert_close(count, hll.estimate(sketch(xrange(count))))
+
+    def test_merge(self):
+        a = sketch(xrange(0, 3000))
+        b = sketch(xrange(2000, 5000))
+        assert_close(5000, hll.estimate(hll.merge(a, b)))
+        # merging is idempotent
+        assert_equal(hll.estimate(a), hll.estimate(hll.merge(a, a)))
+
+    def test_merge_into(self):
+        a = sketch(xrange(0, 3000))
+        b = sketch(xrange(2000, 5000))
+        sketches = hll.empty(12, 2)
+        for row, s in ((0, a), (0, b), (1, b)):
+            indexes = np.nonzero(s)[0]
+            hll.merge_into(sketches, [row] * len(indexes), indexes, s[indexes])
+        assert_equal(hll.estimate(hll.merge(a, b)), hll.estimate(sketches)[0])
+        assert_equal(hll.estimate(b), hll.estimate(sketches)[1])
+
+    def test_pack(self):
+        for count in (0, 10, 1000, 50000):
+            registers = sketch(xrange(count), precision=14)
+            packed = hll.pack(registers)
+            assert_equal(registers.tolist(), hll.unpack(packed, 14).tolist())
+        # sparse sketches are packed by register, dense ones 6 bits per register
+        assert(len(hll.pack(sketch(xrange(100), precision=14))) < 500)
+        # 2^14 registers of 6 bits and the format, base64 encoded
+        assert_equal(16388, len(hll.pack(sketch(xrange(50000), precision=14))))
@@ -1,8 +1,11 @@
+import os
+import json
 import magic
+from StringIO import StringIO
 from mock import Mock
 from nose.tools import assert_raises, assert_equal, assert_not_equal, assert_true
 from jsonschema.exceptions import ValidationError
-from splice.ingest import ingest_links, generate_artifacts, IngestError, deploy
+from splice.ingest import ingest_links, ingest_stream, iter_payload, generate_artifacts, IngestError, deploy
 from tests.base import BaseTestCase
 
 
@@ -128,6 +131,179 @@ class TestIngestLinks(BaseTestCase):
         directory_id = data["STAR/en-US"][0]["directoryId"]
         assert_equal(30, directory_id)
 
+    def test_bulk_ingest_mapping(self):
+        """
+        Test ids are resolved for a whole payload, new and existing tiles alike
+        """
+        tile_a = {
+            "imageURI": "data:image/png;base64,somedata",
+            "url": "https://somewhere.com",
+            "title": "Some Title",
+            "type": "organic",
+            "bgColor": "#FFFFFF"
+        }
+        tile_b = {
+            "imageURI": "data:image/png;base64,someotherdata",
+            "url": "https://somewhereelse.com",
+            "title": "Some Other Title",
+            "type": "organic",
+            "bgColor": "#FFFFFF"
+        }
+        data = ingest_links({
+            "STAR/en-US": [dict(tile_a), dict(tile_b)],
+            "CA/en-US": [dict(tile_b), dict(tile_a)],
+            "US/en-US": [],
+        })
+        # country/locales are processed in sorted order
+        assert_equal([30, 31], [t["directoryId"] for t in data["CA/en-US"]])
+        assert_equal([31, 30], [t["directoryId"] for t in data["STAR/en-US"]])
+        assert_equal([], data["US/en-US"])
+
+        tile_c = {
+            "imageURI": "data:image/png;base64,somedata",
+            "url": "https://somewhere.com",
+            "title": "Some Title",
+            "type": "organic",
+            "bgColor": "#000000"
+        }
+        data = ingest_links({"STAR/en-US": [dict(tile_c), dict(tile_b), dict(tile_a)]})
+        assert_equal([32, 30, 31], [t["directoryId"] for t in data["STAR/en-US"]])
+
+
+class TestPayloadValidator(BaseTestCase):
+
+    def test_pattern_checks(self):
+        """
+        Compiled pattern checks agree with re.search
+        """
+        import re
+        from splice.ingest import _compile_pattern, tile_schema
+
+        patterns = set(p["pattern"] for p in tile_schema["properties"].values() if "pattern" in p)
+        instances = [
+            "", "data:image/png;base64,somedata", "data:image/png;base64,some\ndata",
+            "data:image/png;base64,somedata\n", "data:image/png;base64,somedata\n\n",
+            "http://somewhere.com", "https://somewhere.com", "httpss://somewhere.com",
+            " https://somewhere.com", "ftp://somewhere.com", "#FFFFFF", "#FFFFFG",
+            "rgb(1,2,3)", "rgb(1,2,3", "\nhttp://somewhere.com",
+        ]
+        for pattern in patterns:
+            check = _compile_pattern(pattern)
+            for instance in instances:
+                # line breaks in data URIs are left to the image decoder
+                expected = re.search(pattern, instance) is not None or \
+                    (instance.startswith("data:image/") and "data:image/" in pattern)
+                assert_equal(expected, check(instance), (pattern, instance))
+
+    def test_payload_validator(self):
+        """
+        The compiled validator rejects invalid image uris
+        """
+        from splice.ingest import payload_validator
+        tile = {
+            "imageURI": "data:image/png;base64,somedata",
+            "url": "https://somewhere.com",
+            "title": "Some Title",
+            "type": "organic",
+            "bgColor": "#FFFFFF"
+        }
+        payload_validator.validate({"US/en-US": [tile]})
+
+        tile["imageURI"] = "image/png;base64,somedata"
+        assert_raises(ValidationError, payload_validator.validate, {"US/en-US": [tile]})
+
+
+class TestIngestStream(BaseTestCase):
+
+    def get_sample_path(self):
+        return os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "tilesCountriesSample.json")
+
+    def test_iter_payload(self):
+        """
+        Streamed payloads parse the same as whole documents, whatever the chunk size
+        """
+        with open(self.get_sample_path()) as f:
+            expected = json.load(f)
+
+        for chunk_size in (1, 7, 4096):
+            with open(self.get_sample_path()) as f:
+                assert_equal(expected, dict(iter_payload(f, chunk_size=chunk_size)))
+
+    def test_iter_payload_empty(self):
+        """
+        Empty payloads and country/locales are accepted
+        """
+        assert_equal([], list(iter_payload(StringIO(" { } "))))
+        assert_equal([("US/en-US", [])], list(iter_payload(StringIO('{"US/en-US": [ ]}'))))
+
+    def test_iter_payload_invalid_tile(self):
+        """
+        Invalid tiles are reported with their path in the payload
+        """
+        payload = json.dumps({"US/en-US": [
+            {
+                "imageURI": "data:image/png;base64,somedata",
+                "url": "ftp://somewhere.com",
+                "title": "Some Title",
+                "type": "organic",
+                "bgColor": "#FFFFFF"
+            }
+        ]})
+        try:
+            list(iter_payload(StringIO(payload)))
+        except ValidationError, e:
+            assert_equal(["US/en-US", 0, "url"], list(e.path))
+        else:
+            raise AssertionError("ValidationError not raised")
+
+        assert_raises(ValidationError, list, iter_payload(StringIO('{"invalid": []}')))
+        assert_raises(ValidationError, list, iter_payload(StringIO('{"US/en-US": {}}')))
+
+    def test_iter_payload_malformed(self):
+        """
+        Malformed JSON is rejected
+        """
+        assert_raises(IngestError, list, iter_payload(StringIO('{"US/en-US": [{"url": ')))
+        assert_raises(IngestError, list, iter_payload(StringIO('{"US/en-US": [] "CA/en-US": []}')))
+        assert_raises(IngestError, list, iter_payload(StringIO('')))
+        assert_raises(IngestError, list, iter_payload(StringIO('{"US/en-US": []} []')))
+        assert_raises(IngestError, list, iter_payload(StringIO('{} x')))
+        assert_raises(IngestError, list, iter_payload(StringIO('{"US/en-US": [], "US/en-US": []}')))
+        assert_equal([], list(iter_payload(StringIO('{}\n'))))
+
+    def test_ingest_stream(self):
+        """
+        Streamed ingestion creates the same ids as ingest_links
+        """
+        with open(self.get_sample_path()) as f:
+            data = ingest_stream(f)
+
+        with open(self.get_sample_path()) as f:
+            expected = ingest_links(json.load(f))
+
+        assert_equal(expected, dict(data.iteritems()))
+
+        out = StringIO()
+        data.dump(out)
+        assert_equal(expected, json.loads(out.getvalue()))
+        data.close()
+
+    def test_ingest_stream_atomic(self):
+        """
+        Nothing is ingested from a stream with an invalid country/locale, wherever it is
+        """
+        from splice.models import Tile
+        tile = {
+            "imageURI": "data:image/png;base64,somedata",
+            "url": "https://somewhere.com",
+            "title": "Some Title",
+            "type": "organic",
+            "bgColor": "#FFFFFF"
+        }
+        payload = '{{"US/en-US": [{0}], "CA/en-US": [{{}}]}}'.format(json.dumps(tile))
+        assert_raises(ValidationError, ingest_stream, StringIO(payload))
+        assert_equal(29, self.env.db.session.query(Tile).count())
+
 
 class TestGenerateArtifacts(BaseTestCase):
 
@@ -168,6 +344,67 @@ class TestGenerateArtifacts(BaseTestCase):
         # includes one more file: the locale data payload
         assert_equal(5, len(artifacts))
 
+    def test_images_decoded_once(self):
+        """
+        Images shared across locales are only decoded once
+        """
+        from mock import patch
+        from splice.ingest import slice_image_uri
+
+        tile = {
+            "imageURI": "data:image/png;base64,somedata",
+            "enhancedImageURI": "data:image/png;base64,somemoredata",
+            "url": "https://somewhere.com",
+            "title": "Some Title",
+            "type": "organic",
+            "bgColor": "#FFFFFF"
+        }
+        data = ingest_links({
+            "STAR/en-US": [dict(tile)],
+            "CA/en-US": [dict(tile)],
+            "US/en-US": [dict(tile)],
+        })
+        with patch("splice.ingest.slice_image_uri", side_effect=slice_image_uri) as slice_mock:
+            artifacts = generate_artifacts(data)
+            assert_equal(2, slice_mock.call_count)
+        # two images, three locale files, the tile index and distribution
+        assert_equal(7, len(artifacts))
+
+    def test_distribution_submission(self):
+        """
+        The distribution holds the data submitted, images included
+        """
+        tile = {
+            "imageURI": "data:image/png;base64,somedata",
+            "url": "https://somewhere.com",
+            "title": "Some Title",
+            "type": "organic",
+            "bgColor": "#FFFFFF"
+        }
+        data = ingest_links({"STAR/en-US": [dict(tile)], "CA/en-US": [dict(tile)]})
+        artifacts = generate_artifacts(data)
+        distribution = json.loads(artifacts[-1]["data"])
+        assert_true(artifacts[-1]["dist"])
+        assert_equal(data, distribution)
+        assert_equal("data:image/png;base64,somedata", distribution["CA/en-US"][0]["imageURI"])
+
+    def test_input_unchanged(self):
+        """
+        Generating artifacts leaves the ingested data untouched
+        """
+        tile = {
+            "imageURI": "data:image/png;base64,somedata",
+            "enhancedImageURI": "data:image/png;base64,somemoredata",
+            "url": "https://somewhere.com",
+            "title": "Some Title",
+            "type": "organic",
+            "bgColor": "#FFFFFF"
+        }
+        data = ingest_links({"STAR/en-US": [dict(tile)]})
+        generate_artifacts(data)
+        assert_equal("data:image/png;base64,somedata", data["STAR/en-US"][0]["imageURI"])
+        assert_equal("data:image/png;base64,somemoredata", data["STAR/en-US"][0]["enhancedImageURI"])
+
     def test_unknown_mime_type(self):
         """
         Tests that an unknown mime type is rejected
@@ -275,5 +512,99 @@ class TestDeploy(BaseTestCase):
             "CA/en-US": tiles_ca,
         })
         deploy(data)
-        #  includes one more upload: the locate data payload
+        # images and the STAR/en-US payload are already deployed: only the new
+        # locale data payload, the tile index and the distribution are uploaded
+        assert_equal(3, self.key_mock.set_contents_from_string.call_count)
+
+        from splice.models import DeployedArtifact
+        deployed = self.env.db.session.query(DeployedArtifact).count()
+        self.key_mock.set_contents_from_string = Mock()
+        deploy(data, force=True)
+        #  forcing uploads everything, including the locale data payload
         assert_equal(6, self.key_mock.set_contents_from_string.call_count)
+        # keys already recorded as deployed are not recorded again
+        assert_equal(deployed, self.env.db.session.query(DeployedArtifact).count())
+
+    def test_deploy_public_in_single_request(self):
+        """
+        Artifacts are made public with the upload itself
+        """
+        tiles_star = [
+            {
+                "imageURI": "data:image/png;base64,somedata",
+                "url": "https://somewhere.com",
+                "title": "Some Title",
+                "type": "organic",
+                "bgColor": "#FFFFFF"
+            }
+        ]
+
+        data = ingest_links({"STAR/en-US": tiles_star})
+        deploy(data)
+        assert_equal(0, self.key_mock.set_acl.call_count)
+        for args, kwargs in self.key_mock.set_contents_from_string.call_args_list:
+            assert_equal("public-read", kwargs["policy"])
+
+    def test_deploy_retries(self):
+        """
+        Failed uploads are retried
+        """
+        tiles_star = [
+            {
+                "imageURI": "data:image/png;base64,somedata",
+                "url": "https://somewhere.com",
+                "title": "Some Title",
+                "type": "organic",
+                "bgColor": "#FFFFFF"
+            }
+        ]
+        failures = []
+
+        def flaky_upload(data, *args, **kwargs):
+            if not failures:
+                failures.append(data)
+                raise IOError("connection reset")
+
+        self.key_mock.set_contents_from_string = Mock(side_effect=flaky_upload)
+        data = ingest_links({"STAR/en-US": tiles_star})
+        urls = deploy(data)
+        assert_equal(1, len(failures))
+        assert_equal(4, len(urls))
+        assert_equal(5, self.key_mock.set_contents_from_string.call_count)
+
+    def test_deploy_upload_error(self):
+        """
+        A failed upload fails the deployment before the tile index and distribution are uploaded
+        """
+        tiles_star = [
+            {
+                "imageURI": "data:image/png;base64,somedata",
+                "url": "https://somewhere.com",
+                "title": "Some Title",
+                "type": "organic",
+                "bgColor": "#FFFFFF"
+            }
+        ]
+        uploaded = []
+
+        def failing_upload(data, *args, **kwargs):
+            if data.startswith("{"):
+                raise IOError("connection reset")
+            uploaded.append(data)
+
+        # a single worker uploads artifacts in the order they are generated
+        workers, retry_delay = self.env.config.S3_UPLOAD_WORKERS, self.env.config.S3_UPLOAD_RETRY_DELAY
+        self.env.config.S3_UPLOAD_WORKERS, self.env.config.S3_UPLOAD_RETRY_DELAY = 1, 0
+        try:
+            self.key_mock.set_contents_from_string = Mock(side_effect=failing_upload)
+            data = ingest_links({"STAR/en-US": tiles_star})
+            assert_raises(IOError, deploy, data)
+            # only the image made it, the locale data payload failed on each attempt
+            assert_equal(1, len(uploaded))
+
+            self.key_mock.set_contents_from_string = Mock()
+            deploy(data)
+            # the image uploaded by the failed deployment is not uploaded again
+            assert_equal(3, self.key_mock.set_contents_from_string.call_count)
+        finally:
+            self.env.config.S3_UPLOAD_WORKERS, self.env.config.S3_UPLOAD_RETRY_DELAY = workers, retry_delay
@@ -0,0 +1,192 @@
+import os
+import gzip
+import json
+import shutil
+import tempfile
+from datetime import date
+from nose.tools import assert_equal
+from sqlalchemy import select
+from mock import Mock, patch
+from splice.loader import aggregate, aggregate_files, load_stats, upload_staged, copy_manifest, lock_dimensions, \
+    encode_dimensions, NEWTAB_KEYS
+from splice.models import impression_stats_daily, newtab_stats_daily, impression_stats_weekly, dimensions
+from tests.base import BaseTestCase
+
+CLIENT = dict(locale="en-US", country_code="US", os="Windows", browser="Firefox", version="34.0", device="Desktop")
+
+
+def event(day, tiles, **kwargs):
+    kwargs.update(CLIENT, date=day, tiles=[dict(id=t) if t is not None else {} for t in tiles])
+    return json.dumps(kwargs)
+
+
+class TestLoader(BaseTestCase):
+
+    def setUp(self):
+        super(TestLoader, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(TestLoader, self).tearDown()
+
+    def write_log(self, name, lines):
+        path = os.path.join(self.tmp_dir, name)
+        with (gzip.open if name.endswith(".gz") else open)(path, "wb") as fd:
+            fd.write("\n".join(lines))
+        return path
+
+    def test_aggregate(self):
+        impressions, newtabs, invalid = aggregate([
+            event("2014-09-23", [16, None, 15]),
+            event("2014-09-23", [16, None, 15]),
+            event("2014-09-23", [16, None, 15], click=2),
+            event("2014-09-23", [16], click=3),
+            event("2014-09-23", [16, None, 15], click=-1),
+            "{not json",
+            "",
+        ])
+        assert_equal(3, invalid)
+        day = date(2014, 9, 23)
+        client = tuple(CLIENT[c] for c in ("locale", "country_code", "os", "browser", "version", "device"))
+        assert_equal({(16, day, 0, False) + client: [2, 0, 0, 0, 0, 0], (15, day, 2, False) + client: [2, 1, 0, 0, 0, 0]},
+                     impressions)
+        assert_equal({(day,) + client: [2]}, newtabs)
+
+    def test_aggregate_client(self):
+        """
+        Events without a string fitting each client column are invalid
+        """
+        lines = []
+        for column, value in [("os", None), ("version", 34), ("browser", ""), ("device", "D" * 65),
+                              ("locale", "en-US" * 3), ("country_code", u"\xe9tats")]:
+            line = json.loads(event("2014-09-23", [16]))
+            line[column] = value
+            lines.append(json.dumps(line))
+        line = json.loads(event("2014-09-23", [16]))
+        del line["os"]
+        lines.append(json.dumps(line))
+        assert_equal(({}, {}, 7), aggregate(lines))
+
+        line = json.loads(event("2014-09-23", [16]))
+        line["device"] = "D" * 64
+        impressions, newtabs, invalid = aggregate([json.dumps(line)])
+        assert_equal(0, invalid)
+        assert_equal(1, len(impressions))
+
+    def test_load_stats_invalid_client(self):
+        """
+        Events with an invalid client column are counted invalid rather than failing the load
+        """
+        line = json.loads(event("2014-09-23", [16]))
+        line["os"] = None
+        path = self.write_log("events.json", [event("2014-09-23", [16]), json.dumps(line)])
+        assert_equal((1, 1), load_stats([path], staging_dir=self.tmp_dir))
+
+    def test_encode_dimensions_types(self):
+        """
+        Dimension values are encoded by their text, whatever their type
+        """
+        day = date(2014, 9, 23)
+        sums = {(day, "en-US", "US", "Windows", "Firefox", 34, "Desktop"): [1],
+                (day, "en-US", "US", "Windows", "Firefox", "34", "Desktop"): [2]}
+        conn = self.env.db.engine.connect()
+        encoded, mappings = encode_dimensions(conn, sums, NEWTAB_KEYS)
+        conn.close()
+        assert_equal({u"34": mappings["version"][u"34"]}, mappings["version"])
+        assert_equal([[3]], encoded.values())
+
+    def test_aggregate_files(self):
+        paths = [self.write_log("events{0}.json".format(i), [event("2014-09-23", [16, 15]),
+                                                             event("2014-09-2{0}".format(i), [16], pin=0),
+                                                             "{}"])
+                 for i in range(4)]
+        impressions, newtabs, invalid = aggregate_files(paths, workers=1)
+        assert_equal(4, invalid)
+        assert_equal([[4]], newtabs.values())
+        assert_equal(5, len(impressions))
+        # sums of the files, whether read in one process or several
+        assert_equal((impressions, newtabs, invalid), aggregate_files(paths, workers=3))
+
+    def test_load_stats(self):
+        path = self.write_log("events.json.gz", [event("2014-09-23", [16, 15]),
+                                                 event("2014-09-24", [16]),
+                                                 event("2014-09-24", [16], block=0)])
+        staging_dir = os.path.join(self.tmp_dir, "staging")
+        os.mkdir(staging_dir)
+        conn = self.env.db.engine.connect()
+        daily = impression_stats_daily
+        stmt = select([daily.c.tile_id, daily.c.date, daily.c.impressions, daily.c.blocked, daily.c.week]).order_by(daily.c.date, daily.c.tile_id)
+
+        # loading again replaces the days loaded
+        for _ in range(2):
+            assert_equal((2, 0), load_stats([path], staging_dir=staging_dir))
+            assert_equal([(15, date(2014, 9, 23), 1, 0, 39), (16, date(2014, 9, 23), 1, 0, 39), (16, date(2014, 9, 24), 1, 1, 39)],
+                         conn.execute(stmt).fetchall())
+            assert_equal([(date(2014, 9, 23), 1), (date(2014, 9, 24), 1)],
+                         conn.execute(select([newtab_stats_daily.c.date, newtab_stats_daily.c.newtabs])
+                                      .order_by(newtab_stats_daily.c.date)).fetchall())
+            # the staged files are removed
+            assert_equal([], os.listdir(staging_dir))
+
+        # client names are stored once, and referred to by id
+        for dimension, table in dimensions.iteritems():
+            assert_equal([(CLIENT[dimension],)], conn.execute(select([table.c.name])).fetchall())
+            assert_equal([row[0] for row in conn.execute(select([table.c.id]))],
+                         [row[0] for row in conn.execute(select([daily.c["{0}_id".format(dimension)]]).distinct())])
+
+        weekly = impression_stats_weekly
+        assert_equal([(15, 1), (16, 2)],
+                     conn.execute(select([weekly.c.tile_id, weekly.c.impressions]).order_by(weekly.c.tile_id)).fetchall())
+        conn.close()
+
+    def test_load_stats_keep_staging(self):
+        path = self.write_log("events.json", [event("2014-09-23", [16])])
+        assert_equal((1, 0), load_stats([path], staging_dir=self.tmp_dir, keep_staging=True))
+        staged = [d for d in os.listdir(self.tmp_dir) if d.startswith("splice-load-")]
+        assert_equal(1, len(staged))
+        files = sorted(os.listdir(os.path.join(self.tmp_dir, staged[0])))
+        assert_equal(["impression_stats_daily.0000.csv.gz", "newtab_stats_daily.0000.csv.gz"], files)
+
+    def test_upload_staged(self):
+        """
+        Staged files are uploaded to S3, followed by a manifest of them for Redshift's COPY
+        """
+        bucket = Mock()
+        bucket.name = "bucket"
+        paths = [self.write_log("stats.{0:04d}.csv.gz".format(i), ["1,2"]) for i in range(2)]
+        with patch("splice.loader.Key") as key:
+            keys = upload_staged(bucket, "load/run", self.tmp_dir, "stats", paths)
+        assert_equal(["load/run/stats.0000.csv.gz", "load/run/stats.0001.csv.gz", "load/run/stats.manifest"], keys)
+        assert_equal(3, key.return_value.set_contents_from_filename.call_count)
+        with open(os.path.join(self.tmp_dir, "stats.manifest")) as fd:
+            manifest = json.load(fd)
+        assert_equal([{"url": "s3://bucket/load/run/stats.0000.csv.gz", "mandatory": True},
+                      {"url": "s3://bucket/load/run/stats.0001.csv.gz", "mandatory": True}], manifest["entries"])
+
+    def test_copy_manifest(self):
+        conn = Mock()
+        copy_manifest(conn, newtab_stats_daily, ("date", "newtabs"), "s3://bucket/stats.manifest", "aws_access_key_id=a")
+        stmt, = conn.execute.call_args[0]
+        assert_equal("COPY newtab_stats_daily (date, newtabs) FROM :manifest CREDENTIALS :credentials MANIFEST GZIP CSV",
+                     str(stmt))
+        assert_equal(dict(manifest="s3://bucket/stats.manifest", credentials="aws_access_key_id=a"),
+                     conn.execute.call_args[1])
+
+    def test_lock_dimensions(self):
+        """
+        Loads are serialized on the dimension tables, which only Redshift locks for reads too
+        """
+        for implicit_returning, statement in [
+                (False, "LOCK dim_browser, dim_device, dim_os, dim_version;"),
+                (True, "LOCK TABLE dim_browser, dim_device, dim_os, dim_version IN SHARE ROW EXCLUSIVE MODE;")]:
+            conn = Mock()
+            conn.dialect.name = "postgresql"
+            conn.dialect.implicit_returning = implicit_returning
+            lock_dimensions(conn)
+            conn.execute.assert_called_once_with(statement)
+
+        conn = Mock()
+        conn.dialect.name = "sqlite"
+        lock_dimensions(conn)
+        assert_equal(0, conn.execute.call_count)
@@ -0,0 +1,69 @@
+from datetime import date
+from nose.tools import assert_equal
+from splice import metrics
+from tests.base import BaseTestCase
+
+KEYS = ('year', 'week', 'tile_id', 'tile_title', 'impressions', 'clicks', 'pinned', 'blocked', 'sponsored', 'sponsored_link')
+
+
+class TestDerive(BaseTestCase):
+
+    def test_derive(self):
+        rows = [
+            (2014, 36, 11, 'a', 100, 5, 1, 2, 0, 0),
+            (2014, 36, 12, 'b', 0, 0, 0, 0, 0, 0),
+            (2014, 37, 11, 'a', 200, 20, 0, 4, 0, 0),
+        ]
+        keys, derived = metrics.derive(KEYS, rows, 'tile_id')
+        assert_equal(keys, KEYS + ('ctr', 'pin_rate', 'block_rate', 'impressions_delta', 'clicks_delta', 'ctr_delta'))
+        assert_equal(len(derived), 6)
+
+        assert_equal(derived[0][10:], (0.05, 0.01, 0.02, None, None, None))
+        # no impressions, no rates
+        assert_equal(derived[1][10:], (0.0, 0.0, 0.0, None, None, None))
+        assert_equal(derived[2][10:13], (0.1, 0.0, 0.02))
+        assert_equal(derived[2][13:15], (100, 15))
+        assert abs(derived[2][15] - 0.05) < 1e-9
+        # deltas of counts are ints, as the counts are
+        assert_equal((int, int, float), tuple(type(d) for d in derived[2][13:]))
+
+        # totals per tile, then overall
+        assert_equal(derived[3][:10], (None, None, 11, None, 300, 25, 1, 6, 0, 0))
+        assert_equal(derived[4][:10], (None, None, 12, None, 0, 0, 0, 0, 0, 0))
+        assert_equal(derived[5][:10], (None, None, None, None, 300, 25, 1, 6, 0, 0))
+        assert_equal(derived[5][13:], (None, None, None))
+
+    def test_derive_gaps(self):
+        """
+        Deltas are only taken from the period right before
+        """
+        rows = [
+            (2014, 36, 11, 'a', 100, 5, 1, 2, 0, 0),
+            (2014, 38, 11, 'a', 200, 20, 0, 4, 0, 0),
+            (2014, 39, 11, 'a', 300, 20, 0, 4, 0, 0),
+        ]
+        keys, derived = metrics.derive(KEYS, rows, 'tile_id')
+        assert_equal(derived[1][13:], (None, None, None))
+        assert_equal(derived[2][13:15], (100, 0))
+
+        monthly = ('year', 'month') + KEYS[2:]
+        rows = [(2013, 12, 11, 'a', 100, 5, 1, 2, 0, 0), (2014, 1, 11, 'a', 200, 5, 1, 2, 0, 0)]
+        keys, derived = metrics.derive(monthly, rows, 'tile_id')
+        assert_equal(derived[1][13:15], (100, 0))
+
+    def test_previous_period(self):
+        """
+        Periods before others, as in the year and period columns of the stats tables
+        """
+        assert_equal((2014, 12), metrics.previous_period(2015, 'month', 1))
+        assert_equal((2014, 51), metrics.previous_period(2014, 'week', 52))
+        # 2013-12-30 and 31 are in the first ISO week of 2014, 2016-01-01 in the 53rd of 2015
+        assert_equal((2013, 1), metrics.previous_period(2014, 'week', 1))
+        assert_equal((2015, 53), metrics.previous_period(2016, 'week', 53))
+        assert_equal((2014, 1), metrics.previous_period(2014, 'week', 2))
+        assert_equal((2013, date(2013, 12, 31)), metrics.previous_period(2014, 'date', date(2014, 1, 1)))
+
+    def test_derive_empty(self):
+        keys, derived = metrics.derive(KEYS, [], 'tile_id')
+        assert_equal(len(keys), len(KEYS) + 6)
+        assert_equal(derived, [])
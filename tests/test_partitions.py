@@ -0,0 +1,62 @@
+from datetime import date
+from mock import Mock, patch
+from nose.tools import assert_equal
+from splice import partitions
+from splice.models import impression_stats_daily
+from tests.base import BaseTestCase
+
+
+class TestPartitions(BaseTestCase):
+
+    def test_months(self):
+        assert_equal([date(2014, 11, 1), date(2014, 12, 1), date(2015, 1, 1)],
+                     list(partitions.months(date(2014, 11, 15), date(2015, 1, 1))))
+        assert_equal(date(2013, 12, 1), partitions.add_months(date(2014, 3, 1), -3))
+
+    def test_partition_ddl(self):
+        assert_equal("CREATE TABLE impression_stats_daily_2014_12 PARTITION OF impression_stats_daily "
+                     "FOR VALUES FROM ('2014-12-01') TO ('2015-01-01')",
+                     partitions.partition_ddl(impression_stats_daily, date(2014, 12, 1)))
+        assert_equal(date(2014, 12, 1), partitions.partition_month(impression_stats_daily, "impression_stats_daily_2014_12"))
+        assert_equal(None, partitions.partition_month(impression_stats_daily, "impression_stats_daily_old"))
+
+    def test_create_partitions(self):
+        conn = Mock()
+        with patch.object(partitions, "existing_partitions", Mock(return_value={"impression_stats_daily_2014_10"})):
+            created = partitions.create_partitions(conn, impression_stats_daily, date(2014, 9, 30), date(2014, 11, 2))
+        assert_equal(["impression_stats_daily_2014_09", "impression_stats_daily_2014_11"], created)
+        assert_equal(2, conn.execute.call_count)
+
+    def test_drop_partitions(self):
+        existing = {"impression_stats_daily_2014_08", "impression_stats_daily_2014_09", "impression_stats_daily_old"}
+        for detach_only, renamed, statement in [
+                (True, "impression_stats_daily_2014_08_detached",
+                 "ALTER TABLE impression_stats_daily_2014_08 RENAME TO impression_stats_daily_2014_08_detached"),
+                (False, None, "DROP TABLE impression_stats_daily_2014_08")]:
+            conn = Mock()
+            with patch.object(partitions, "existing_partitions", Mock(return_value=existing)), \
+                    patch.object(partitions, "detached_name", Mock(return_value=renamed)):
+                removed = partitions.drop_partitions(conn, impression_stats_daily, date(2014, 9, 1), detach_only)
+            assert_equal([("impression_stats_daily_2014_08", renamed)], removed)
+            assert_equal(2, conn.execute.call_count)
+            conn.execute.assert_any_call("ALTER TABLE impression_stats_daily DETACH PARTITION impression_stats_daily_2014_08")
+            # a detached partition leaves its name to the partition created for the month again
+            conn.execute.assert_called_with(statement)
+        assert_equal(None, partitions.partition_month(impression_stats_daily, "impression_stats_daily_2014_08_detached"))
+
+    def test_detached_name(self):
+        """
+        A month detached again is renamed after those detached before
+        """
+        conn = Mock()
+        name = "impression_stats_daily_2014_08"
+        for taken, detached in [([], name + "_detached"),
+                                ([name + "_detached"], name + "_detached_2"),
+                                ([name + "_detached", name + "_detached_2"], name + "_detached_3")]:
+            conn.execute.return_value = [(t,) for t in taken]
+            assert_equal(detached, partitions.detached_name(conn, name))
+
+    def test_supports_partitions(self):
+        conn = self.env.db.engine.connect()
+        assert not partitions.supports_partitions(conn)
+        conn.close()
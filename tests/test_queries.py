@@ -0,0 +1,280 @@
+from nose.tools import assert_equal, assert_not_equal, assert_true
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from mock import Mock, patch
+from splice.models import tile_fingerprint
+from splice.queries import insert_tile, insert_tiles, resolve_tiles, tile_exists, tile_ids, tile_fingerprints
+from tests.base import BaseTestCase
+
+
+class TestInsertTile(BaseTestCase):
+
+    def test_insert_tile_returns_id(self):
+        """
+        The id of an inserted tile is returned without relying on MAX(id)
+        """
+        columns = dict(
+            target_url="https://somewhere.com",
+            bg_color="#FFFFFF",
+            title="Some Title",
+            type="organic",
+            image_uri="somehash",
+            enhanced_image_uri=None,
+            locale="en-US",
+        )
+        assert_equal(30, insert_tile(**columns))
+        assert_equal(30, tile_exists(**columns))
+
+        columns["locale"] = "fr"
+        assert_equal(31, insert_tile(**columns))
+
+    def test_insert_tiles_mapping(self):
+        """
+        Batch inserts return a mapping of every tile key to its new id
+        """
+        tiles = [
+            dict(
+                target_url="https://somewhere.com/{0}".format(i),
+                bg_color="#FFFFFF",
+                title="Some Title",
+                type="organic",
+                image_uri="somehash",
+                enhanced_image_uri="someotherhash",
+                locale="en-US",
+            )
+            for i in range(3)
+        ]
+        ids = insert_tiles(tiles)
+        assert_equal([30, 31, 32], [ids[tile_fingerprint(**t)] for t in tiles])
+        assert_equal({}, insert_tiles([]))
+
+    def _postgres_conn(self, implicit_returning=True):
+        conn = Mock()
+        conn.dialect.name = "postgresql"
+        conn.dialect.implicit_returning = implicit_returning
+        return conn
+
+    def _tile(self):
+        return dict(
+            target_url="https://somewhere.com",
+            bg_color="#FFFFFF",
+            title="Some Title",
+            type="organic",
+            image_uri="somehash",
+            enhanced_image_uri=None,
+            locale="en-US",
+        )
+
+    def test_insert_tiles_returning(self):
+        """
+        On Postgres, ids come back from the insert itself
+        """
+        tile = self._tile()
+        fingerprint = tile_fingerprint(**tile)
+        conn = self._postgres_conn()
+        conn.execute.return_value = [(40, fingerprint)]
+
+        assert_equal({fingerprint: 40}, insert_tiles([tile], conn=conn))
+        assert_equal(1, conn.execute.call_count)
+        stmt = conn.execute.call_args[0][0]
+        assert_true(str(stmt.compile(dialect=postgresql.dialect())).endswith("RETURNING tiles.id, tiles.fingerprint"))
+
+    def test_resolve_tiles_concurrent_insert(self):
+        """
+        On Postgres, tiles inserted concurrently since the lookup are looked up again
+        """
+        tile = self._tile()
+        fingerprint = tile_fingerprint(**tile)
+        conn = self._postgres_conn()
+        with patch("splice.queries.tile_ids") as tile_ids_mock, patch("splice.queries.insert_tiles") as insert_mock:
+            tile_ids_mock.side_effect = [{}, {fingerprint: 40}]
+            insert_mock.side_effect = [IntegrityError("INSERT", {}, Exception()), {}]
+            assert_equal(({fingerprint: 40}, {}), resolve_tiles([tile], conn))
+            assert_equal([], insert_mock.call_args[0][0])
+        conn.begin_nested.return_value.rollback.assert_called_once_with()
+        assert_equal(0, conn.execute.call_count)
+
+    def test_resolve_tiles_locks_redshift(self):
+        """
+        Redshift doesn't enforce unique indexes, so the tiles table is locked
+        """
+        tile = self._tile()
+        fingerprint = tile_fingerprint(**tile)
+        conn = self._postgres_conn(implicit_returning=False)
+        with patch("splice.queries.tile_ids") as tile_ids_mock, patch("splice.queries.insert_tiles") as insert_mock:
+            tile_ids_mock.return_value = {}
+            insert_mock.return_value = {fingerprint: 40}
+            assert_equal(({fingerprint: 40}, {fingerprint: 40}), resolve_tiles([tile], conn))
+        conn.execute.assert_called_once_with("LOCK TABLE tiles;")
+        assert_equal(0, conn.begin_nested.call_count)
+
+
+class TestTileFingerprints(BaseTestCase):
+
+    def test_orm_tiles_fingerprinted(self):
+        """
+        Tiles added through the ORM are found by fingerprint
+        """
+        from splice.models import Tile
+        columns = dict(
+            target_url="https://somewhere.com",
+            bg_color="#FFFFFF",
+            title="Some Title",
+            type="organic",
+            image_uri="somehash",
+            enhanced_image_uri=None,
+            locale="en-US",
+        )
+        session = self.env.db.session
+        session.add(Tile(**columns))
+        session.commit()
+        assert_equal(30, tile_exists(**columns))
+
+    def test_null_enhanced_image(self):
+        """
+        A tile without an enhanced image differs from one with an empty one
+        """
+        assert_not_equal(tile_fingerprint("https://somewhere.com", "#FFFFFF", "Some Title", "somehash", None, "en-US"),
+                         tile_fingerprint("https://somewhere.com", "#FFFFFF", "Some Title", "somehash", "", "en-US"))
+
+    def test_unfingerprinted_tiles(self):
+        """
+        Tiles written without a fingerprint are found by their columns
+        """
+        from splice.models import Tile
+        columns = dict(
+            target_url="https://somewhere.com",
+            bg_color="#FFFFFF",
+            title="Some Title",
+            type="organic",
+            image_uri="somehash",
+            enhanced_image_uri=None,
+            locale="en-US",
+        )
+        self.env.db.engine.execute(Tile.__table__.insert().values(fingerprint=None, **columns))
+        assert_equal(30, tile_exists(**columns))
+        assert_equal({tile_fingerprint(**columns): 30}, tile_ids([columns]))
+
+        columns["enhanced_image_uri"] = ""
+        assert_equal(None, tile_exists(**columns))
+        assert_equal({}, tile_ids([columns]))
+
+    def test_reingest_without_queries(self):
+        """
+        Re-ingesting known tiles is resolved in-process
+        """
+        from splice.ingest import ingest_links
+        tile = {
+            "imageURI": "data:image/png;base64,somedata",
+            "url": "https://somewhere.com",
+            "title": "Some Title",
+            "type": "organic",
+            "bgColor": "#FFFFFF"
+        }
+        ingest_links({"STAR/en-US": [dict(tile)]})
+
+        with patch("splice.ingest.resolve_tiles") as resolve_mock:
+            data = ingest_links({"STAR/en-US": [dict(tile)], "CA/en-US": [dict(tile)]})
+            assert_equal(0, resolve_mock.call_count)
+        assert_equal(30, data["CA/en-US"][0]["directoryId"])
+
+        tile_fingerprints.clear()
+        data = ingest_links({"STAR/en-US": [dict(tile)]})
+        assert_equal(30, data["STAR/en-US"][0]["directoryId"])
+
+
+class TestCachedReport(BaseTestCase):
+
+    def setUp(self):
+        super(TestCachedReport, self).setUp()
+        from datetime import datetime
+        from splice.cache import LRUCache
+        from splice.environment import Environment
+        # the cache is disabled by default
+        self.cache = LRUCache()
+        patcher = patch.object(Environment, "report_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        from splice.models import impression_stats_daily
+        conn = self.env.db.engine.connect()
+        with open(self.get_fixture_path('impression_stats.csv')) as fd:
+            for line in fd:
+                row = line.split(',')
+                row[1] = datetime.strptime(row[1], "%Y-%m-%d")
+                conn.execute(impression_stats_daily.insert().values(self.encode_dimensions(conn, row, 12)))
+        conn.close()
+
+    def test_cached(self):
+        """
+        Report results are served from the cache for the same parameters
+        """
+        from splice.queries import tile_summary
+        conn = self.env.db.engine.connect()
+        keys, rows = tile_summary(conn, '2014-05-15', 'week', country_code='US')
+        rows = list(rows)
+        assert(rows)
+
+        unused = Mock()
+        assert_equal((keys, rows), tile_summary(unused, '2014-05-15', period='week', country_code='US'))
+        assert_equal(0, unused.execute.call_count)
+
+        keys, other = tile_summary(conn, '2014-05-15', 'week', country_code='CA')
+        assert_not_equal(rows, list(other))
+        conn.close()
+
+    def test_streamed_before_cached(self):
+        """
+        Rows are streamed as they are read, and only cached once all are
+        """
+        from splice.queries import tile_summary
+        conn = self.env.db.engine.connect()
+        keys, rows = tile_summary(conn, '2014-05-15', 'week')
+        first = next(rows)
+        assert_equal(0, len(self.cache._items))
+        rows = [first] + list(rows)
+        assert_equal((keys, rows), tile_summary(Mock(), '2014-05-15', 'week'))
+        conn.close()
+
+    def test_large_results_not_cached(self):
+        """
+        Results of more than REPORT_CACHE_MAX_ROWS rows are streamed without being cached
+        """
+        from splice.queries import tile_summary
+        max_rows = self.env.config.REPORT_CACHE_MAX_ROWS
+        self.env.config.REPORT_CACHE_MAX_ROWS = 2
+        try:
+            conn = self.env.db.engine.connect()
+            rows = list(tile_summary(conn, '2014-05-15', 'week')[1])
+            assert(len(rows) > 2)
+            assert_equal(rows, list(tile_summary(conn, '2014-05-15', 'week')[1]))
+            conn.close()
+        finally:
+            self.env.config.REPORT_CACHE_MAX_ROWS = max_rows
+
+
+class TestPeriodKey(BaseTestCase):
+
+    def test_week_of_calendar_year(self):
+        """
+        Weeks are keyed on the calendar year, as in the stats tables, not the ISO year
+        """
+        from datetime import date
+        from splice.loader import _period_columns
+        from splice.queries import _period_key
+        for day in (date(2014, 12, 29), date(2016, 1, 1), date(2014, 9, 15)):
+            month, week, year = _period_columns(day)
+            assert_equal((year, week), _period_key(day, 'week'))
+            assert_equal((year, month), _period_key(day, 'month'))
+        assert_equal((2014, 1), _period_key(date(2014, 12, 29), 'week'))
+
+    def test_period_dates(self):
+        """
+        Rows of a week are bounded by the dates of its ISO weeks within the calendar year
+        """
+        from datetime import date
+        from splice.queries import _period_dates
+        assert_equal([(date(2014, 9, 15), date(2014, 9, 21))], _period_dates(2014, 'week', 38))
+        assert_equal([(date(2014, 1, 1), date(2014, 1, 5)), (date(2014, 12, 29), date(2014, 12, 31))],
+                     _period_dates(2014, 'week', 1))
+        assert_equal([(date(2016, 1, 1), date(2016, 1, 3))], _period_dates(2016, 'week', 53))
+        assert_equal([(date(2014, 2, 1), date(2014, 2, 28))], _period_dates(2014, 'month', 2))
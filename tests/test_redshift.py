@@ -0,0 +1,76 @@
+from mock import Mock, patch
+from nose.tools import assert_equal
+from splice import redshift
+from splice.models import Tile, impression_stats_daily, newtab_stats_daily
+from tests.base import BaseTestCase
+
+
+class TestRedshiftLayout(BaseTestCase):
+
+    def test_declared_layout(self):
+        layout = redshift.declared_layout(impression_stats_daily)
+        assert_equal("key", layout["diststyle"])
+        assert_equal("tile_id", layout["distkey"])
+        assert_equal(("date", "tile_id"), layout["sortkey"])
+        assert_equal("bytedict", layout["encode"]["locale"])
+
+        layout = redshift.declared_layout(Tile.__table__)
+        assert_equal(("all", None, ()), (layout["diststyle"], layout["distkey"], layout["sortkey"]))
+
+    def test_layout_diff(self):
+        declared = redshift.declared_layout(newtab_stats_daily)
+        live = dict(declared, encode=dict(declared["encode"]))
+        assert_equal([], redshift.layout_diff(declared, live))
+
+        live.update(sortkey=(), diststyle="all")
+        live["encode"]["locale"] = "lzo"
+        assert_equal(["diststyle: all instead of even",
+                      "sortkey: () instead of ('date',)",
+                      "encode locale: lzo instead of bytedict"],
+                     redshift.layout_diff(declared, live))
+
+    def test_create_table_ddl(self):
+        ddl = redshift.create_table_ddl(impression_stats_daily)
+        assert ddl.startswith("CREATE TABLE impression_stats_daily (\n    tile_id INTEGER,\n    date DATE NOT NULL,\n")
+        assert "    enhanced BOOLEAN DEFAULT FALSE NOT NULL ENCODE runlength,\n" in ddl
+        assert "    FOREIGN KEY(tile_id) REFERENCES tiles (id)" in ddl
+        assert ddl.endswith("\nDISTSTYLE KEY\nDISTKEY (tile_id)\nSORTKEY (date, tile_id);")
+
+    def test_deep_copy_ddl(self):
+        ddl = redshift.deep_copy_ddl(Tile.__table__, {"id": 31})
+        # the copy generates the ids following those copied
+        assert ddl.startswith("CREATE TABLE tiles_new (\n    id INTEGER GENERATED BY DEFAULT AS IDENTITY(31,1) NOT NULL,")
+        assert "\n\nDROP TABLE tiles CASCADE;\n\nALTER TABLE tiles_new RENAME TO tiles;\n\n" in ddl
+        # the foreign keys dropped with the table are added back
+        assert "ALTER TABLE impression_stats_daily ADD FOREIGN KEY (tile_id) REFERENCES tiles (id);" in ddl
+
+    def test_layout_migration(self):
+        tables = [Tile.__table__, impression_stats_daily, newtab_stats_daily]
+        layouts = dict((t.name, redshift.declared_layout(t)) for t in tables)
+
+        with patch.object(redshift, "live_layout", lambda conn, name: layouts[name]):
+            assert_equal((None, {}), redshift.layout_migration(None, tables))
+
+        layouts["impression_stats_daily"] = dict(layouts["impression_stats_daily"], sortkey=())
+        with patch.object(redshift, "live_layout", lambda conn, name: layouts[name]):
+            migration, diffs = redshift.layout_migration(None, tables)
+        assert_equal({"impression_stats_daily": ["sortkey: () instead of ('date', 'tile_id')"]}, diffs)
+        assert migration.startswith("BEGIN;\n\n-- sortkey: () instead of ('date', 'tile_id')\nCREATE TABLE impression_stats_daily_new (")
+        assert migration.endswith("ALTER TABLE impression_stats_daily_new RENAME TO impression_stats_daily;\n\nCOMMIT;\n")
+
+    def test_layout_migration_identity(self):
+        tables = [Tile.__table__]
+        layouts = {"tiles": dict(redshift.declared_layout(Tile.__table__), diststyle="even")}
+        conn = Mock()
+
+        conn.execute.return_value.scalar.return_value = 30
+        with patch.object(redshift, "live_layout", lambda conn, name: layouts[name]):
+            migration, _ = redshift.layout_migration(conn, tables)
+        assert "    id INTEGER GENERATED BY DEFAULT AS IDENTITY(31,1) NOT NULL," in migration
+        assert_equal("SELECT max(tiles.id) AS max_1 \nFROM tiles", str(conn.execute.call_args[0][0]))
+
+        # an empty table generates from the seed
+        conn.execute.return_value.scalar.return_value = None
+        with patch.object(redshift, "live_layout", lambda conn, name: layouts[name]):
+            migration, _ = redshift.layout_migration(conn, tables)
+        assert "    id INTEGER GENERATED BY DEFAULT AS IDENTITY(1,1) NOT NULL," in migration